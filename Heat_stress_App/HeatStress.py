@@ -1,19 +1,18 @@
 import streamlit as st
-import xarray as xr
 import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
-import requests
-from PIL import Image
-from io import BytesIO
-from urllib.parse import urlencode
-from pyproj import CRS, Transformer
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import matplotlib.colors as mcolors
-import os
+from resources import TEMP_PATH, geographic_grid, open_dataset, padded_bbox, time_values
+from basemap import get_wms_image
+from lod import BASEMAP_TARGET_VERTICES, SURFACE_TARGET_VERTICES, prepare_basemap, prepare_surface
+from prefetch import Prefetcher, neighbours, session_owner
+from animation import ANIMATION_CMAPS, APP_WORKERS, DEFAULT_HOUR, build_animation
+from warmup import start_warm_up
+from instrumentation import finish_page, span, start_page
 
 st.set_page_config(page_title="Heat Stress", page_icon="🏠", layout="wide")
+# Precaricamento in background (una volta per processo) di dati e librerie delle pagine
+start_warm_up()
+page_metrics = start_page("heatstress")
 st.title("☀️ Welcome in Heat Stress!")
 st.markdown("#### Explore how climate and heat stress evolve over time in **Lombardy**")
 st.write("Let's visualize a temperature map")
@@ -22,94 +21,81 @@ st.write("THIS IS A DEMO VERSION OF THE APP AND THE AVAILABLE DATES RANGE FROM 2
 # === PARAMETRO Z EXAGGERATION ===
 z_exaggeration = 0.05
 
-# === Caricamento dati ===
-dataset_path = os.path.join("Heat_stress_App", "data", "2m_air_temp_2023-04-01_2023-09-30.nc")
-
+# === Caricamento dati (dataset condiviso, aperto una sola volta per processo) ===
 try:
-    ds = xr.open_dataset(dataset_path)
-
-    time_values = [pd.to_datetime(t).to_pydatetime() for t in ds["T_2M"].time.values]
-    selected_time = st.slider("**Select a date**", min_value=time_values[0], max_value=time_values[-1], value=time_values[0])
+    with span("heatstress.open_dataset"):
+        ds = open_dataset(TEMP_PATH)
+        slider_times = time_values(TEMP_PATH).to_pydatetime().tolist()
+    selected_time = st.slider("**Select a date**", min_value=slider_times[0], max_value=slider_times[-1], value=slider_times[0])
     st.markdown(f"**Selected date:** {selected_time.strftime('%#d %b %y')}")
     st.markdown("Pan with your mouse to **move the map**!")
-    time_index = time_values.index(selected_time)
+    time_index = slider_times.index(selected_time)
 
 except Exception as e:
     st.error(f"❌ Failed to load dataset: {e}")
     st.stop()
 
 time0 = selected_time
-temp_data = ds["T_2M"].sel(time=selected_time)
-tempK = temp_data.values
-tempC_raw = tempK - 273.15  # temperatura in °C
-
-# === Coordinate geografiche ===
-rlat = ds["rlat"].values
-rlon = ds["rlon"].values
-rlon2d, rlat2d = np.meshgrid(rlon, rlat)
-
-rotated_attrs = ds["crs_rotated_latitude_longitude"].attrs
-pole_lat = rotated_attrs.get("grid_north_pole_latitude", 43.0)
-pole_lon = rotated_attrs.get("grid_north_pole_longitude", -170.0)
-
-crs_rot = CRS.from_cf({
-    "grid_mapping_name": "rotated_latitude_longitude",
-    "grid_north_pole_latitude": pole_lat,
-    "grid_north_pole_longitude": pole_lon
-})
-crs_target = CRS.from_epsg(4326)
-transformer = Transformer.from_crs(crs_rot, crs_target, always_xy=True)
-lon, lat = transformer.transform(rlon2d, rlat2d)
+
+# === Coordinate geografiche (calcolate una volta e condivise tra le pagine) ===
+lon, lat = geographic_grid(TEMP_PATH)
 
 # Bounding box per la mappa
-lat_min, lat_max = np.nanmin(lat), np.nanmax(lat)
-lon_min, lon_max = np.nanmin(lon), np.nanmax(lon)
-padding = 1.5
-lat_min -= padding
-lat_max += padding
-lon_min -= padding
-lon_max += padding
-
-# Scarica mappa WMS
-wms_base = "https://ows.terrestris.de/osm/service?"
-params = {
-    "SERVICE": "WMS",
-    "VERSION": "1.1.1",
-    "REQUEST": "GetMap",
-    "FORMAT": "image/png",
-    "TRANSPARENT": "TRUE",
-    "LAYERS": "OSM-WMS",
-    "STYLES": "",
-    "SRS": "EPSG:4326",
-    "BBOX": f"{lon_min},{lat_min},{lon_max},{lat_max}",
-    "WIDTH": "512",
-    "HEIGHT": "512"
-}
-response = requests.get(wms_base + urlencode(params))
-image = Image.open(BytesIO(response.content)).convert("RGB")
-map_img = np.array(image) / 255.0
-
-# Griglia per immagine WMS
-img_lat = np.linspace(lat_min, lat_max, map_img.shape[0])
-img_lon = np.linspace(lon_min, lon_max, map_img.shape[1])
-img_lon_grid, img_lat_grid = np.meshgrid(img_lon, img_lat)
-
-# Calcolo superficie
-base = np.nanmin(tempC_raw)
-range_ = np.nanmax(tempC_raw) - base
-z_surface = ((np.nanmax(tempC_raw) - tempC_raw) / range_) * z_exaggeration
-surface_color = tempC_raw
-custom_temp = np.expand_dims(surface_color, axis=2)
+lon_min, lat_min, lon_max, lat_max = padded_bbox(TEMP_PATH)
+
+
+# === Dati della superficie decimati e in float32, con precaricamento dei timestamp vicini ===
+# Lo slider avanza di un giorno: giorni adiacenti e ore vicine vengono preparati in background
+PREFETCH_OFFSETS = ("1D", "-1D", "2D", "-2D", "1h", "-1h")
+
+def load_surface(time_key, target_vertices=SURFACE_TARGET_VERTICES):
+    tempC_raw = ds["T_2M"].sel(time=time_key).values - 273.15  # temperatura in °C
+    return prepare_surface(tempC_raw, lon, lat, z_exaggeration, target_vertices)
+
+
+@st.cache_resource(show_spinner=False)
+def get_surface_prefetcher():
+    return Prefetcher(max_items=256)
+
+
+@st.cache_resource(show_spinner=False)
+def load_wms_texture(bbox, target_vertices=BASEMAP_TARGET_VERTICES):
+    # Mappa WMS (dalla cache locale, scaricata solo la prima volta)
+    map_img = get_wms_image(bbox)
+    if map_img is None:
+        # Le eccezioni non vengono messe in cache: al prossimo rerun si riprova
+        raise LookupError("Mappa WMS non disponibile")
+    return prepare_basemap(map_img, bbox, target_vertices)
+
+
+def load_basemap_texture(bbox, target_vertices=BASEMAP_TARGET_VERTICES):
+    try:
+        return load_wms_texture(bbox, target_vertices)
+    except LookupError:
+        # Nessuna rete e nessuna mappa in cache: sfondo neutro
+        return prepare_basemap(np.ones((512, 512, 3)), bbox, target_vertices)
+
+
+surface_prefetcher = get_surface_prefetcher()
+with span("heatstress.surface"):
+    surface = surface_prefetcher.get(pd.Timestamp(selected_time), load_surface)
+surface_prefetcher.prefetch(neighbours(slider_times, selected_time, PREFETCH_OFFSETS), load_surface,
+                            owner=session_owner())
+with span("heatstress.basemap_texture"):
+    basemap_texture = load_basemap_texture((lon_min, lat_min, lon_max, lat_max))
 
 # === Plot 3D ===
+# plotly importato qui: titolo e slider sono già visibili mentre viene caricato
+plotly_timer = span("heatstress.plotly").start()
+import plotly.graph_objects as go
+
 fig = go.Figure()
 
-map_gray = np.flipud(map_img.mean(axis=2))
 fig.add_trace(go.Surface(
-    z=np.zeros_like(img_lon_grid),
-    x=img_lon_grid,
-    y=img_lat_grid,
-    surfacecolor=map_gray,
+    z=np.zeros_like(basemap_texture["gray"]),
+    x=basemap_texture["x"],
+    y=basemap_texture["y"],
+    surfacecolor=basemap_texture["gray"],
     colorscale="gray",
     cmin=0,
     cmax=1,
@@ -119,20 +105,20 @@ fig.add_trace(go.Surface(
 ))
 
 fig.add_trace(go.Surface(
-    z=z_surface,
-    x=lon,
-    y=lat,
-    surfacecolor=surface_color,
-    customdata=custom_temp,
+    z=surface["z"],
+    x=surface["x"],
+    y=surface["y"],
+    surfacecolor=surface["color"],
+    customdata=surface["color"],
     colorscale='turbo',
-    cmin=np.nanmin(tempC_raw),
-    cmax=np.nanmax(tempC_raw),
+    cmin=surface["cmin"],
+    cmax=surface["cmax"],
     showscale=False,
     opacity=0.5,
     hovertemplate=
         "Lon: %{x:.4f}<br>" +
         "Lat: %{y:.4f}<br>" +
-        "Temp: %{customdata[0]:.2f} °C<br>" +
+        "Temp: %{customdata:.2f} °C<br>" +
         "<extra></extra>"
 ))
 
@@ -154,12 +140,20 @@ fig.update_layout(
 )
 
 st.plotly_chart(fig, use_container_width=True)
+plotly_timer.stop()
 
 
 # === Colorbar senza bordi ma con tacche e valori piccoli e grigi ===
+# matplotlib serve solo per la colorbar: importato dopo aver mostrato il grafico 3D
+colorbar_timer = span("heatstress.colorbar").start()
+import matplotlib
+import matplotlib.pyplot as plt
+import matplotlib.cm as cm
+import matplotlib.colors as mcolors
+
 fig_colorbar, ax = plt.subplots(figsize=(2.5, 0.05))
-norm = mcolors.Normalize(vmin=np.nanmin(tempC_raw), vmax=np.nanmax(tempC_raw))
-turbo = cm.get_cmap("turbo")
+norm = mcolors.Normalize(vmin=surface["cmin"], vmax=surface["cmax"])
+turbo = matplotlib.colormaps["turbo"]
 
 cb1 = plt.colorbar(
     cm.ScalarMappable(norm=norm, cmap=turbo),
@@ -185,6 +179,42 @@ for spine in ax.spines.values():
 
 # Mostra la legenda
 st.pyplot(fig_colorbar)
+colorbar_timer.stop()
+
+
+# === Time-lapse di una variabile (animazione generata una volta e letta dalla cache) ===
+st.divider()
+st.markdown("## 🎞️ Time-lapse")
+anim_cols = st.columns([1, 2])
+with anim_cols[0]:
+    anim_variable = st.selectbox("Variable", list(ANIMATION_CMAPS), index=list(ANIMATION_CMAPS).index("UTCI"))
+    anim_range = st.date_input("Date range", (slider_times[0].date(), slider_times[-1].date()),
+                               min_value=slider_times[0].date(), max_value=slider_times[-1].date())
+    # Solo le ore presenti nei dati (la demo contiene le ore 11-17)
+    anim_hours = sorted({t.hour for t in slider_times})
+    anim_hour = st.select_slider("Hour of the day", options=anim_hours,
+                                 value=DEFAULT_HOUR if DEFAULT_HOUR in anim_hours else anim_hours[0])
+    generate = st.button("Generate animation")
+
+with anim_cols[1]:
+    if len(anim_range) == 2:
+        with span("heatstress.animation_lookup"):
+            anim_path = build_animation(anim_variable, *anim_range, hour=anim_hour, create=False, verbose=False)
+        anim_error = None
+        if anim_path is None and generate:
+            try:
+                with st.spinner("Rendering frames..."), span("heatstress.animation_build"):
+                    anim_path = build_animation(anim_variable, *anim_range, hour=anim_hour, n_workers=APP_WORKERS,
+                                                verbose=False)
+            except ValueError as e:
+                # Es. nessun timestamp nel periodo selezionato
+                anim_error = e
+        if anim_path is not None:
+            st.image(anim_path, width="stretch")
+        elif anim_error is not None:
+            st.warning(f"⚠️ {anim_error}")
+        else:
+            st.info("Press **Generate animation** to render the selected period.")
 
 
 
@@ -225,3 +255,5 @@ If you want to further undertand the scientific bases behind these indices I inv
 st.markdown("---")
 
 st.info("Use the menu on the left to explore how each index behaves across time and space!")
+
+finish_page(page_metrics)
@@ -0,0 +1,235 @@
+"""
+Animazioni (time-lapse) di un indice su un intervallo di date.
+
+I fotogrammi vengono generati in parallelo da più processi in due fasi:
+  1. calcolo delle griglie dell'indice per blocchi contigui di timestamp
+     (dal cubo precalcolato se presente, altrimenti dai NetCDF con
+     compute_all_indices su tutto il blocco)
+  2. rendering dei fotogrammi con le funzioni di rendering.py, con una scala
+     di colori fissa per tutta la sequenza (min/max globali della fase 1),
+     etichetta con data e ora e quantizzazione a 256 colori
+Il risultato è codificato in GIF (o WebP animato) e salvato in ANIMATION_DIR
+con un nome che dipende dai parametri: una seconda richiesta uguale legge
+direttamente il file.
+
+Uso offline, per esempio per l'estate 2023:
+    python Heat_stress_App/animation.py UTCI 2023-04-01 2023-09-30
+"""
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+import resources
+
+
+ANIMATION_DIR = os.path.join(resources.DATA_DIR, "animations")
+CUBE_PATH = resources.CUBE_PATH
+
+DEFAULT_HOUR = 12  # un fotogramma al giorno a quest'ora (None = tutti i timestamp)
+DEFAULT_FPS = 6
+DEFAULT_WIDTH = 480
+APP_WORKERS = 2  # processi per le animazioni generate dalla pagina (server condiviso)
+FORMATS = {"gif": "GIF", "webp": "WEBP"}
+
+ANIMATION_CMAPS = {
+    "Temperature": "inferno",
+    "Relative Humidity": "Blues",
+    "Humidex": "plasma",
+    "WBGT": "viridis",
+    "Lethal Heat Stress Index": "coolwarm",
+    "UTCI": "cividis"
+}
+
+
+def frame_timestamps(times, start, end, hour=DEFAULT_HOUR):
+    """
+    Timestamp dei fotogrammi tra start ed end (inclusi).
+    Parametri:
+      - times: timestamp disponibili
+      - hour: ora del giorno da usare (un fotogramma al giorno); None = tutti
+    Ritorna:
+      - array delle posizioni in times
+    """
+    times = pd.DatetimeIndex(times)
+    start = pd.Timestamp(start)
+    end = pd.Timestamp(end)
+    if end == end.normalize():
+        end = end + pd.Timedelta(days=1) - pd.Timedelta(1, "ns")
+    selected = (times >= start) & (times <= end)
+    if hour is not None:
+        selected &= (times.hour == hour) & (times.minute == 0)
+    return np.flatnonzero(selected)
+
+
+def _blocks(positions, n_blocks):
+    """Suddivide le posizioni in (al più) n_blocks blocchi contigui."""
+    return [block for block in np.array_split(positions, max(1, n_blocks)) if len(block)]
+
+
+def _load_grids(temp_path, dew_path, cube_root, positions, variable):
+    """
+    Fase 1 (worker): griglie (n, rlat, rlon) float32 della variabile per i
+    timestamp in positions.
+    """
+    from cube import IndexCube, cube_exists
+
+    if cube_root is not None and cube_exists(cube_root):
+        cube = IndexCube(cube_root)
+        return cube.read(positions, variable)
+
+    from extraction import open_datasets
+    from functions import compute_all_indices, fill_dew_point
+
+    dataset_temp, dataset_dew = open_datasets(temp_path, dew_path)
+    try:
+        Ta_k = dataset_temp['T_2M'].isel(time=positions).transpose('time', 'rlat', 'rlon').load()
+        if variable == "Temperature":
+            return (Ta_k.values - 273.15).astype(np.float32)
+        Td_k = dataset_dew['TD_2M'].sel(time=Ta_k.time.values).transpose('time', 'rlat', 'rlon').load()
+        return compute_all_indices(Ta_k, fill_dew_point(Td_k))[variable]
+    finally:
+        dataset_temp.close()
+        dataset_dew.close()
+
+
+def _render_frames(grids, labels, cmap, extent, base, vmin, vmax, alpha):
+    """
+    Fase 2 (worker): fotogrammi come immagini PIL in modalità palette.
+    """
+    from PIL import Image, ImageDraw
+    from rendering import render_map_rgb
+
+    width = base.shape[1]
+    frames = []
+    for grid, label in zip(grids, labels):
+        image = Image.fromarray(render_map_rgb(grid, cmap, extent, vmin, vmax, alpha, width, base=base))
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((4, 4, 8 + 7 * len(label), 20), fill=(255, 255, 255))
+        draw.text((7, 6), label, fill=(60, 60, 60))
+        frames.append(image.quantize(colors=256, method=Image.Quantize.FASTOCTREE))
+    return frames
+
+
+def encode_animation(frames, fps=DEFAULT_FPS, fmt="gif"):
+    """Codifica i fotogrammi in un'animazione (GIF o WebP) che si ripete all'infinito."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Formato non valido: {fmt!r} (usa {', '.join(FORMATS)})")
+    buffer = BytesIO()
+    frames[0].save(buffer, format=FORMATS[fmt], save_all=True, append_images=frames[1:],
+                   duration=int(round(1000 / fps)), loop=0)
+    return buffer.getvalue()
+
+
+def animation_path(variable, start, end, hour=DEFAULT_HOUR, fps=DEFAULT_FPS, width=DEFAULT_WIDTH, fmt="gif",
+                   style=(), temp_path=resources.TEMP_PATH, output_dir=ANIMATION_DIR):
+    """
+    Percorso del file in cache per i parametri dati (style: cmap, alpha,
+    vmin, vmax). Dipende anche dalla data di modifica del NetCDF.
+    """
+    mtime = os.path.getmtime(temp_path) if os.path.exists(temp_path) else 0
+    key = f"{variable}|{pd.Timestamp(start)}|{pd.Timestamp(end)}|{hour}|{fps}|{width}|{style}|{temp_path}|{mtime}"
+    slug = variable.lower().replace(" ", "_")
+    return os.path.join(output_dir, f"{slug}_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}.{fmt}")
+
+
+def build_animation(variable, start, end, hour=DEFAULT_HOUR, fps=DEFAULT_FPS, width=DEFAULT_WIDTH, fmt="gif",
+                    cmap=None, alpha=0.6, vmin=None, vmax=None, n_workers=None,
+                    temp_path=resources.TEMP_PATH, dew_path=resources.DEW_PATH, cube_root=CUBE_PATH,
+                    output_dir=ANIMATION_DIR, extent=None, create=True, verbose=True):
+    """
+    Genera (o legge dalla cache) l'animazione di una variabile tra start ed end.
+    Parametri:
+      - variable: "Temperature" o un nome di INDEX_NAMES
+      - start, end: intervallo di date (inclusi)
+      - hour: ora del giorno dei fotogrammi (None = tutti i timestamp)
+      - fps: fotogrammi al secondo
+      - width: larghezza in pixel
+      - fmt: "gif" oppure "webp"
+      - cmap: colormap (default: quella della Dashboard per la variabile)
+      - vmin, vmax: scala dei colori (default: min e max su tutta la sequenza)
+      - n_workers: numero di processi (1 = sequenziale, None = tutti i core;
+        dall'app usare APP_WORKERS)
+      - extent: estensione in EPSG:3857 (default: quella del NetCDF)
+      - create: se False restituisce None invece di generare un'animazione non in cache
+    Ritorna:
+      - percorso del file dell'animazione
+    """
+    from rendering import basemap_raster, output_shape
+
+    cmap = cmap or ANIMATION_CMAPS.get(variable, "inferno")
+    path = animation_path(variable, start, end, hour, fps, width, fmt, (cmap, alpha, vmin, vmax),
+                          temp_path, output_dir)
+    if os.path.exists(path):
+        if verbose:
+            print(f"♻️ Animazione già presente: {path}")
+        return path
+    if not create:
+        return None
+
+    start_time = time.time()
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    times = resources.time_values(temp_path).values
+    extent = tuple(float(v) for v in (extent or resources.web_mercator_extent(temp_path)))
+
+    positions = frame_timestamps(times, start, end, hour)
+    if len(positions) == 0:
+        raise ValueError(f"Nessun timestamp disponibile tra {start} e {end}")
+    labels = [f"{pd.Timestamp(t):%Y-%m-%d %H:%M}" for t in times[positions]]
+    blocks = _blocks(positions, n_workers * 4)
+    base = np.array(basemap_raster(extent, output_shape(extent, width)))
+
+    # spawn invece di fork: il server Streamlit è multithread e un fork può bloccarsi
+    executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) \
+        if n_workers > 1 else None
+    try:
+        # Fase 1: griglie (blocchi contigui, risultati nell'ordine dei blocchi)
+        if executor is None:
+            grids = [_load_grids(temp_path, dew_path, cube_root, block, variable) for block in blocks]
+        else:
+            futures = [executor.submit(_load_grids, temp_path, dew_path, cube_root, block, variable)
+                       for block in blocks]
+            grids = [future.result() for future in futures]
+        if vmin is None:
+            vmin = float(min(np.nanmin(g) for g in grids))
+        if vmax is None:
+            vmax = float(max(np.nanmax(g) for g in grids))
+        if verbose:
+            print(f"  {len(positions)} griglie calcolate in {time.time() - start_time:.1f} secondi.")
+
+        # Fase 2: fotogrammi con scala fissa
+        offsets = np.cumsum([0] + [len(block) for block in blocks])
+        jobs = [(g, labels[a:b], cmap, extent, base, vmin, vmax, alpha)
+                for g, a, b in zip(grids, offsets[:-1], offsets[1:])]
+        if executor is None:
+            frames = [frame for job in jobs for frame in _render_frames(*job)]
+        else:
+            futures = [executor.submit(_render_frames, *job) for job in jobs]
+            frames = [frame for future in futures for frame in future.result()]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    content = encode_animation(frames, fps, fmt)
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+    if verbose:
+        print(f"✅ Animazione di {len(frames)} fotogrammi ({len(content) / 1024:.0f} kB) creata in "
+              f"{time.time() - start_time:.1f} secondi: {path}")
+    return path
+
+
+if __name__ == "__main__":
+    build_animation(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -0,0 +1,246 @@
+"""
+Cache locale delle mappe di sfondo (tile contextily e immagini WMS).
+
+Il dominio dell'app è fisso (Lombardia), quindi le mappe di sfondo sono
+sempre le stesse: vengono scaricate una sola volta e salvate su disco.
+  - SHIPPED_DIR (data/basemaps/): raster pre-renderizzati distribuiti con
+    l'app, letti per primi e mai eliminati (vedi prewarm)
+  - CACHE_DIR (data/basemap_cache/): cache a runtime con dimensione massima
+    MAX_CACHE_MB; quando viene superata si eliminano i file usati meno di recente
+Se la rete non è disponibile e la mappa non è in cache, le funzioni
+restituiscono None e le pagine mostrano i dati senza sfondo.
+
+Uso offline per preparare i raster da distribuire:
+    python Heat_stress_App/basemap.py
+"""
+import hashlib
+import os
+import time
+from io import BytesIO
+from urllib.parse import urlencode
+
+import numpy as np
+
+from instrumentation import span
+
+
+DATA_DIR = os.path.join("Heat_stress_App", "data")
+SHIPPED_DIR = os.path.join(DATA_DIR, "basemaps")
+CACHE_DIR = os.environ.get("HEATSTRESS_BASEMAP_CACHE", os.path.join(DATA_DIR, "basemap_cache"))
+MAX_CACHE_MB = 200
+REQUEST_TIMEOUT = 10  # secondi
+
+WMS_BASE = "https://ows.terrestris.de/osm/service?"
+
+
+# === Cache su disco ===
+
+def _cache_name(key, ext):
+    return hashlib.sha1(key.encode("utf-8")).hexdigest() + ext
+
+
+def _find_cached(name):
+    """Cerca prima tra i raster distribuiti, poi nella cache a runtime."""
+    shipped = os.path.join(SHIPPED_DIR, name)
+    if os.path.exists(shipped):
+        return shipped
+    cached = os.path.join(CACHE_DIR, name)
+    if os.path.exists(cached):
+        # Aggiorna la data di ultimo uso (politica LRU)
+        os.utime(cached, None)
+        return cached
+    return None
+
+
+def _store(name, data, directory=None):
+    """Scrive un file in cache in modo atomico e applica il limite di dimensione."""
+    directory = directory or CACHE_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    if directory == CACHE_DIR:
+        evict()
+    return path
+
+
+def evict(max_mb=None):
+    """
+    Elimina i file usati meno di recente finché la cache a runtime
+    non rientra in max_mb megabyte (default MAX_CACHE_MB).
+    Ritorna:
+      - numero di file eliminati
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return 0
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if os.path.isfile(path) and not name.endswith(".tmp"):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    limit = (MAX_CACHE_MB if max_mb is None else max_mb) * 1024 * 1024
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+
+def clear_cache():
+    """Svuota la cache a runtime (i raster distribuiti non vengono toccati)."""
+    if os.path.isdir(CACHE_DIR):
+        for name in os.listdir(CACHE_DIR):
+            os.remove(os.path.join(CACHE_DIR, name))
+
+
+# === Sfondo WMS (pagina HeatStress) ===
+
+def wms_params(bbox, width=512, height=512):
+    """Parametri della richiesta GetMap per il bounding box (lon_min, lat_min, lon_max, lat_max)."""
+    lon_min, lat_min, lon_max, lat_max = bbox
+    return {
+        "SERVICE": "WMS",
+        "VERSION": "1.1.1",
+        "REQUEST": "GetMap",
+        "FORMAT": "image/png",
+        "TRANSPARENT": "TRUE",
+        "LAYERS": "OSM-WMS",
+        "STYLES": "",
+        "SRS": "EPSG:4326",
+        "BBOX": f"{lon_min},{lat_min},{lon_max},{lat_max}",
+        "WIDTH": str(width),
+        "HEIGHT": str(height)
+    }
+
+
+def fetch_wms_png(bbox, width=512, height=512, directory=None):
+    """
+    Restituisce i byte PNG della mappa WMS, dalla cache se presente.
+    Ritorna:
+      - bytes, oppure None se la mappa non è in cache e il download fallisce
+    """
+    url = WMS_BASE + urlencode(wms_params(bbox, width, height))
+    name = _cache_name("wms|" + url, ".png")
+    path = _find_cached(name) if directory is None else None
+    if path is not None:
+        with open(path, "rb") as f:
+            return f.read()
+
+    import requests
+    try:
+        with span("basemap.fetch_wms"):
+            response = requests.get(url, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"⚠️ Mappa WMS non disponibile: {e}")
+        return None
+    if not response.headers.get("Content-Type", "image/png").startswith("image/"):
+        return None
+    _store(name, response.content, directory)
+    return response.content
+
+
+def get_wms_image(bbox, width=512, height=512):
+    """
+    Mappa WMS come array RGB float in [0, 1] (come usato dalla pagina HeatStress).
+    Ritorna:
+      - array (height, width, 3), oppure None se non disponibile
+    """
+    from PIL import Image
+
+    content = fetch_wms_png(bbox, width, height)
+    if content is None:
+        return None
+    image = Image.open(BytesIO(content)).convert("RGB")
+    return np.array(image) / 255.0
+
+
+# === Sfondo contextily (pagina Dashboard) ===
+
+def _provider(source=None):
+    import contextily as ctx
+    return source if source is not None else ctx.providers.OpenStreetMap.Mapnik
+
+
+def fetch_tiles(extent_3857, source=None, zoom="auto", directory=None):
+    """
+    Restituisce il mosaico di tile contextily che copre extent_3857,
+    dalla cache se presente.
+    Parametri:
+      - extent_3857: [xmin, xmax, ymin, ymax] in EPSG:3857
+      - source: provider di contextily (default OpenStreetMap.Mapnik)
+    Ritorna:
+      - (image, extent) come ctx.bounds2img, oppure None se non disponibile
+    """
+    source = _provider(source)
+    xmin, xmax, ymin, ymax = extent_3857
+    key = f"ctx|{source.get('name', source.get('url'))}|{xmin:.3f},{ymin:.3f},{xmax:.3f},{ymax:.3f}|{zoom}"
+    name = _cache_name(key, ".npz")
+    path = _find_cached(name) if directory is None else None
+    if path is not None:
+        with np.load(path) as cached:
+            return cached["image"], tuple(cached["extent"])
+
+    import contextily as ctx
+    import requests
+    try:
+        with span("basemap.fetch_tiles"):
+            image, extent = ctx.bounds2img(xmin, ymin, xmax, ymax, zoom=zoom, source=source, ll=False)
+    except (requests.RequestException, OSError) as e:
+        # Solo errori di rete/HTTP: gli altri (provider o estensione non validi) vengono propagati
+        print(f"⚠️ Tile contextily non disponibili: {e}")
+        return None
+    buffer = BytesIO()
+    np.savez_compressed(buffer, image=image, extent=np.asarray(extent))
+    _store(name, buffer.getvalue(), directory)
+    return image, tuple(extent)
+
+
+def add_basemap(ax, extent_3857, source=None, zoom="auto"):
+    """
+    Disegna lo sfondo sull'asse matplotlib (in EPSG:3857) come
+    ctx.add_basemap, ma leggendo le tile dalla cache.
+    Ritorna:
+      - True se lo sfondo è stato disegnato, False se non disponibile
+    """
+    tiles = fetch_tiles(extent_3857, source, zoom)
+    if tiles is None:
+        return False
+    image, extent = tiles
+    xmin, xmax, ymin, ymax = extent_3857
+    ax.imshow(image, extent=extent, interpolation="bilinear")
+    ax.axis((xmin, xmax, ymin, ymax))
+    return True
+
+
+# === Preparazione offline ===
+
+def prewarm(directory=SHIPPED_DIR):
+    """
+    Scarica e salva in `directory` gli sfondi usati dalle pagine dell'app,
+    così da poterli distribuire insieme all'app (anche senza rete).
+    """
+    import resources
+
+    start = time.time()
+    ok_wms = fetch_wms_png(resources.padded_bbox(resources.TEMP_PATH), directory=directory) is not None
+    ok_tiles = fetch_tiles(resources.web_mercator_extent(resources.TEMP_PATH), directory=directory) is not None
+    print(f"{'✅' if ok_wms else '❌'} Sfondo WMS (HeatStress)")
+    print(f"{'✅' if ok_tiles else '❌'} Tile contextily (Dashboard)")
+    print(f"Sfondi salvati in {directory} in {time.time() - start:.1f} secondi.")
+    return ok_wms and ok_tiles
+
+
+if __name__ == "__main__":
+    prewarm()
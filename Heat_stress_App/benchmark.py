@@ -0,0 +1,513 @@
+"""
+Benchmark delle formule degli indici, della pipeline di estrazione e della
+preparazione dei dati delle pagine (senza Streamlit).
+
+I NetCDF T_2M / TD_2M sintetici (ciclo diurno, gradiente spaziale, buchi
+nella rugiada come nei dati reali) vengono generati una sola volta per
+dimensione in SYNTHETIC_DIR. Ogni caso viene ripetuto più volte e si
+registra il tempo minimo (il meno disturbato dal resto del sistema) e la
+mediana, con il throughput nell'unità del caso (celle/s, timestamp/s, ...).
+
+I risultati possono essere salvati come baseline (JSON in BENCHMARK_DIR) e
+confrontati con una baseline precedente: un caso è una regressione se il suo
+tempo minimo supera quello della baseline di oltre la tolleranza. Le baseline
+hanno senso solo sulla stessa macchina.
+
+Uso:
+    python Heat_stress_App/benchmark.py                           # esegue e stampa
+    python Heat_stress_App/benchmark.py --save baseline           # salva data/benchmarks/baseline.json
+    python Heat_stress_App/benchmark.py --compare baseline        # confronta (exit code 1 se ci sono regressioni)
+    python Heat_stress_App/benchmark.py --sizes small --groups formulas,pipeline --repeat 3
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+
+BENCHMARK_DIR = os.path.join("Heat_stress_App", "data", "benchmarks")
+SYNTHETIC_DIR = os.environ.get("HEATSTRESS_BENCH_DATA", os.path.join(tempfile.gettempdir(), "heatstress_bench"))
+
+# Dimensione -> (timestamp orari, rlat, rlon)
+SIZES = {
+    "small": (24 * 14, 60, 80),
+    "medium": (24 * 61, 150, 200),
+    "large": (24 * 92, 300, 400),
+}
+DEFAULT_SIZES = ("small", "medium")
+DEFAULT_REPEAT = 5
+DEFAULT_TOLERANCE = 0.15  # +15% sul tempo minimo = regressione
+FORMULA_HOURS = 24 * 7  # timestamp usati dai casi sulle formule (un blocco di estrazione)
+
+
+# === Dati sintetici ===
+
+def make_synthetic_netcdf(temp_path, dew_path, n_times, n_rlat, n_rlon, start="2023-06-01", seed=0,
+                          chunk_size=24 * 7):
+    """
+    Scrive una coppia di NetCDF T_2M / TD_2M con la stessa struttura dei dati
+    originali (griglia a polo ruotato, lat/lon 2D, tempo orario), a blocchi
+    di chunk_size timestamp per limitare la memoria.
+    """
+    import netCDF4
+    from pyproj import CRS, Transformer
+
+    pole = {"grid_mapping_name": "rotated_latitude_longitude",
+            "grid_north_pole_latitude": 43.0, "grid_north_pole_longitude": -170.0}
+    rlat = np.linspace(-6.0, 6.0, n_rlat)
+    rlon = np.linspace(-7.0, 7.0, n_rlon)
+    to_geographic = Transformer.from_crs(CRS.from_cf(pole), CRS.from_epsg(4326), always_xy=True)
+    lon, lat = to_geographic.transform(*np.meshgrid(rlon, rlat))
+
+    times = pd.date_range(start, periods=n_times, freq="h")
+    hours = ((times - pd.Timestamp("1970-01-01")) // pd.Timedelta(hours=1)).values
+    rng = np.random.default_rng(seed)
+    # Gradiente nord-sud e "rilievi" fissi, più un ciclo diurno e rumore per timestamp
+    base = (300.0 - 0.8 * (lat - lat.mean()) - 6.0 * np.abs(np.sin(lon / 2.0))).astype(np.float32)
+    diurnal = 7.0 * np.sin(2 * np.pi * (times.hour.values - 9) / 24).astype(np.float32)
+
+    datasets = [netCDF4.Dataset(path, "w", format="NETCDF4") for path in (temp_path, dew_path)]
+    try:
+        variables = []
+        for ds, name in zip(datasets, ("T_2M", "TD_2M")):
+            ds.createDimension("time", n_times)
+            ds.createDimension("rlat", n_rlat)
+            ds.createDimension("rlon", n_rlon)
+            crs = ds.createVariable("crs_rotated_latitude_longitude", "i4")
+            crs.setncatts(pole)
+            var_time = ds.createVariable("time", "i8", ("time",))
+            var_time.setncatts({"units": "hours since 1970-01-01 00:00:00", "calendar": "standard"})
+            var_time[:] = hours
+            for axis_name, values in (("rlat", rlat), ("rlon", rlon)):
+                axis = ds.createVariable(axis_name, "f8", (axis_name,))
+                axis.setncatts({"units": "degrees", "standard_name": f"grid_{axis_name[1:]}itude"})
+                axis[:] = values
+            for coord_name, values in (("lat", lat), ("lon", lon)):
+                coord = ds.createVariable(coord_name, "f8", ("rlat", "rlon"))
+                coord.units = "degrees_north" if coord_name == "lat" else "degrees_east"
+                coord[:] = values
+            var = ds.createVariable(name, "f4", ("time", "rlat", "rlon"), fill_value=np.float32(-9999.0))
+            var.setncatts({"units": "K", "coordinates": "lat lon", "grid_mapping": "crs_rotated_latitude_longitude"})
+            variables.append(var)
+
+        for start_pos in range(0, n_times, chunk_size):
+            stop_pos = min(start_pos + chunk_size, n_times)
+            n = stop_pos - start_pos
+            Ta = base + diurnal[start_pos:stop_pos, None, None] + rng.normal(0, 1.0, (n, n_rlat, n_rlon)).astype(np.float32)
+            Td = Ta - rng.uniform(2.0, 15.0, Ta.shape).astype(np.float32)
+            # Buchi nella rugiada (valori sotto la soglia di fill_dew_point), ~0.05% delle celle
+            gaps = rng.random(Td.shape) < 5e-4
+            Td[gaps] = 200.0
+            variables[0][start_pos:stop_pos] = Ta
+            variables[1][start_pos:stop_pos] = Td
+    finally:
+        for ds in datasets:
+            ds.close()
+
+
+def synthetic_paths(size, seed=0, directory=SYNTHETIC_DIR):
+    """
+    Percorsi (T_2M, TD_2M) dei NetCDF sintetici di una dimensione di SIZES,
+    generati se non ancora presenti.
+    """
+    n_times, n_rlat, n_rlon = SIZES[size]
+    os.makedirs(directory, exist_ok=True)
+    temp_path = os.path.join(directory, f"{size}_{n_times}x{n_rlat}x{n_rlon}_{seed}_T_2M.nc")
+    dew_path = os.path.join(directory, f"{size}_{n_times}x{n_rlat}x{n_rlon}_{seed}_TD_2M.nc")
+    if not (os.path.exists(temp_path) and os.path.exists(dew_path)):
+        start_time = time.time()
+        tmp_paths = [f"{path}.{os.getpid()}.tmp" for path in (temp_path, dew_path)]
+        make_synthetic_netcdf(*tmp_paths, n_times, n_rlat, n_rlon, seed=seed)
+        for tmp_path, path in zip(tmp_paths, (temp_path, dew_path)):
+            os.replace(tmp_path, path)
+        print(f"🧪 Dati sintetici '{size}' generati in {time.time() - start_time:.1f} secondi.")
+    return temp_path, dew_path
+
+
+class BenchmarkData:
+    """
+    Input condivisi dai casi di una dimensione, calcolati al primo utilizzo.
+    """
+
+    def __init__(self, size, work_dir):
+        self.size = size
+        self.work_dir = work_dir
+        self.temp_path, self.dew_path = synthetic_paths(size)
+
+    @cached_property
+    def datasets(self):
+        from extraction import open_datasets
+        return open_datasets(self.temp_path, self.dew_path)
+
+    @cached_property
+    def timestamps(self):
+        return self.datasets[0]["T_2M"].time.values
+
+    @cached_property
+    def chunk(self):
+        """(Ta_k, Td_k) DataArray del primo blocco di FORMULA_HOURS timestamp."""
+        dataset_temp, dataset_dew = self.datasets
+        Ta_k = dataset_temp["T_2M"].isel(time=slice(0, FORMULA_HOURS)).load()
+        Td_k = dataset_dew["TD_2M"].isel(time=slice(0, FORMULA_HOURS)).load()
+        return Ta_k, Td_k
+
+    @cached_property
+    def formula_inputs(self):
+        """Array numpy degli input intermedi delle formule (rugiada già riempita)."""
+        from functions import calculate_relative_humidity, calculate_wbt, fill_dew_point
+
+        Ta_k, Td_k = self.chunk
+        Ta_k = Ta_k.values
+        Td_k = np.asarray(fill_dew_point(Td_k))
+        Ta_c = Ta_k - np.float32(273.15)
+        Td_c = Td_k - np.float32(273.15)
+        RH = calculate_relative_humidity(Ta_c, Td_c)
+        return {"Ta_k": Ta_k, "Td_k": Td_k, "Ta_c": Ta_c, "Td_c": Td_c, "RH": RH,
+                "WBT_c": calculate_wbt(Ta_c, RH)}
+
+    @cached_property
+    def table_csv(self):
+        """Tabella degli indici estratta dai dati sintetici (CSV)."""
+        from extraction import run_extraction
+
+        path = os.path.join(self.work_dir, f"{self.size}_heatstress.csv")
+        run_extraction(self.temp_path, self.dew_path, path, verbose=False)
+        return path
+
+    @cached_property
+    def table_store(self):
+        """La stessa tabella nell'archivio Parquet usato dalle pagine."""
+        from storage import csv_to_store
+
+        root = os.path.join(self.work_dir, f"{self.size}_heatstress_store")
+        csv_to_store(self.table_csv, root)
+        return root
+
+    @cached_property
+    def table(self):
+        from storage import load_table
+        from trends import STAT_LABELS
+
+        return load_table(self.table_store, columns=["Timestamp", "Indice", *STAT_LABELS])
+
+    def close(self):
+        if "datasets" in self.__dict__:
+            for ds in self.datasets:
+                ds.close()
+
+
+# === Casi ===
+# Ogni caso riceve i BenchmarkData e restituisce (funzione da cronometrare, elementi elaborati, unità)
+
+def _formula_case(name):
+    def case(data):
+        import functions
+
+        inputs = data.formula_inputs
+        n_cells = inputs["Ta_k"].size
+        calls = {
+            "humidex": lambda: functions.calculate_humidex(inputs["Ta_k"], inputs["Td_k"]),
+            "relative_humidity": lambda: functions.calculate_relative_humidity(inputs["Ta_c"], inputs["Td_c"]),
+            "heat_index": lambda: functions.calculate_heat_index(inputs["Ta_c"], inputs["RH"]),
+            "wbt": lambda: functions.calculate_wbt(inputs["Ta_c"], inputs["RH"]),
+            "wbgt": lambda: functions.calculate_wbgt(inputs["Ta_c"], inputs["WBT_c"]),
+            "lethal_heat_stress_index": lambda: functions.calculate_lethal_heat_stress_index(inputs["WBT_c"],
+                                                                                             inputs["RH"]),
+            "utci": lambda: functions.calculate_utci(inputs["Ta_c"], inputs["RH"]),
+        }
+        return calls[name], n_cells, "celle/s"
+    return case
+
+
+def _case_compute_all_indices(data):
+    from functions import allocate_index_buffers, compute_all_indices
+
+    inputs = data.formula_inputs
+    out = allocate_index_buffers(inputs["Ta_k"].shape)
+    return lambda: compute_all_indices(inputs["Ta_k"], inputs["Td_k"], out=out), inputs["Ta_k"].size, "celle/s"
+
+
+def _case_fill_dew_point(data):
+    from functions import fill_dew_point
+
+    _, Td_k = data.chunk
+    return lambda: fill_dew_point(Td_k), Td_k.size, "celle/s"
+
+
+def _case_spatial_stats(data):
+    from functions import spatial_stats
+
+    grids = data.formula_inputs["Ta_c"]
+    return lambda: spatial_stats(grids), len(grids), "griglie/s"
+
+
+def _case_process_chunk(data):
+    from extraction import process_chunk
+    from functions import allocate_index_buffers
+
+    Ta_k, Td_k = data.chunk
+    times = Ta_k.time.values
+    out = allocate_index_buffers(Ta_k.shape)
+    return lambda: process_chunk(Ta_k, Td_k, times, out=out), len(times), "timestamp/s"
+
+
+def _case_extraction(data):
+    from extraction import run_extraction
+
+    output_path = os.path.join(data.work_dir, f"{data.size}_extraction.csv")
+    run = lambda: run_extraction(data.temp_path, data.dew_path, output_path, verbose=False)
+    return run, len(data.timestamps), "timestamp/s"
+
+
+def _case_dashboard_timestamp(data):
+    """Calcolo di tutti gli indici di un timestamp e rendering delle mappe (load_timestamp_data)."""
+    from animation import ANIMATION_CMAPS
+    from functions import compute_all_indices, fill_dew_point
+    from rendering import encode_png, output_shape, render_map_rgb
+
+    dataset_temp, dataset_dew = data.datasets
+    timestamp = data.timestamps[len(data.timestamps) // 2]
+    extent = (1.0e6, 2.0e6, 4.0e6, 5.5e6)
+    base = np.full(output_shape(extent) + (3,), 255, dtype=np.uint8)
+
+    def run():
+        temperature = dataset_temp["T_2M"].sel(time=timestamp)
+        values = compute_all_indices(temperature, fill_dew_point(dataset_dew["TD_2M"].sel(time=timestamp)))
+        values["Temperature"] = temperature.values - 273.15
+        for title, cmap in ANIMATION_CMAPS.items():
+            grid = values[title]
+            rgb = render_map_rgb(grid, cmap, extent, float(np.nanmin(grid)), float(np.nanmax(grid)),
+                                 base=base, width=base.shape[1])
+            encode_png(rgb)
+    return run, 1, "timestamp/s"
+
+
+def _case_heatstress_surface(data):
+    """Superficie 3D di un timestamp della pagina principale (load_surface)."""
+    from lod import prepare_surface
+
+    dataset_temp = data.datasets[0]
+    lon = dataset_temp["lon"].values
+    lat = dataset_temp["lat"].values
+    timestamp = data.timestamps[len(data.timestamps) // 2]
+
+    def run():
+        temp_c = dataset_temp["T_2M"].sel(time=timestamp).values - 273.15
+        return prepare_surface(temp_c, lon, lat, z_exaggeration=0.02)
+    return run, 1, "timestamp/s"
+
+
+def _case_trend_load_table(data):
+    from storage import load_table
+    from trends import STAT_LABELS
+
+    root = data.table_store
+    return lambda: load_table(root, columns=["Timestamp", "Indice", *STAT_LABELS]), len(data.table), "righe/s"
+
+
+def _case_trend_aggregates(data):
+    from trends import TrendAggregates
+
+    df = data.table
+    return lambda: TrendAggregates(df), len(df), "righe/s"
+
+
+def _case_trend_exceedances(data):
+    from constants import soglie
+    from trends import TrendAggregates
+
+    aggregates = TrendAggregates(data.table)
+    pairs = [(index, stat) for index in aggregates.indices if index in soglie for stat in aggregates.stat_columns]
+
+    def run():
+        for index, stat in pairs:
+            aggregates.annual_exceedances(index, stat, soglie[index])
+    return run, len(pairs), "serie/s"
+
+
+def _case_danger_days(data):
+    from events import detect_danger_days, heatwave_events
+
+    df = data.table
+    return lambda: heatwave_events(detect_danger_days(df)), len(df), "righe/s"
+
+
+CASES = {
+    "formulas": {name: _formula_case(name) for name in (
+        "humidex", "relative_humidity", "heat_index", "wbt", "wbgt", "lethal_heat_stress_index", "utci")},
+    "pipeline": {
+        "fill_dew_point": _case_fill_dew_point,
+        "compute_all_indices": _case_compute_all_indices,
+        "spatial_stats": _case_spatial_stats,
+        "process_chunk": _case_process_chunk,
+        "extraction": _case_extraction,
+    },
+    "pages": {
+        "dashboard_timestamp": _case_dashboard_timestamp,
+        "heatstress_surface": _case_heatstress_surface,
+        "trend_load_table": _case_trend_load_table,
+        "trend_aggregates": _case_trend_aggregates,
+        "trend_exceedances": _case_trend_exceedances,
+        "danger_days": _case_danger_days,
+    },
+}
+
+
+# === Esecuzione ===
+
+def measure(func, repeat=DEFAULT_REPEAT, warmup=1):
+    """Tempi (secondi) di repeat esecuzioni di func, dopo warmup esecuzioni di riscaldamento."""
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, groups=None, repeat=DEFAULT_REPEAT, verbose=True):
+    """
+    Esegue i casi dei gruppi richiesti (default: tutti) per ogni dimensione.
+    Ritorna:
+      - dizionario {"dimensione/gruppo/caso": {min_s, median_s, items, unit, throughput}}
+    """
+    groups = list(CASES) if groups is None else list(groups)
+    unknown = [group for group in groups if group not in CASES]
+    if unknown:
+        raise ValueError(f"Gruppi sconosciuti: {unknown} (disponibili: {', '.join(CASES)})")
+
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="heatstress_bench_")
+    try:
+        for size in sizes:
+            data = BenchmarkData(size, work_dir)
+            try:
+                for group in groups:
+                    for name, case in CASES[group].items():
+                        func, items, unit = case(data)
+                        timings = measure(func, repeat)
+                        key = f"{size}/{group}/{name}"
+                        results[key] = {
+                            "min_s": min(timings),
+                            "median_s": statistics.median(timings),
+                            "items": items,
+                            "unit": unit,
+                            "throughput": items / min(timings),
+                        }
+                        if verbose:
+                            print(f"  {key:<45} {min(timings) * 1000:10.2f} ms  "
+                                  f"{results[key]['throughput']:14,.0f} {unit}")
+            finally:
+                data.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def environment():
+    """Descrizione della macchina e delle librerie, salvata con la baseline."""
+    import xarray as xr
+
+    return {
+        "date": pd.Timestamp.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "xarray": xr.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def baseline_path(name, directory=BENCHMARK_DIR):
+    return name if name.endswith(".json") else os.path.join(directory, f"{name}.json")
+
+
+def save_baseline(results, name, directory=BENCHMARK_DIR):
+    """Salva i risultati come baseline JSON; ritorna il percorso del file."""
+    path = baseline_path(name, directory)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=2, ensure_ascii=False)
+    return path
+
+
+def load_baseline(name, directory=BENCHMARK_DIR):
+    with open(baseline_path(name, directory)) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Confronta i tempi minimi con quelli della baseline.
+    Ritorna:
+      - DataFrame con una riga per caso: tempi, rapporto nuovo/baseline ed esito
+        ("regressione", "miglioramento", "invariato", "nuovo")
+    """
+    base_results = baseline.get("results", baseline)
+    rows = []
+    for key, result in results.items():
+        base = base_results.get(key)
+        if base is None:
+            rows.append({"caso": key, "baseline_ms": np.nan, "nuovo_ms": result["min_s"] * 1000,
+                         "rapporto": np.nan, "esito": "nuovo"})
+            continue
+        ratio = result["min_s"] / base["min_s"]
+        if ratio > 1 + tolerance:
+            outcome = "regressione"
+        elif ratio < 1 / (1 + tolerance):
+            outcome = "miglioramento"
+        else:
+            outcome = "invariato"
+        rows.append({"caso": key, "baseline_ms": base["min_s"] * 1000, "nuovo_ms": result["min_s"] * 1000,
+                     "rapporto": ratio, "esito": outcome})
+    return pd.DataFrame(rows, columns=["caso", "baseline_ms", "nuovo_ms", "rapporto", "esito"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark degli indici di heat stress e delle pagine dell'app")
+    parser.add_argument("--sizes", default=",".join(DEFAULT_SIZES),
+                        help=f"dimensioni separate da virgole ({', '.join(SIZES)})")
+    parser.add_argument("--groups", default=",".join(CASES),
+                        help=f"gruppi di casi separati da virgole ({', '.join(CASES)})")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="ripetizioni per caso")
+    parser.add_argument("--save", metavar="NOME", help="salva i risultati come baseline")
+    parser.add_argument("--compare", metavar="NOME", help="confronta con una baseline salvata")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="rallentamento relativo tollerato prima di segnalare una regressione")
+    args = parser.parse_args(argv)
+
+    sizes = [size for size in args.sizes.split(",") if size]
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        parser.error(f"dimensioni sconosciute: {unknown}")
+
+    results = run_benchmarks(sizes, [group for group in args.groups.split(",") if group], args.repeat)
+    if args.save:
+        print(f"💾 Baseline salvata: {save_baseline(results, args.save)}")
+    if args.compare:
+        table = compare(results, load_baseline(args.compare), args.tolerance)
+        with pd.option_context("display.max_rows", None, "display.width", 120):
+            print(table.to_string(index=False, float_format=lambda v: f"{v:.2f}"))
+        n_regressions = int((table["esito"] == "regressione").sum())
+        if n_regressions:
+            print(f"❌ {n_regressions} regressioni oltre il {args.tolerance:.0%}")
+            return 1
+        print("✅ Nessuna regressione")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
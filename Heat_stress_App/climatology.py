@@ -0,0 +1,367 @@
+"""
+Climatologia per cella dei percentili giornalieri degli indici di heat stress.
+
+Per ogni cella della griglia, variabile e giorno dell'anno viene calcolato un
+percentile climatologico (es. il 90°) dei massimi giornalieri del periodo di
+riferimento (es. 1981-2010), usando una finestra mobile di `window` giorni
+centrata sul giorno. Il risultato è una tabella di lookup (366, variabili,
+rlat, rlon) che permette alla Dashboard di mostrare le anomalie locali
+rispetto al clima della cella, invece delle sole soglie assolute.
+
+Il calcolo avviene in due passaggi, entrambi a memoria limitata e
+parallelizzabili su più processi:
+  1. build_daily_maxima: i NetCDF orari vengono letti a blocchi di giorni, gli
+     indici calcolati con compute_all_indices e ridotti al massimo giornaliero,
+     salvato su disco in daily_max.npy (anni, 366, variabili, rlat, rlon).
+     Uno shard per anno. Il file resta su disco e viene riutilizzato per
+     calcolare altri percentili o finestre senza rileggere i NetCDF.
+  2. build_climatology: daily_max.npy viene letto in memory-map per blocchi
+     di celle (dimensionati su max_memory_mb) e per ogni giorno dell'anno si
+     calcola il percentile dei campioni della finestra (tutti gli anni).
+
+Il calendario è quello di un anno bisestile (366 giorni): negli anni non
+bisestili il 29 febbraio resta NaN e viene ignorato.
+
+Struttura della cartella:
+  - daily_max.npy, daily_meta.json: massimi giornalieri (passaggio 1)
+  - climatology.npy: array (366, variabili, rlat, rlon) float32
+  - meta.json: variabili, percentile, finestra, periodo e forma (scritto per
+    ultimo, la sua presenza indica che la climatologia è completa)
+"""
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cube import CUBE_VARIABLES
+from functions import INDEX_NAMES, allocate_index_buffers, compute_all_indices, fill_dew_point, spatial_stats
+
+
+CLIMATOLOGY_VARIABLES = CUBE_VARIABLES
+DAYS_IN_YEAR = 366
+BASE_PERIOD = (1981, 2010)
+DEFAULT_PERCENTILE = 90
+DEFAULT_WINDOW = 15  # giorni, centrati sul giorno dell'anno
+DEFAULT_MAX_MEMORY_MB = 512
+
+DAILY_FILE = "daily_max.npy"
+DAILY_META_FILE = "daily_meta.json"
+CLIMATOLOGY_FILE = "climatology.npy"
+META_FILE = "meta.json"
+
+
+def calendar_day(timestamps):
+    """
+    Giorno dell'anno nel calendario bisestile (0 = 1 gennaio, 59 = 29 febbraio,
+    365 = 31 dicembre), uguale per tutti gli anni.
+    """
+    timestamps = pd.DatetimeIndex(timestamps)
+    leap_offset = (~timestamps.is_leap_year & (timestamps.month > 2)).astype(int)
+    return np.asarray(timestamps.dayofyear - 1 + leap_offset)
+
+
+def _select_period(timestamps, base_period):
+    """Posizioni dei timestamp nel periodo di riferimento e anni coperti."""
+    timestamps = pd.DatetimeIndex(timestamps)
+    if base_period is None:
+        first, last = timestamps.year.min(), timestamps.year.max()
+    else:
+        first, last = base_period
+    positions = np.flatnonzero((timestamps.year >= first) & (timestamps.year <= last))
+    if len(positions) == 0:
+        raise ValueError(f"Nessun timestamp nel periodo di riferimento {first}-{last}")
+    return positions, list(range(first, last + 1))
+
+
+def _day_chunks(positions, timestamps, days_per_chunk):
+    """
+    Suddivide le posizioni (ordinate) in blocchi di giorni interi.
+    Ritorna:
+      - lista di array di posizioni, uno per blocco
+    """
+    days = pd.DatetimeIndex(timestamps[positions]).normalize()
+    bounds = np.flatnonzero(days[1:] != days[:-1]) + 1
+    day_starts = np.concatenate([[0], bounds])
+    chunk_starts = day_starts[::days_per_chunk]
+    chunk_stops = np.append(chunk_starts[1:], len(positions))
+    return [positions[a:b] for a, b in zip(chunk_starts, chunk_stops)]
+
+
+def _daily_max_year(temp_path, dew_path, root, year_position, positions, days_per_chunk):
+    """
+    Lavoro di un singolo worker: massimi giornalieri di un anno, scritti
+    direttamente in daily_max.npy (ogni worker scrive un anno diverso).
+    """
+    # Import locale: come in cube.py
+    from extraction import open_datasets
+
+    start_time = time.time()
+    daily = np.load(os.path.join(root, DAILY_FILE), mmap_mode="r+")
+
+    dataset_temp, dataset_dew = open_datasets(temp_path, dew_path)
+    try:
+        timestamps = dataset_temp['T_2M'].time.values
+        out = None
+        for chunk in _day_chunks(positions, timestamps, days_per_chunk):
+            chunk_times = timestamps[chunk]
+            Ta_k = dataset_temp['T_2M'].isel(time=chunk).transpose('time', 'rlat', 'rlon').load()
+            Td_k = dataset_dew['TD_2M'].sel(time=chunk_times).transpose('time', 'rlat', 'rlon').load()
+            if out is None or out["UTCI"].shape != Ta_k.shape:
+                out = allocate_index_buffers(Ta_k.shape)
+            compute_all_indices(Ta_k, fill_dew_point(Td_k), out=out)
+
+            # Inizio di ciascun giorno nel blocco (i timestamp sono ordinati)
+            days = pd.DatetimeIndex(chunk_times).normalize()
+            starts = np.concatenate([[0], np.flatnonzero(days[1:] != days[:-1]) + 1])
+            doy = calendar_day(days[starts])
+
+            hourly = [Ta_k.values.astype(np.float32) - np.float32(273.15)] + [out[name] for name in INDEX_NAMES]
+            for v, values in enumerate(hourly):
+                # fmax ignora i NaN (NaN solo se il giorno è tutto NaN)
+                daily[year_position, doy, v] = np.fmax.reduceat(values, starts, axis=0)
+        daily.flush()
+    finally:
+        dataset_temp.close()
+        dataset_dew.close()
+    return year_position, time.time() - start_time
+
+
+def build_daily_maxima(temp_path, dew_path, root, base_period=BASE_PERIOD, days_per_chunk=7,
+                       n_workers=1, verbose=True):
+    """
+    Passaggio 1: massimi giornalieri di temperatura (°C) e indici per ogni
+    cella, salvati in root/daily_max.npy (anni, 366, variabili, rlat, rlon).
+    Parametri:
+      - temp_path: NetCDF con T_2M
+      - dew_path: NetCDF con TD_2M
+      - root: cartella di output
+      - base_period: (primo anno, ultimo anno) inclusi; None = tutti gli anni
+      - days_per_chunk: giorni letti dai NetCDF per blocco (memoria limitata)
+      - n_workers: numero di processi (uno shard per anno; None = tutti i core)
+    Ritorna:
+      - lista degli anni
+    """
+    import xarray as xr
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    with xr.open_dataset(temp_path) as dataset_temp:
+        timestamps = dataset_temp['T_2M'].time.values
+        n_rlat = dataset_temp.sizes['rlat']
+        n_rlon = dataset_temp.sizes['rlon']
+    positions, years = _select_period(timestamps, base_period)
+    position_years = pd.DatetimeIndex(timestamps[positions]).year.values
+
+    os.makedirs(root, exist_ok=True)
+    meta_path = os.path.join(root, DAILY_META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    shape = (len(years), DAYS_IN_YEAR, len(CLIMATOLOGY_VARIABLES), n_rlat, n_rlon)
+    daily = np.lib.format.open_memmap(os.path.join(root, DAILY_FILE), mode="w+", dtype=np.float32, shape=shape)
+    # Gli anni senza dati restano NaN
+    for year_position in range(len(years)):
+        daily[year_position] = np.nan
+    daily.flush()
+    del daily
+
+    shards = [(years.index(year), positions[position_years == year]) for year in np.unique(position_years)]
+    args = [(temp_path, dew_path, root, year_position, shard, days_per_chunk) for year_position, shard in shards]
+    if n_workers == 1:
+        results = (_daily_max_year(*a) for a in args)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        results = (future.result() for future in [executor.submit(_daily_max_year, *a) for a in args])
+    try:
+        for year_position, elapsed in results:
+            if verbose:
+                print(f"  Massimi giornalieri {years[year_position]} completati in {elapsed:.1f} secondi.")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    with open(meta_path, "w") as f:
+        json.dump({"variables": list(CLIMATOLOGY_VARIABLES), "years": years, "shape": list(shape)}, f)
+    return years
+
+
+def window_offsets(window=DEFAULT_WINDOW):
+    """Scostamenti in giorni della finestra centrata (es. 15 -> -7..+7)."""
+    if window < 1 or window % 2 == 0:
+        raise ValueError(f"window deve essere un intero dispari positivo, non {window!r}")
+    half = window // 2
+    return np.arange(-half, half + 1)
+
+
+def window_percentile(daily, percentile=DEFAULT_PERCENTILE, window=DEFAULT_WINDOW):
+    """
+    Percentile climatologico con finestra mobile per un blocco di celle.
+    La finestra attraversa i confini dell'anno (il 1° gennaio usa anche
+    la fine di dicembre dell'anno precedente), escluso il bordo del periodo.
+    Parametri:
+      - daily: array (anni, 366, celle) di massimi giornalieri
+      - percentile: percentile da calcolare (0-100)
+      - window: ampiezza della finestra in giorni (dispari)
+    Ritorna:
+      - array (366, celle) float32, equivalente a np.nanpercentile sui campioni
+    """
+    n_years, n_days, n_cells = daily.shape
+    series = daily.reshape(n_years * n_days, n_cells)
+    offsets = window_offsets(window)
+    year_starts = np.arange(n_years)[:, None] * n_days
+    stats = {"p": percentile}
+
+    result = np.empty((n_days, n_cells), dtype=np.float32)
+    for doy in range(n_days):
+        idx = (year_starts + doy + offsets[None, :]).ravel()
+        idx = idx[(idx >= 0) & (idx < len(series))]
+        # spatial_stats calcola una statistica per riga: righe = celle
+        result[doy] = spatial_stats(series[idx].T, stats)["p"]
+    return result
+
+
+def _cell_tiles(n_cells, n_years, window, max_memory_mb):
+    """Blocchi di celle tali che dati e campioni della finestra stiano in max_memory_mb."""
+    bytes_per_cell = 4 * n_years * (DAYS_IN_YEAR + 3 * window)
+    tile = max(1, int(max_memory_mb * 1024 * 1024 // bytes_per_cell))
+    return [slice(start, min(start + tile, n_cells)) for start in range(0, n_cells, tile)]
+
+
+def _percentile_tile(root, tile, percentile, window):
+    """
+    Lavoro di un singolo worker: percentili di un blocco di celle per tutte
+    le variabili, scritti direttamente in climatology.npy.
+    """
+    start_time = time.time()
+    daily = np.load(os.path.join(root, DAILY_FILE), mmap_mode="r")
+    clim = np.load(os.path.join(root, CLIMATOLOGY_FILE), mmap_mode="r+")
+    n_years, n_days, n_vars = daily.shape[:3]
+    daily = daily.reshape(n_years, n_days, n_vars, -1)
+    clim = clim.reshape(n_days, n_vars, -1)
+    for v in range(n_vars):
+        clim[:, v, tile] = window_percentile(np.asarray(daily[:, :, v, tile]), percentile, window)
+    clim.flush()
+    return tile, time.time() - start_time
+
+
+def build_climatology(temp_path, dew_path, root, base_period=BASE_PERIOD, percentile=DEFAULT_PERCENTILE,
+                      window=DEFAULT_WINDOW, n_workers=1, max_memory_mb=DEFAULT_MAX_MEMORY_MB,
+                      reuse_daily=True, verbose=True):
+    """
+    Calcola la climatologia dei percentili per cella e giorno dell'anno.
+    Parametri:
+      - temp_path: NetCDF con T_2M
+      - dew_path: NetCDF con TD_2M
+      - root: cartella di output
+      - base_period: (primo anno, ultimo anno) inclusi; None = tutti gli anni
+      - percentile: percentile dei massimi giornalieri (es. 90)
+      - window: ampiezza della finestra mobile in giorni (dispari)
+      - n_workers: numero di processi (1 = sequenziale, None = tutti i core)
+      - max_memory_mb: memoria indicativa per worker nel passaggio 2
+      - reuse_daily: riutilizza daily_max.npy se già calcolato sullo stesso periodo
+    Ritorna:
+      - Climatology aperta sulla tabella appena creata
+    """
+    start_time = time.time()
+    window_offsets(window)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    daily_meta = os.path.join(root, DAILY_META_FILE)
+    years = None
+    if reuse_daily and os.path.exists(daily_meta):
+        with open(daily_meta) as f:
+            meta = json.load(f)
+        if base_period is None or (meta["years"][0], meta["years"][-1]) == tuple(base_period):
+            years = meta["years"]
+            if verbose:
+                print(f"♻️ Massimi giornalieri {years[0]}-{years[-1]} già presenti, riutilizzati.")
+    if years is None:
+        years = build_daily_maxima(temp_path, dew_path, root, base_period, n_workers=n_workers, verbose=verbose)
+
+    meta_path = os.path.join(root, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    daily = np.load(os.path.join(root, DAILY_FILE), mmap_mode="r")
+    n_years, n_days, n_vars, n_rlat, n_rlon = daily.shape
+    del daily
+    shape = (n_days, n_vars, n_rlat, n_rlon)
+    clim = np.lib.format.open_memmap(os.path.join(root, CLIMATOLOGY_FILE), mode="w+", dtype=np.float32, shape=shape)
+    del clim
+
+    tiles = _cell_tiles(n_rlat * n_rlon, n_years, window, max_memory_mb)
+    if n_workers == 1:
+        results = (_percentile_tile(root, tile, percentile, window) for tile in tiles)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        results = (future.result() for future in
+                   [executor.submit(_percentile_tile, root, tile, percentile, window) for tile in tiles])
+    try:
+        for tile, elapsed in results:
+            if verbose:
+                print(f"  Celle {tile.start}-{tile.stop} di {n_rlat * n_rlon} completate in {elapsed:.1f} secondi.")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    meta = {
+        "variables": list(CLIMATOLOGY_VARIABLES),
+        "percentile": percentile,
+        "window": window,
+        "base_period": [years[0], years[-1]],
+        "shape": list(shape),
+    }
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+    if verbose:
+        print(f"✅ Climatologia del {percentile}° percentile ({years[0]}-{years[-1]}, finestra di {window} giorni) "
+              f"creata in {root} in {time.time() - start_time:.1f} secondi.")
+    return Climatology(root)
+
+
+def climatology_exists(root):
+    """True se la cartella contiene una climatologia completa."""
+    return os.path.exists(os.path.join(root, META_FILE)) and os.path.exists(os.path.join(root, CLIMATOLOGY_FILE))
+
+
+class Climatology:
+    """
+    Lettore della climatologia dei percentili con accesso in memory-map.
+    """
+
+    def __init__(self, root):
+        if not climatology_exists(root):
+            raise FileNotFoundError(f"❌ Climatologia non trovata o incompleta: {root}")
+        with open(os.path.join(root, META_FILE)) as f:
+            meta = json.load(f)
+        self.root = root
+        self.variables = tuple(meta["variables"])
+        self.percentile = meta["percentile"]
+        self.window = meta["window"]
+        self.base_period = tuple(meta["base_period"])
+        self.data = np.load(os.path.join(root, CLIMATOLOGY_FILE), mmap_mode="r")
+        if list(self.data.shape) != meta["shape"]:
+            raise ValueError(f"Forma della climatologia {self.data.shape} diversa da meta.json {meta['shape']}")
+
+    def get(self, timestamp, variables=None):
+        """
+        Percentili climatologici (rlat, rlon) del giorno dell'anno del
+        timestamp, come viste in sola lettura sul file.
+        Ritorna:
+          - dizionario {variabile: array 2D float32}
+        """
+        block = self.data[int(calendar_day([timestamp])[0])]
+        names = self.variables if variables is None else variables
+        return {name: block[self.variables.index(name)] for name in names}
+
+    def anomaly(self, timestamp, variable, values):
+        """
+        Differenza tra i valori (rlat, rlon) e il percentile climatologico
+        della cella: > 0 dove il valore supera il clima locale.
+        """
+        return np.asarray(values, dtype=np.float32) - self.get(timestamp, [variable])[variable]
@@ -0,0 +1,29 @@
+"""
+Costanti condivise della tabella degli indici di heat stress.
+
+Modulo senza dipendenze: extraction.py, storage.py, events.py e rollup.py
+usano le stesse soglie e colonne senza importare la pipeline di estrazione
+(xarray, functions, instrumentation).
+"""
+
+# ------------------ CONFIGURAZIONE ------------------
+soglie = {
+    "Heat Index": 40.6,
+    "Humidex": 45,
+    "Lethal Heat Stress Index": 27,
+    "UTCI": 46,
+    "WBGT": 30,
+    "Relative Humidity": 80
+}
+
+# Indici riportati nella tabella di output (stesso ordine del notebook)
+OUTPUT_INDICES = list(soglie.keys())
+
+# Statistica -> (colonna valore, colonna confronto con soglia)
+STAT_COLUMNS = {
+    "mean": ("Media (°C)", "Media > Soglia"),
+    "median": ("Mediana (°C)", "Mediana > Soglia"),
+    "p95": ("95° Perc. (°C)", "95° Perc. > Soglia"),
+    "p99": ("99° Perc. (°C)", "99° Perc. > Soglia"),
+    "max": ("Massimo (°C)", "Massimo > Soglia"),
+}
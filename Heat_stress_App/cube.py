@@ -0,0 +1,162 @@
+"""
+Cubo precalcolato degli indici di heat stress su disco.
+
+Lo stadio offline (build_cube) calcola una volta per tutte la temperatura e
+tutti gli indici di compute_all_indices e li salva in un unico array float32
+di forma (time, variabili, rlat, rlon): ogni timestamp è un blocco contiguo
+su disco. Il lettore (IndexCube) apre l'array in memory-map, per cui leggere
+un timestamp è un semplice slice senza copie né ricalcoli.
+
+Struttura della cartella:
+  - cube.npy: array (time, variabili, rlat, rlon) float32, oppure int16
+    quantizzato con packed=True (metà dello spazio, vedi encoding.py)
+  - meta.json: timestamp, nomi delle variabili, forma ed eventuale codifica
+    (scritto per ultimo, la sua presenza indica che il cubo è completo)
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from functions import INDEX_NAMES, allocate_index_buffers, compute_all_indices, fill_dew_point
+
+
+CUBE_VARIABLES = ("Temperature",) + INDEX_NAMES
+CUBE_FILE = "cube.npy"
+META_FILE = "meta.json"
+
+
+def build_cube(temp_path, dew_path, root, chunk_size=24 * 7, packed=False, verbose=True):
+    """
+    Materializza temperatura (°C) e indici per tutti i timestamp dei NetCDF.
+    Parametri:
+      - temp_path: NetCDF con T_2M
+      - dew_path: NetCDF con TD_2M
+      - root: cartella di output del cubo
+      - chunk_size: numero di ore elaborate per blocco
+      - packed: salva i valori come int16 quantizzati (encoding.CUBE_PACKING)
+    Ritorna:
+      - IndexCube aperto sul cubo appena creato
+    """
+    # Import locale: la Dashboard usa solo il lettore
+    from encoding import CUBE_PACKING, cube_encoding, pack
+    from extraction import iter_time_chunks, open_datasets
+
+    dataset_temp, dataset_dew = open_datasets(temp_path, dew_path)
+    try:
+        timestamps = dataset_temp['T_2M'].time.values
+        n_rlat = dataset_temp.sizes['rlat']
+        n_rlon = dataset_temp.sizes['rlon']
+        shape = (len(timestamps), len(CUBE_VARIABLES), n_rlat, n_rlon)
+
+        os.makedirs(root, exist_ok=True)
+        meta_path = os.path.join(root, META_FILE)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        cube = np.lib.format.open_memmap(os.path.join(root, CUBE_FILE), mode="w+",
+                                         dtype=np.int16 if packed else np.float32, shape=shape)
+        # Scrittura di una variabile del blocco, quantizzata se richiesto
+        store = (lambda target, values: pack(values, *CUBE_PACKING, out=target)) if packed else np.copyto
+
+        out = None
+        for chunk in iter_time_chunks(len(timestamps), chunk_size):
+            Ta_k = dataset_temp['T_2M'].isel(time=chunk).transpose('time', 'rlat', 'rlon').load()
+            Td_k = dataset_dew['TD_2M'].sel(time=timestamps[chunk]).transpose('time', 'rlat', 'rlon').load()
+            if out is None or out["UTCI"].shape != Ta_k.shape:
+                out = allocate_index_buffers(Ta_k.shape)
+            compute_all_indices(Ta_k, fill_dew_point(Td_k), out=out)
+
+            store(cube[chunk, 0], Ta_k.values - 273.15)
+            for i, name in enumerate(INDEX_NAMES, start=1):
+                store(cube[chunk, i], out[name])
+            if verbose:
+                print(f"  Cubo: {chunk.stop}/{len(timestamps)} timestamp scritti.")
+
+        cube.flush()
+        del cube
+    finally:
+        dataset_temp.close()
+        dataset_dew.close()
+
+    meta = {
+        "variables": list(CUBE_VARIABLES),
+        "shape": list(shape),
+        "timestamps": [str(t) for t in np.datetime_as_string(timestamps, unit="s")],
+    }
+    if packed:
+        meta["encoding"] = cube_encoding(CUBE_PACKING)
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+    if verbose:
+        print(f"✅ Cubo degli indici creato in: {root}")
+    return IndexCube(root)
+
+
+def cube_exists(root):
+    """True se la cartella contiene un cubo completo."""
+    return os.path.exists(os.path.join(root, META_FILE)) and os.path.exists(os.path.join(root, CUBE_FILE))
+
+
+class IndexCube:
+    """
+    Lettore del cubo degli indici con accesso casuale in memory-map.
+    Un cubo float32 viene letto senza copie; un cubo int16 viene decodificato
+    in float32 (NaN per i valori mancanti) al momento della lettura.
+    """
+
+    def __init__(self, root):
+        if not cube_exists(root):
+            raise FileNotFoundError(f"❌ Cubo degli indici non trovato o incompleto: {root}")
+        with open(os.path.join(root, META_FILE)) as f:
+            meta = json.load(f)
+        self.root = root
+        self.variables = tuple(meta["variables"])
+        self.timestamps = pd.DatetimeIndex(pd.to_datetime(meta["timestamps"]))
+        self.data = np.load(os.path.join(root, CUBE_FILE), mmap_mode="r")
+        if list(self.data.shape) != meta["shape"]:
+            raise ValueError(f"Forma del cubo {self.data.shape} diversa da meta.json {meta['shape']}")
+        self.packing = meta.get("encoding")
+        self._positions = pd.Series(np.arange(len(self.timestamps)), index=self.timestamps)
+
+    def __contains__(self, timestamp):
+        return pd.Timestamp(timestamp) in self._positions.index
+
+    def position(self, timestamp):
+        """Posizione del timestamp lungo l'asse time (KeyError se assente)."""
+        return int(self._positions[pd.Timestamp(timestamp)])
+
+    def _decode(self, values):
+        """Valori float32 del cubo: vista sul file, oppure decodifica degli int16."""
+        if self.packing is None:
+            return values
+        from encoding import unpack
+
+        return unpack(values, self.packing["scale_factor"], self.packing["add_offset"],
+                      self.packing["fill_value"])
+
+    def get(self, timestamp, variables=None):
+        """
+        Restituisce le griglie (rlat, rlon) di un timestamp: viste in sola
+        lettura sul file (nessuna copia) per un cubo float32, nuovi array per
+        un cubo int16.
+        Parametri:
+          - timestamp: istante richiesto
+          - variables: nomi delle variabili (default: tutte)
+        Ritorna:
+          - dizionario {variabile: array 2D float32}
+        """
+        block = self.data[self.position(timestamp)]
+        names = self.variables if variables is None else variables
+        return {name: self._decode(block[self.variables.index(name)]) for name in names}
+
+    def read(self, positions, variable=None):
+        """
+        Griglie di una variabile (o di tutte) per più posizioni lungo l'asse time.
+        Ritorna:
+          - array (len(positions), rlat, rlon) float32, oppure
+            (len(positions), variabili, rlat, rlon) con variable=None (copia in memoria)
+        """
+        values = self.data[positions] if variable is None else self.data[positions, self.variables.index(variable)]
+        return np.array(values) if self.packing is None else self._decode(values)
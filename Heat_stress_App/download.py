@@ -0,0 +1,455 @@
+"""
+Download a blocchi (anno, mese) dei dati ERA5 downscaled sull'Italia.
+
+Sostituisce la singola richiesta del notebook 00 (20 anni × 12 mesi in un
+unico NetCDF per variabile, da ripetere da capo in caso di errore):
+  - la richiesta viene suddivisa in un blocco per (variabile, anno, mese)
+  - i blocchi vengono scaricati in parallelo da un pool limitato di thread,
+    ognuno su un file .part che viene verificato (variabile presente,
+    timestamp attesi) e solo allora rinominato nel file definitivo
+  - rilanciando il download i blocchi già completi vengono saltati; in caso
+    di errore un blocco viene ritentato, riprendendo il file .part se il
+    client lo supporta (HTTPClient con richieste Range)
+  - merge_chunks concatena i blocchi di una variabile in un unico NetCDF
+    compresso e a chunk (un timestamp per chunk), un blocco mensile alla
+    volta, pronto per extraction.py; da riga di comando il campo viene
+    salvato come int16 quantizzato (vedi encoding.py)
+
+Il client è qualunque oggetto con il metodo retrieve(dataset, product,
+request, target) di ddsapi.Client. Per le prove senza rete, serve_synthetic
+avvia un server HTTP locale che genera blocchi NetCDF sintetici e
+HTTPClient vi si collega.
+
+Uso:
+    python Heat_stress_App/download.py API_KEY data/raw 1981 2000
+"""
+import calendar
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+DATASET = "era5-downscaled-over-italy"
+PRODUCT = "hourly"
+
+# Variabile della richiesta -> nome della variabile nel NetCDF
+VARIABLES = {
+    "air_temperature": "T_2M",
+    "dew_point_temperature": "TD_2M",
+}
+
+# Area e ore del notebook 00
+DEFAULT_AREA = {"north": 46.65, "south": 44.64, "east": 11.6, "west": 8.4}
+DEFAULT_HOURS = tuple(range(11, 18))
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 3
+RETRY_DELAY = 5.0  # secondi, raddoppiati a ogni tentativo
+HTTP_BLOCK_SIZE = 1024 * 1024
+
+
+# === Blocchi ===
+
+def build_request(variable, year, month, area=DEFAULT_AREA, hours=DEFAULT_HOURS):
+    """Richiesta ddsapi per un singolo mese (stesso formato del notebook 00)."""
+    return {
+        "area": dict(area),
+        "time": {
+            "hour": [f"{hour:02d}" for hour in hours],
+            "year": [str(year)],
+            "month": [str(month)],
+            "day": [str(day) for day in range(1, calendar.monthrange(year, month)[1] + 1)],
+        },
+        "variable": [variable],
+        "format": "netcdf",
+    }
+
+
+def chunk_path(root, variable, year, month):
+    """Percorso del file di un blocco: root/variabile/variabile_AAAA_MM.nc"""
+    return os.path.join(root, variable, f"{variable}_{year}_{month:02d}.nc")
+
+
+def plan_chunks(root, variables, years, months=range(1, 13)):
+    """
+    Elenco dei blocchi (in ordine di variabile, anno, mese).
+    Ritorna:
+      - lista di dizionari con variable, year, month e path
+    """
+    return [{"variable": variable, "year": int(year), "month": int(month),
+             "path": chunk_path(root, variable, int(year), int(month))}
+            for variable in variables for year in years for month in months]
+
+
+def expected_timestamps(year, month, hours=DEFAULT_HOURS):
+    """Timestamp attesi in un blocco mensile."""
+    days = pd.date_range(f"{year}-{month:02d}-01", periods=calendar.monthrange(year, month)[1], freq="D")
+    return pd.DatetimeIndex([day + pd.Timedelta(hours=hour) for day in days for hour in hours])
+
+
+def verify_chunk(path, variable, year, month, hours=DEFAULT_HOURS):
+    """
+    Controlla che un blocco scaricato sia leggibile, contenga la variabile
+    attesa e tutti (e soli) i timestamp del mese.
+    Ritorna:
+      - None se il blocco è valido, altrimenti una stringa con il problema
+    """
+    name = VARIABLES.get(variable, variable)
+    try:
+        with xr.open_dataset(path) as ds:
+            if name not in ds:
+                return f"variabile {name} assente"
+            times = pd.DatetimeIndex(ds["time"].values)
+    except Exception as e:
+        return f"file non leggibile ({e})"
+    expected = expected_timestamps(year, month, hours)
+    if len(times) != len(expected) or not (times.sort_values() == expected).all():
+        return f"{len(times)} timestamp invece di {len(expected)}"
+    return None
+
+
+# === Download ===
+
+def _download_chunk(client, chunk, area, hours, retries, retry_delay, verbose):
+    """
+    Scarica un blocco nel file .part, lo verifica e lo rinomina.
+    Ritorna:
+      - (chunk, numero di tentativi)
+    """
+    path = chunk["path"]
+    part_path = f"{path}.part"
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    request = build_request(chunk["variable"], chunk["year"], chunk["month"], area, hours)
+
+    for attempt in range(1, retries + 1):
+        try:
+            client.retrieve(DATASET, PRODUCT, request, part_path)
+            problem = verify_chunk(part_path, chunk["variable"], chunk["year"], chunk["month"], hours)
+            if problem is None:
+                os.replace(part_path, path)
+                return chunk, attempt
+            # File completo ma non valido: non va ripreso
+            os.remove(part_path)
+            error = ValueError(problem)
+        except Exception as e:
+            # Il file .part resta: un client con ripresa (HTTPClient) continua da dove si era fermato
+            error = e
+        if verbose:
+            print(f"  ⚠️ {os.path.basename(path)}: tentativo {attempt}/{retries} fallito ({error})")
+        if attempt < retries:
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+    raise RuntimeError(f"❌ Download di {os.path.basename(path)} fallito dopo {retries} tentativi: {error}")
+
+
+def download_chunks(client, root, variables=tuple(VARIABLES), years=range(1981, 2001), months=range(1, 13),
+                    area=DEFAULT_AREA, hours=DEFAULT_HOURS, n_workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES,
+                    retry_delay=RETRY_DELAY, verify_existing=True, verbose=True):
+    """
+    Scarica in parallelo i blocchi mensili mancanti.
+    Parametri:
+      - client: oggetto con retrieve(dataset, product, request, target), es. ddsapi.Client
+      - root: cartella dei blocchi (una sottocartella per variabile)
+      - variables: variabili della richiesta (chiavi di VARIABLES)
+      - years, months: anni e mesi da scaricare
+      - n_workers: download contemporanei
+      - retries: tentativi per blocco
+      - verify_existing: se True i blocchi già presenti vengono verificati
+                         e riscaricati se non validi
+    Ritorna:
+      - lista dei blocchi che non è stato possibile scaricare (vuota se tutto è andato bene)
+    """
+    start_time = time.time()
+    chunks = plan_chunks(root, variables, years, months)
+    todo = []
+    for chunk in chunks:
+        if os.path.exists(chunk["path"]):
+            if not verify_existing:
+                continue
+            problem = verify_chunk(chunk["path"], chunk["variable"], chunk["year"], chunk["month"], hours)
+            if problem is None:
+                continue
+            if verbose:
+                print(f"  ⚠️ {os.path.basename(chunk['path'])} non valido ({problem}): verrà riscaricato")
+            os.remove(chunk["path"])
+        todo.append(chunk)
+    if verbose:
+        print(f"⏭️ {len(chunks) - len(todo)} blocchi già scaricati, {len(todo)} da scaricare.")
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, n_workers), thread_name_prefix="download") as executor:
+        futures = {executor.submit(_download_chunk, client, chunk, area, hours, retries, retry_delay, verbose): chunk
+                   for chunk in todo}
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                chunk, attempts = future.result()
+                if verbose:
+                    print(f"  [{done}/{len(todo)}] {os.path.basename(chunk['path'])} scaricato"
+                          + (f" ({attempts} tentativi)" if attempts > 1 else ""))
+            except Exception as e:
+                failed.append(futures[future])
+                if verbose:
+                    print(f"  [{done}/{len(todo)}] {e}")
+
+    if verbose:
+        status = "✅ Download completato" if not failed else f"❌ {len(failed)} blocchi non scaricati"
+        print(f"{status} in {time.time() - start_time:.1f} secondi.")
+    return failed
+
+
+# === Unione dei blocchi ===
+
+def merge_chunks(root, variable, output_path, complevel=4, packed=False, verbose=True):
+    """
+    Concatena lungo il tempo i blocchi mensili di una variabile in un unico
+    NetCDF (dimensione time illimitata, compressione zlib, un timestamp per
+    chunk). I blocchi vengono letti uno alla volta: la memoria dipende solo
+    dalla dimensione di un mese. I tempi vengono convertiti nelle unità del
+    primo blocco. Con packed=True il campo di temperatura viene salvato come
+    int16 quantizzato a chunk di un giorno, cioè dei timestamp di un giorno
+    del primo blocco (7 con le ore DEFAULT_HOURS; vedi encoding.py).
+    Ritorna:
+      - numero di timestamp scritti
+    """
+    import netCDF4
+
+    from encoding import PACKING, create_packed_variable, packed_chunksizes, steps_per_day, write_packed
+
+    directory = os.path.join(root, variable)
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".nc"))
+    if not paths:
+        raise FileNotFoundError(f"❌ Nessun blocco scaricato in {directory}")
+
+    start_time = time.time()
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    n_written = 0
+    with netCDF4.Dataset(tmp_path, "w", format="NETCDF4") as dst:
+        for i, path in enumerate(paths):
+            with netCDF4.Dataset(path) as src:
+                src.set_auto_maskandscale(False)
+                if i == 0:
+                    dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+                    for name, dim in src.dimensions.items():
+                        dst.createDimension(name, None if name == "time" else len(dim))
+                    sizes = {name: len(dim) for name, dim in src.dimensions.items()}
+                    packed_names = {name for name, var in src.variables.items()
+                                    if packed and name in PACKING and "time" in var.dimensions and var.ndim > 1}
+                    for name, var in src.variables.items():
+                        if name in packed_names:
+                            out = create_packed_variable(dst, name, var, PACKING[name],
+                                                         packed_chunksizes(var.dimensions, sizes,
+                                                                           steps_per_day(src["time"])),
+                                                         complevel)
+                            continue
+                        compress = var.ndim > 0 and var.dtype.kind in "fiu"
+                        chunksizes = None
+                        if "time" in var.dimensions:
+                            chunksizes = [1 if d == "time" else len(src.dimensions[d]) for d in var.dimensions]
+                        fill_value = var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None
+                        out = dst.createVariable(name, var.dtype, var.dimensions, zlib=compress,
+                                                 complevel=complevel, shuffle=compress, chunksizes=chunksizes,
+                                                 fill_value=fill_value)
+                        out.set_auto_maskandscale(False)
+                        out.setncatts({key: var.getncattr(key) for key in var.ncattrs() if key != "_FillValue"})
+                        if "time" not in var.dimensions:
+                            out[...] = var[...]
+                    time_units = dst["time"].getncattr("units")
+                    time_calendar = dst["time"].getncattr("calendar") if "calendar" in dst["time"].ncattrs() \
+                        else "standard"
+
+                n_times = len(src.dimensions["time"])
+                target = slice(n_written, n_written + n_times)
+                for name, var in src.variables.items():
+                    if "time" not in var.dimensions:
+                        continue
+                    if name == "time":
+                        dates = netCDF4.num2date(var[:], var.getncattr("units"),
+                                                 var.getncattr("calendar") if "calendar" in var.ncattrs()
+                                                 else "standard")
+                        values = netCDF4.date2num(dates, time_units, time_calendar)
+                        dst["time"][target] = np.asarray(values).astype(dst["time"].dtype)
+                        continue
+                    index = [slice(None)] * var.ndim
+                    index[var.dimensions.index("time")] = target
+                    if name in packed_names:
+                        write_packed(dst[name], tuple(index), var, var[...])
+                    else:
+                        dst[name][tuple(index)] = var[...]
+                n_written += n_times
+    os.replace(tmp_path, output_path)
+
+    if verbose:
+        print(f"✅ {len(paths)} blocchi uniti in {output_path}: {n_written} timestamp "
+              f"in {time.time() - start_time:.1f} secondi.")
+    return n_written
+
+
+# === Client ===
+
+def dds_client(key):
+    """Client ddsapi (dipendenza opzionale, serve solo per il download reale)."""
+    import ddsapi
+    return ddsapi.Client(key=key)
+
+
+class HTTPClient:
+    """
+    Client per il server di prova di serve_synthetic, con la stessa
+    interfaccia di ddsapi.Client. Il file target viene ripreso dal byte in
+    cui si era interrotto (richiesta Range) se esiste già.
+    """
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def retrieve(self, dataset, product, request, target):
+        import requests
+
+        response = requests.post(f"{self.base_url}/retrieve", timeout=self.timeout,
+                                 json={"dataset": dataset, "product": product, "request": request})
+        response.raise_for_status()
+        result = response.json()
+
+        offset = os.path.getsize(target) if os.path.exists(target) else 0
+        if offset > result["size"]:
+            os.remove(target)
+            offset = 0
+        if offset == result["size"]:
+            return target
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with requests.get(f"{self.base_url}{result['url']}", headers=headers, stream=True,
+                          timeout=self.timeout) as response:
+            response.raise_for_status()
+            # 206: il server riprende da offset; 200: file intero da capo
+            mode = "ab" if response.status_code == 206 else "wb"
+            with open(target, mode) as f:
+                for block in response.iter_content(HTTP_BLOCK_SIZE):
+                    f.write(block)
+        if os.path.getsize(target) != result["size"]:
+            raise IOError(f"Download incompleto: {os.path.getsize(target)} di {result['size']} byte")
+        return target
+
+
+# === Server di prova ===
+
+def make_synthetic_chunk(path, request, shape=(20, 30), seed=0):
+    """
+    NetCDF sintetico con la struttura di un blocco mensile reale (griglia a
+    polo ruotato, lat/lon 2D) per le ore e i giorni della richiesta.
+    """
+    variable = request["variable"][0]
+    name = VARIABLES.get(variable, variable)
+    year = int(request["time"]["year"][0])
+    month = int(request["time"]["month"][0])
+    hours = [int(hour) for hour in request["time"]["hour"]]
+    times = expected_timestamps(year, month, hours)
+
+    n_rlat, n_rlon = shape
+    rlat = np.linspace(-1.0, 1.0, n_rlat)
+    rlon = np.linspace(-1.5, 1.5, n_rlon)
+    lon, lat = np.meshgrid(rlon + 10.0, rlat + 45.6)
+    rng = np.random.default_rng([seed, year, month, len(name)])
+    values = (295.0 + 10.0 * rng.random((len(times), n_rlat, n_rlon))).astype(np.float32)
+    if name == "TD_2M":
+        values -= rng.uniform(2.0, 15.0, values.shape).astype(np.float32)
+
+    crs = xr.DataArray(0, attrs={"grid_mapping_name": "rotated_latitude_longitude",
+                                 "grid_north_pole_latitude": 43.0, "grid_north_pole_longitude": -170.0})
+    ds = xr.Dataset({name: (("time", "rlat", "rlon"), values, {"units": "K"}),
+                     "crs_rotated_latitude_longitude": crs},
+                    coords={"time": times, "rlat": rlat, "rlon": rlon,
+                            "lat": (("rlat", "rlon"), lat), "lon": (("rlat", "rlon"), lon)})
+    # Unità diverse per ogni blocco, come nei file reali: merge_chunks deve convertirle
+    ds.to_netcdf(path, encoding={"time": {"units": f"hours since {year}-{month:02d}-01", "dtype": "i8"}})
+
+
+def serve_synthetic(directory, host="127.0.0.1", port=0, interrupt_first=None, shape=(20, 30)):
+    """
+    Avvia in un thread un server HTTP che simula il servizio DDS:
+      - POST /retrieve con {"dataset", "product", "request"} genera (una
+        volta) il blocco sintetico e risponde {"url", "size"}
+      - GET /files/<nome> restituisce il file, rispettando l'header Range
+    Parametri:
+      - directory: cartella in cui vengono salvati i file generati
+      - port: 0 = porta libera scelta dal sistema
+      - interrupt_first: se impostato, il primo GET di ogni file si interrompe
+                         dopo questo numero di byte (per provare la ripresa)
+    Ritorna:
+      - (server, base_url); server.shutdown() per fermarlo
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    os.makedirs(directory, exist_ok=True)
+    lock = threading.Lock()
+    interrupted = set()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, payload, status=200):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != "/retrieve":
+                return self._send_json({"error": "not found"}, 404)
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            request = payload["request"]
+            name = hashlib.sha1(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()[:16] + ".nc"
+            path = os.path.join(directory, name)
+            with lock:
+                if not os.path.exists(path):
+                    make_synthetic_chunk(f"{path}.tmp", request, shape)
+                    os.replace(f"{path}.tmp", path)
+            self._send_json({"url": f"/files/{name}", "size": os.path.getsize(path)})
+
+        def do_GET(self):
+            path = os.path.join(directory, os.path.basename(self.path))
+            if not self.path.startswith("/files/") or not os.path.exists(path):
+                return self._send_json({"error": "not found"}, 404)
+            with open(path, "rb") as f:
+                content = f.read()
+            offset = 0
+            range_header = self.headers.get("Range")
+            if range_header and range_header.startswith("bytes="):
+                offset = int(range_header[len("bytes="):].split("-")[0])
+            self.send_response(206 if offset else 200)
+            if offset:
+                self.send_header("Content-Range", f"bytes {offset}-{len(content) - 1}/{len(content)}")
+            self.send_header("Content-Length", str(len(content) - offset))
+            self.end_headers()
+            body = content[offset:]
+            with lock:
+                cut = interrupt_first is not None and path not in interrupted
+                interrupted.add(path)
+            if cut:
+                # Connessione chiusa a metà trasferimento
+                self.wfile.write(body[:interrupt_first])
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    api_key, output_root, first_year, last_year = sys.argv[1:5]
+    failed = download_chunks(dds_client(api_key), output_root, years=range(int(first_year), int(last_year) + 1))
+    if not failed:
+        for variable in VARIABLES:
+            merge_chunks(output_root, variable, os.path.join(output_root, f"{variable}_{first_year}_{last_year}.nc"),
+                         packed=True)
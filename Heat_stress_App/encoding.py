@@ -0,0 +1,381 @@
+"""
+Codifica compatta (int16 quantizzato) dei campi di temperatura su disco.
+
+I campi di temperatura (T_2M, TD_2M in Kelvin, indici del cubo in °C) hanno
+una precisione utile ben inferiore a quella del float32: vengono salvati come
+interi a 16 bit con la convenzione CF
+
+    valore = intero * scale_factor + add_offset
+
+con passo scale_factor = 0.01 (errore massimo circa 0.005 K) e _FillValue = -32768
+per i valori mancanti. Nei NetCDF le variabili codificate sono anche
+compresse (zlib + shuffle) a chunk di un giorno con la griglia intera. La
+lunghezza del chunk è il numero di timestamp in un giorno del file (vedi
+steps_per_day): 24 per i dati orari completi, 7 per il download e la demo
+con le ore 11-17. Leggere una mappa decomprime un solo chunk, che resta
+nella cache HDF5 per le ore successive, e un blocco di estrazione legge
+pochi chunk contigui. Rispetto al float32 non compresso lo spazio si riduce
+di almeno 3 volte (di più per campi spazialmente regolari).
+
+I lettori esistenti non cambiano: xarray decodifica scale_factor/add_offset
+direttamente in float32 (con NaN al posto di _FillValue). PackedReader legge
+invece una variabile con netCDF4 decodificando in buffer float32
+preallocati, senza array intermedi in float64.
+
+  - encode_netcdf: copia in streaming un NetCDF codificando i campi di temperatura
+  - max_error: differenza massima tra un NetCDF originale e quello codificato
+  - pack_cube: converte un cubo degli indici float32 (cube.py) in int16;
+    il cubo resta non compresso per mantenere l'accesso in memory-map
+Le stesse codifiche sono disponibili in reduction.reduce_netcdf,
+download.merge_chunks e cube.build_cube con packed=True.
+
+Uso:
+    python Heat_stress_App/encoding.py T_2M.nc T_2M_int16.nc --verify
+    python Heat_stress_App/encoding.py --cube data/index_cube data/index_cube_int16
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+
+# (scale_factor, add_offset) per variabile: campi in Kelvin centrati su 0 °C
+PACKING = {
+    "T_2M": (0.01, 273.15),
+    "TD_2M": (0.01, 273.15),
+}
+CUBE_PACKING = (0.01, 0.0)  # indici del cubo in °C (RH in %)
+FILL_VALUE = np.int16(-32768)
+VALID_MIN, VALID_MAX = -32767, 32767
+DEFAULT_TIME_CHUNK = None  # timestamp per chunk HDF5 (None = quelli di un giorno, vedi steps_per_day)
+DEFAULT_COMPLEVEL = 4
+DEFAULT_BLOCK_SIZE = 24 * 7  # timestamp letti e scritti per blocco
+
+# Attributi del float originale che non valgono più per l'intero codificato
+_DROPPED_ATTRS = ("_FillValue", "missing_value", "scale_factor", "add_offset", "valid_min", "valid_max",
+                  "valid_range")
+
+
+def _mb(n_bytes):
+    return n_bytes / (1024 * 1024)
+
+
+def pack(values, scale_factor, add_offset, missing_value=None, out=None):
+    """
+    Quantizza valori float in int16: round((valore - add_offset) / scale_factor).
+    Parametri:
+      - values: array float (qualsiasi forma)
+      - scale_factor, add_offset: parametri della codifica
+      - missing_value: valore di origine da trattare come mancante (oltre ai NaN)
+      - out: buffer int16 preallocato (opzionale)
+    Ritorna:
+      - array int16, con FILL_VALUE per i valori mancanti
+    """
+    values = np.asarray(values)
+    scaled = np.subtract(values, add_offset, dtype=np.float64)
+    scaled /= scale_factor
+    np.rint(scaled, out=scaled)
+    valid = np.isfinite(scaled)
+    if missing_value is not None:
+        valid &= values != missing_value
+    if valid.any():
+        low, high = scaled[valid].min(), scaled[valid].max()
+        if low < VALID_MIN or high > VALID_MAX:
+            raise ValueError(f"Valori fuori dall'intervallo della codifica int16 "
+                             f"({low * scale_factor + add_offset:.2f}, {high * scale_factor + add_offset:.2f})")
+    if out is None:
+        out = np.empty(values.shape, dtype=np.int16)
+    out[...] = FILL_VALUE
+    np.copyto(out, scaled, casting="unsafe", where=valid)
+    return out
+
+
+def unpack(packed, scale_factor, add_offset, fill_value=FILL_VALUE, out=None):
+    """
+    Decodifica interi quantizzati in float32 (NaN per fill_value).
+    Parametri:
+      - packed: array intero
+      - out: buffer float32 preallocato (opzionale), della stessa forma
+    Ritorna:
+      - array float32
+    """
+    packed = np.asarray(packed)
+    if out is None:
+        out = np.empty(packed.shape, dtype=np.float32)
+    np.multiply(packed, np.float32(scale_factor), out=out, dtype=np.float32)
+    out += np.float32(add_offset)
+    if fill_value is not None:
+        out[packed == fill_value] = np.nan
+    return out
+
+
+def steps_per_day(times):
+    """
+    Numero di timestamp nel giorno più completo: lunghezza dei chunk di un giorno.
+    Parametri:
+      - times: array datetime64 oppure variabile time di netCDF4 (con units)
+    """
+    if hasattr(times, "units"):
+        import netCDF4
+
+        calendar = times.getncattr("calendar") if "calendar" in times.ncattrs() else "standard"
+        times = netCDF4.num2date(times[:], times.getncattr("units"), calendar,
+                                 only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+    days = np.asarray(times, dtype="datetime64[D]")
+    if len(days) == 0:
+        return 1
+    return int(np.unique(days, return_counts=True)[1].max())
+
+
+def packed_chunksizes(dimensions, sizes, time_chunk):
+    """Chunk HDF5 di time_chunk timestamp con la griglia intera (sizes: {dimensione: lunghezza})."""
+    return [min(time_chunk, sizes[d]) or time_chunk if d == "time" else sizes[d] for d in dimensions]
+
+
+def create_packed_variable(dst, name, var, packing, chunksizes, complevel=DEFAULT_COMPLEVEL):
+    """
+    Crea in dst (netCDF4.Dataset) la versione int16 della variabile var,
+    compressa, con gli attributi di var e scale_factor/add_offset/_FillValue.
+    La variabile restituita ha la decodifica automatica disattivata: si
+    scrive con write_packed.
+    """
+    scale_factor, add_offset = packing
+    out = dst.createVariable(name, np.int16, var.dimensions, zlib=True, complevel=complevel, shuffle=True,
+                             chunksizes=chunksizes, fill_value=FILL_VALUE)
+    out.set_auto_maskandscale(False)
+    out.setncatts({key: var.getncattr(key) for key in var.ncattrs() if key not in _DROPPED_ATTRS})
+    out.setncatts({"scale_factor": np.float32(scale_factor), "add_offset": np.float32(add_offset)})
+    return out
+
+
+def decoded_values(var, raw):
+    """
+    Valori fisici (float) di un blocco letto senza decodifica automatica da
+    var, che può essere float (con _FillValue/missing_value) oppure già codificata.
+    """
+    attrs = var.ncattrs()
+    fill_value = var.getncattr("_FillValue") if "_FillValue" in attrs else \
+        var.getncattr("missing_value") if "missing_value" in attrs else None
+    if "scale_factor" in attrs or "add_offset" in attrs:
+        return unpack(raw, var.getncattr("scale_factor") if "scale_factor" in attrs else 1.0,
+                      var.getncattr("add_offset") if "add_offset" in attrs else 0.0, fill_value)
+    values = np.asarray(raw, dtype=np.float32)
+    if fill_value is not None and not np.isnan(fill_value):
+        values = np.where(raw == fill_value, np.float32(np.nan), values)
+    return values
+
+
+def write_packed(out, index, src_var, raw):
+    """Scrive in out[index] (variabile di create_packed_variable) un blocco grezzo letto da src_var."""
+    out[index] = pack(decoded_values(src_var, raw), float(out.getncattr("scale_factor")),
+                      float(out.getncattr("add_offset")))
+
+
+class PackedReader:
+    """
+    Lettura di una variabile di un NetCDF in buffer float32, decodificando
+    direttamente gli interi quantizzati (o copiando i float, con NaN per i mancanti).
+
+        with PackedReader("T_2M_int16.nc", "T_2M") as reader:
+            buffer = np.empty((168,) + reader.shape[1:], np.float32)
+            reader.read(slice(0, 168), out=buffer)
+    """
+
+    def __init__(self, path, variable):
+        import netCDF4
+
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"❌ File NetCDF non trovato: {path}")
+        self.dataset = netCDF4.Dataset(path)
+        self.variable = self.dataset[variable]
+        self.variable.set_auto_maskandscale(False)
+        attrs = self.variable.ncattrs()
+        self.packed = "scale_factor" in attrs or "add_offset" in attrs
+        self.scale_factor = float(self.variable.getncattr("scale_factor")) if "scale_factor" in attrs else 1.0
+        self.add_offset = float(self.variable.getncattr("add_offset")) if "add_offset" in attrs else 0.0
+        self.fill_value = self.variable.getncattr("_FillValue") if "_FillValue" in attrs else None
+        self.shape = self.variable.shape
+
+    def read(self, index=slice(None), out=None):
+        """
+        Legge variable[index] (indice sul primo asse o tupla di indici).
+        Ritorna:
+          - array float32 (out, se passato)
+        """
+        raw = self.variable[index]
+        if self.packed:
+            return unpack(raw, self.scale_factor, self.add_offset, self.fill_value, out)
+        if out is None:
+            out = np.empty(raw.shape, dtype=np.float32)
+        np.copyto(out, raw, casting="same_kind")
+        if self.fill_value is not None and not np.isnan(self.fill_value):
+            out[raw == self.fill_value] = np.nan
+        return out
+
+    def close(self):
+        self.dataset.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def encode_netcdf(input_path, output_path, packing=PACKING, time_chunk=DEFAULT_TIME_CHUNK,
+                  complevel=DEFAULT_COMPLEVEL, block_size=DEFAULT_BLOCK_SIZE, verbose=True):
+    """
+    Copia in streaming un NetCDF codificando in int16 le variabili di packing
+    con dimensione time; le altre variabili vengono copiate così come sono
+    (compresse). La memoria dipende solo da block_size.
+    Parametri:
+      - time_chunk: timestamp per chunk HDF5 (None = quelli di un giorno del file)
+    Ritorna:
+      - numero di variabili codificate
+    """
+    import netCDF4
+
+    start_time = time.time()
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    n_packed = 0
+    with netCDF4.Dataset(input_path) as src, netCDF4.Dataset(tmp_path, "w", format="NETCDF4") as dst:
+        src.set_auto_maskandscale(False)
+        dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+        sizes = {name: len(dim) for name, dim in src.dimensions.items()}
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+        if time_chunk is None and "time" in src.variables:
+            time_chunk = steps_per_day(src["time"])
+
+        for name, var in src.variables.items():
+            if name in packing and "time" in var.dimensions and var.ndim > 1:
+                out = create_packed_variable(dst, name, var, packing[name],
+                                             packed_chunksizes(var.dimensions, sizes, time_chunk), complevel)
+                n_packed += 1
+            else:
+                compress = var.ndim > 0 and var.dtype.kind in "fiu"
+                fill_value = var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None
+                out = dst.createVariable(name, var.dtype, var.dimensions, zlib=compress, complevel=complevel,
+                                         shuffle=compress, fill_value=fill_value)
+                out.set_auto_maskandscale(False)
+                out.setncatts({key: var.getncattr(key) for key in var.ncattrs() if key != "_FillValue"})
+
+            if "time" not in var.dimensions or var.ndim == 1:
+                out[...] = var[...]
+                continue
+            axis = var.dimensions.index("time")
+            for start in range(0, sizes["time"], block_size):
+                index = [slice(None)] * var.ndim
+                index[axis] = slice(start, min(start + block_size, sizes["time"]))
+                index = tuple(index)
+                if name in packing:
+                    write_packed(out, index, var, var[index])
+                else:
+                    out[index] = var[index]
+    os.replace(tmp_path, output_path)
+
+    if verbose:
+        size_in, size_out = os.path.getsize(input_path), os.path.getsize(output_path)
+        print(f"✅ {os.path.basename(output_path)}: {_mb(size_in):.1f} MB -> {_mb(size_out):.1f} MB "
+              f"({size_in / max(size_out, 1):.1f}x) in {time.time() - start_time:.1f} secondi.")
+    return n_packed
+
+
+def max_error(original_path, encoded_path, variable, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Differenza assoluta massima tra i valori decodificati di due NetCDF
+    (NaN nelle stesse posizioni attesi).
+    Ritorna:
+      - errore massimo (stesse unità della variabile)
+    """
+    error = 0.0
+    with PackedReader(original_path, variable) as original, PackedReader(encoded_path, variable) as encoded:
+        if original.shape != encoded.shape:
+            raise ValueError(f"Forme diverse: {original.shape} e {encoded.shape}")
+        for start in range(0, original.shape[0], block_size):
+            block = slice(start, min(start + block_size, original.shape[0]))
+            a, b = original.read(block), encoded.read(block)
+            if not np.array_equal(np.isnan(a), np.isnan(b)):
+                raise ValueError(f"Valori mancanti diversi nel blocco {block}")
+            if np.isfinite(a).any():
+                error = max(error, float(np.nanmax(np.abs(a - b))))
+    return error
+
+
+def cube_encoding(packing=CUBE_PACKING):
+    """Descrizione della codifica salvata in meta.json del cubo."""
+    scale_factor, add_offset = packing
+    return {"dtype": "int16", "scale_factor": scale_factor, "add_offset": add_offset,
+            "fill_value": int(FILL_VALUE)}
+
+
+def pack_cube(root, output_root, packing=CUBE_PACKING, block_size=DEFAULT_BLOCK_SIZE, verbose=True):
+    """
+    Converte un cubo degli indici float32 (cube.py) in un cubo int16 con la
+    stessa struttura; meta.json riporta la codifica e viene scritto per ultimo.
+    Ritorna:
+      - IndexCube aperto sul nuovo cubo
+    """
+    from cube import CUBE_FILE, META_FILE, IndexCube
+
+    source = IndexCube(root)
+    if source.packing is not None:
+        raise ValueError(f"Il cubo {root} è già codificato")
+    os.makedirs(output_root, exist_ok=True)
+    meta_path = os.path.join(output_root, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    target = np.lib.format.open_memmap(os.path.join(output_root, CUBE_FILE), mode="w+", dtype=np.int16,
+                                       shape=source.data.shape)
+    for start in range(0, source.data.shape[0], block_size):
+        block = slice(start, min(start + block_size, source.data.shape[0]))
+        pack(source.data[block], *packing, out=target[block])
+    target.flush()
+    del target
+
+    with open(os.path.join(root, META_FILE)) as f:
+        meta = json.load(f)
+    meta["encoding"] = cube_encoding(packing)
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    if verbose:
+        size_in = os.path.getsize(os.path.join(root, CUBE_FILE))
+        size_out = os.path.getsize(os.path.join(output_root, CUBE_FILE))
+        print(f"✅ Cubo codificato in {output_root}: {_mb(size_in):.1f} MB -> {_mb(size_out):.1f} MB")
+    return IndexCube(output_root)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Codifica int16 compressa dei NetCDF di temperatura e del cubo")
+    parser.add_argument("input", help="NetCDF di origine (o cartella del cubo con --cube)")
+    parser.add_argument("output", help="NetCDF codificato (o cartella del nuovo cubo con --cube)")
+    parser.add_argument("--cube", action="store_true", help="converte un cubo degli indici (cube.py)")
+    parser.add_argument("--time-chunk", type=int, default=DEFAULT_TIME_CHUNK,
+                        help="timestamp per chunk HDF5 (default: quelli di un giorno del file)")
+    parser.add_argument("--complevel", type=int, default=DEFAULT_COMPLEVEL, help="livello di compressione zlib")
+    parser.add_argument("--verify", action="store_true", help="riporta l'errore massimo di quantizzazione")
+    args = parser.parse_args(argv)
+
+    if args.cube:
+        pack_cube(args.input, args.output)
+        return 0
+    if os.path.abspath(args.input) == os.path.abspath(args.output):
+        parser.error("input e output devono essere file diversi")
+    encode_netcdf(args.input, args.output, time_chunk=args.time_chunk, complevel=args.complevel)
+    if args.verify:
+        import netCDF4
+
+        with netCDF4.Dataset(args.output) as ds:
+            names = [name for name in PACKING if name in ds.variables]
+        for name in names:
+            print(f"  {name}: errore massimo {max_error(args.input, args.output, name):.4f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
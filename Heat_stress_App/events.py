@@ -0,0 +1,158 @@
+"""
+Rilevamento dei "danger days" e delle ondate di calore multi-indice.
+
+Sostituisce il ciclo per-timestamp del notebook 04 (groupby("Timestamp"),
+set_index("Indice") e confronto con "si" per ogni gruppo): la tabella degli
+indici viene trasformata una sola volta in una matrice (timestamp x indice)
+e il numero di indici sopra soglia e la somma dei residui sono calcolati
+con operazioni vettoriali su tutta la serie.
+I timestamp pericolosi consecutivi (per giorno di calendario) vengono poi
+uniti in eventi di ondata di calore con durata e intensità.
+"""
+import numpy as np
+import pandas as pd
+
+from constants import soglie
+
+
+DEFAULT_STAT_COLUMN = "99° Perc. (°C)"
+DEFAULT_MIN_EXCEEDED = 3
+
+
+def pivot_indices(df, stat_column=DEFAULT_STAT_COLUMN, indices=None):
+    """
+    Matrice (timestamp x indice) dei valori di una statistica.
+    Parametri:
+      - df: tabella degli indici (Timestamp, Indice, colonne delle statistiche)
+      - stat_column: colonna della statistica
+      - indices: indici da considerare (default: tutti quelli presenti)
+    Ritorna:
+      - timestamps: DatetimeIndex ordinato
+      - indices: lista dei nomi degli indici (colonne della matrice)
+      - values: array (n_timestamp, n_indici) float64, NaN dove manca il dato
+      - thresholds: array (n_indici,) delle soglie
+    """
+    if indices is not None:
+        df = df[df["Indice"].isin(indices)]
+
+    t_codes, timestamps = pd.factorize(pd.to_datetime(df["Timestamp"]), sort=True)
+    i_codes, names = pd.factorize(df["Indice"].astype(str), sort=indices is None)
+    names = list(names)
+    if indices is not None:
+        # Mantiene l'ordine richiesto dall'utente
+        order = [names.index(name) for name in indices if name in names]
+        remap = np.empty(len(names), dtype=np.intp)
+        remap[order] = np.arange(len(order))
+        i_codes = remap[i_codes]
+        names = [names[k] for k in order]
+
+    values = np.full((len(timestamps), len(names)), np.nan)
+    values[t_codes, i_codes] = df[stat_column].to_numpy(dtype=np.float64)
+
+    if "Soglia (°C)" in df.columns:
+        thresholds = np.full(len(names), np.nan)
+        thresholds[i_codes] = df["Soglia (°C)"].to_numpy(dtype=np.float64)
+    else:
+        thresholds = np.array([soglie[name] for name in names], dtype=np.float64)
+    return pd.DatetimeIndex(timestamps), names, values, thresholds
+
+
+def count_exceedances(values, thresholds):
+    """
+    Numero di indici sopra soglia e somma dei residui (valore - soglia)
+    dei soli indici sopra soglia, per ogni riga della matrice.
+    I NaN non contano come superamenti.
+    """
+    residuals = values - thresholds
+    exceeded = residuals > 0
+    n_exceeded = exceeded.sum(axis=1)
+    exceedance_sum = np.where(exceeded, residuals, 0.0).sum(axis=1)
+    return n_exceeded, exceedance_sum
+
+
+def detect_danger_days(df, stat_column=DEFAULT_STAT_COLUMN, min_thresholds_exceeded=DEFAULT_MIN_EXCEEDED,
+                       indices=None):
+    """
+    Timestamp in cui almeno min_thresholds_exceeded indici superano la
+    propria soglia (stesso risultato del ciclo del notebook 04).
+    Ritorna:
+      - DataFrame con Date, Year, ThresholdsExceeded, ExceedanceSum
+    """
+    timestamps, _, values, thresholds = pivot_indices(df, stat_column, indices)
+    n_exceeded, exceedance_sum = count_exceedances(values, thresholds)
+    danger = n_exceeded >= min_thresholds_exceeded
+    dates = timestamps[danger]
+    return pd.DataFrame({
+        "Date": dates,
+        "Year": dates.year,
+        "ThresholdsExceeded": n_exceeded[danger],
+        "ExceedanceSum": exceedance_sum[danger]
+    })
+
+
+def yearly_summary(danger_days, years=None):
+    """
+    Aggregazione annuale dei danger days.
+    Parametri:
+      - danger_days: risultato di detect_danger_days
+      - years: anni da includere (default: dal primo all'ultimo anno presente)
+    Ritorna:
+      - DataFrame indicizzato per anno con DangerousDays, ExceedanceSum
+        e AvgCumulativeIntensity (0 negli anni senza danger days)
+    """
+    if years is None:
+        years = range(danger_days["Year"].min(), danger_days["Year"].max() + 1) if len(danger_days) else []
+    summary = danger_days.groupby("Year").agg(
+        DangerousDays=("Date", "count"),
+        ExceedanceSum=("ExceedanceSum", "sum")
+    ).reindex(years, fill_value=0)
+    summary.index.name = "Year"
+
+    days = summary["DangerousDays"].to_numpy()
+    summary["AvgCumulativeIntensity"] = np.divide(summary["ExceedanceSum"].to_numpy(dtype=float), days,
+                                                  out=np.zeros(len(days)), where=days > 0)
+    return summary
+
+
+def heatwave_events(danger_days, min_duration=1, max_gap=0):
+    """
+    Unisce i giorni di calendario con almeno un danger day consecutivi in
+    eventi di ondata di calore.
+    Parametri:
+      - danger_days: risultato di detect_danger_days
+      - min_duration: durata minima (giorni) di un evento
+      - max_gap: giorni non pericolosi tollerati all'interno di un evento
+    Ritorna:
+      - DataFrame con Start, End, Year, Duration (giorni), DangerousTimestamps,
+        MaxThresholdsExceeded, CumulativeIntensity, MeanIntensity, PeakIntensity
+    """
+    columns = ["Start", "End", "Year", "Duration", "DangerousTimestamps",
+               "MaxThresholdsExceeded", "CumulativeIntensity", "MeanIntensity", "PeakIntensity"]
+    if len(danger_days) == 0:
+        return pd.DataFrame(columns=columns)
+
+    daily = danger_days.groupby(pd.DatetimeIndex(danger_days["Date"]).normalize()).agg(
+        DangerousTimestamps=("Date", "count"),
+        MaxThresholdsExceeded=("ThresholdsExceeded", "max"),
+        CumulativeIntensity=("ExceedanceSum", "sum"),
+        PeakIntensity=("ExceedanceSum", "max")
+    )
+    days = daily.index.values.astype("datetime64[D]").astype(np.int64)
+
+    # Nuovo evento quando la distanza dal giorno precedente supera max_gap + 1
+    new_event = np.concatenate(([True], np.diff(days) > max_gap + 1))
+    starts = np.flatnonzero(new_event)
+
+    events = pd.DataFrame({
+        "Start": daily.index[starts],
+        "End": daily.index[np.append(starts[1:], len(days)) - 1],
+        "DangerousTimestamps": np.add.reduceat(daily["DangerousTimestamps"].to_numpy(), starts),
+        "MaxThresholdsExceeded": np.maximum.reduceat(daily["MaxThresholdsExceeded"].to_numpy(), starts),
+        "CumulativeIntensity": np.add.reduceat(daily["CumulativeIntensity"].to_numpy(dtype=float), starts),
+        "PeakIntensity": np.maximum.reduceat(daily["PeakIntensity"].to_numpy(dtype=float), starts)
+    })
+    events["Year"] = events["Start"].dt.year
+    events["Duration"] = (events["End"] - events["Start"]).dt.days + 1
+    events["MeanIntensity"] = events["CumulativeIntensity"] / events["DangerousTimestamps"]
+    events = events[events["Duration"] >= min_duration].reset_index(drop=True)
+    return events[columns]
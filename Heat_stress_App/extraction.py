@@ -0,0 +1,465 @@
+"""
+Estrazione batch degli indici di heat stress dai NetCDF T_2M / TD_2M.
+
+Sostituisce il ciclo per-timestamp del notebook 03: i dati vengono letti a
+blocchi di `chunk_size` ore, gli indici sono calcolati con compute_all_indices
+sull'intero blocco (time, rlat, rlon) e le statistiche spaziali vengono
+vettorializzate su tutti i timestamp del blocco. Il risultato viene scritto
+in streaming, per cui la memoria dipende solo dalla dimensione del blocco.
+"""
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import instrumentation
+from constants import OUTPUT_INDICES, STAT_COLUMNS, soglie
+from functions import allocate_index_buffers, compute_all_indices, fill_dew_point, spatial_stats
+from instrumentation import span
+
+
+DEFAULT_CHUNK_SIZE = 24 * 7  # una settimana di dati orari
+
+# Formule usate per gli indici (functions.compute_all_indices). Il notebook 03
+# calcola LHSI, UTCI e Heat Index con formule diverse: un output esistente
+# viene esteso solo se il marker accanto ad esso riporta queste formule.
+# Da aggiornare se cambia una formula in functions.py.
+FORMULAS = "functions.compute_all_indices/1"
+MARKER_SUFFIX = ".formulas.json"
+STORE_MARKER = "_formulas.json"  # ignorato da pyarrow in lettura (prefisso "_")
+
+
+def open_datasets(temp_path, dew_path):
+    """
+    Apre (in modo lazy) la coppia di NetCDF di temperatura e punto di rugiada.
+    Ritorna:
+      - (dataset_temp, dataset_dew)
+    """
+    for path in (temp_path, dew_path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"❌ File NetCDF non trovato: {path}")
+    return xr.open_dataset(temp_path), xr.open_dataset(dew_path)
+
+
+def iter_time_chunks(n_times, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Genera gli slice temporali [start, stop) di lunghezza chunk_size.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size deve essere >= 1")
+    for start in range(0, n_times, chunk_size):
+        yield slice(start, min(start + chunk_size, n_times))
+
+
+def build_records(timestamps, stats, first_number=1):
+    """
+    Costruisce la tabella in formato lungo (una riga per timestamp e indice)
+    con le stesse colonne prodotte dal notebook di estrazione.
+    Parametri:
+      - timestamps: array datetime64 dei timestamp del blocco
+      - stats: {statistica: array (time * indici,)} ordinato per timestamp,
+               poi per indice (come restituito da spatial_stats)
+      - first_number: valore di "Numero Timestamp" per il primo timestamp
+    """
+    n_times = len(timestamps)
+    n_indices = len(OUTPUT_INDICES)
+    timestamps = np.asarray(timestamps, dtype="datetime64[ns]")
+
+    df = pd.DataFrame({
+        "Timestamp": np.repeat(np.datetime_as_string(timestamps), n_indices),
+        "Numero Timestamp": np.repeat(np.arange(first_number, first_number + n_times), n_indices),
+        "Indice": np.tile(OUTPUT_INDICES, n_times),
+    })
+
+    threshold = np.tile([soglie[key] for key in OUTPUT_INDICES], n_times).astype(float)
+    values = {}
+    for stat, (col_value, _) in STAT_COLUMNS.items():
+        values[stat] = np.asarray(stats[stat], dtype=float)
+        df[col_value] = values[stat]
+    df["Soglia (°C)"] = threshold
+    for stat, (_, col_flag) in STAT_COLUMNS.items():
+        df[col_flag] = np.where(values[stat] > threshold, "si", "no")
+    df["Data"] = timestamps.astype("datetime64[D]").repeat(n_indices).astype(object)
+    return df
+
+
+def process_chunk(Ta_k, Td_k, timestamps, first_number=1, out=None):
+    """
+    Calcola indici e statistiche per un blocco di timestamp.
+    Parametri:
+      - Ta_k, Td_k: DataArray (time, rlat, rlon) in Kelvin
+      - timestamps: array datetime64 dei timestamp del blocco
+      - first_number: "Numero Timestamp" del primo timestamp
+      - out: buffer preallocati per compute_all_indices (opzionale)
+    Ritorna:
+      - DataFrame in formato lungo per il blocco
+    """
+    with span("extraction.fill_dew_point"):
+        Td_k = fill_dew_point(Td_k)
+    with span("extraction.indices"):
+        indices = compute_all_indices(Ta_k, Td_k, out=out)
+    with span("extraction.stats"):
+        # (time, indici, rlat, rlon): tutte le statistiche del blocco in una sola chiamata
+        stacked = np.stack([indices[key] for key in OUTPUT_INDICES], axis=1)
+        stats = spatial_stats(stacked.reshape(-1, *stacked.shape[2:]))
+    with span("extraction.records"):
+        return build_records(timestamps, stats, first_number)
+
+
+def pending_runs(timestamps, processed=None):
+    """
+    Individua i tratti contigui dell'asse temporale ancora da elaborare.
+    Parametri:
+      - timestamps: array datetime64 del NetCDF
+      - processed: timestamp già presenti nell'output (None = nessuno)
+    Ritorna:
+      - lista di slice sull'asse time
+    """
+    n_times = len(timestamps)
+    if processed is None or len(processed) == 0:
+        return [slice(0, n_times)] if n_times else []
+
+    todo = ~pd.DatetimeIndex(timestamps).isin(pd.DatetimeIndex(processed))
+    # Confini dei tratti in cui todo vale True
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], todo, [False]]).astype(np.int8)))
+    return [slice(int(a), int(b)) for a, b in zip(edges[::2], edges[1::2])]
+
+
+def shard_time_axis(timestamps, shard_by="year", chunk_size=DEFAULT_CHUNK_SIZE, runs=None):
+    """
+    Suddivide l'asse temporale in shard contigui da distribuire ai worker.
+    Parametri:
+      - timestamps: array datetime64 (ordinato)
+      - shard_by: "year" (uno shard per anno) oppure "chunk" (uno per blocco)
+      - runs: tratti da suddividere (default: l'intero asse, vedi pending_runs)
+    Ritorna:
+      - lista di slice sull'asse time
+    """
+    if shard_by not in ("year", "chunk"):
+        raise ValueError(f"shard_by non valido: {shard_by!r} (usa 'year' o 'chunk')")
+    if runs is None:
+        runs = [slice(0, len(timestamps))]
+
+    shards = []
+    for run in runs:
+        if shard_by == "chunk":
+            bounds = [c.start for c in iter_time_chunks(run.stop - run.start, chunk_size)][1:]
+        else:
+            years = pd.DatetimeIndex(timestamps[run]).year.values
+            # Indici dove cambia l'anno -> confini degli shard
+            bounds = (np.flatnonzero(np.diff(years)) + 1).tolist()
+        starts = [0] + bounds
+        stops = bounds + [run.stop - run.start]
+        shards.extend(slice(run.start + a, run.start + b) for a, b in zip(starts, stops))
+    return shards
+
+
+def number_offset(runs, start, last_number=0):
+    """
+    Scostamento da sommare alla posizione nel NetCDF per ottenere il
+    "Numero Timestamp", in modo che i timestamp da elaborare proseguano la
+    numerazione dell'output esistente senza buchi.
+    Parametri:
+      - runs: tratti da elaborare (vedi pending_runs)
+      - start: posizione del primo timestamp dello shard
+      - last_number: "Numero Timestamp" massimo già presente (0 = nessuno)
+    """
+    pending_before = sum(max(0, min(run.stop, start) - run.start) for run in runs)
+    return last_number + pending_before - start
+
+
+def extract_indices(dataset_temp, dataset_dew, chunk_size=DEFAULT_CHUNK_SIZE, verbose=True, shard=None,
+                    offset=0):
+    """
+    Generatore: elabora i dataset a blocchi temporali e restituisce
+    un DataFrame per ciascun blocco.
+    Parametri:
+      - shard: slice opzionale sull'asse time da elaborare (default: tutto)
+      - offset: scostamento del "Numero Timestamp" (vedi number_offset)
+    """
+    timestamps = dataset_temp['T_2M'].time.values
+    out = None
+    if shard is None:
+        shard = slice(0, len(timestamps))
+
+    for rel_chunk in iter_time_chunks(shard.stop - shard.start, chunk_size):
+        chunk = slice(shard.start + rel_chunk.start, shard.start + rel_chunk.stop)
+        start_time = time.time()
+        chunk_times = timestamps[chunk]
+        with span("extraction.read"):
+            Ta_k = dataset_temp['T_2M'].isel(time=chunk).load()
+            Td_k = dataset_dew['TD_2M'].sel(time=chunk_times).load()
+
+        # Riutilizza i buffer finché la forma del blocco non cambia (ultimo blocco)
+        if out is None or out["UTCI"].shape != Ta_k.shape:
+            out = allocate_index_buffers(Ta_k.shape)
+        df_chunk = process_chunk(Ta_k, Td_k, chunk_times, chunk.start + 1 + offset, out=out)
+
+        if verbose:
+            first = pd.Timestamp(chunk_times[0])
+            last = pd.Timestamp(chunk_times[-1])
+            elapsed = time.time() - start_time
+            print(f"  Blocco {first:%Y-%m-%d %H:%M} → {last:%Y-%m-%d %H:%M} completato in {elapsed:.1f} secondi.")
+        yield df_chunk
+
+
+def _extract_shard(temp_path, dew_path, shard, chunk_size, offset=0):
+    """
+    Lavoro di un singolo worker: apre i NetCDF in modo indipendente,
+    elabora lo shard e restituisce (shard, DataFrame, secondi impiegati,
+    metriche del worker).
+    """
+    start_time = time.time()
+    # Con fork il worker eredita le metriche del processo principale: si riparte da zero
+    instrumentation.reset()
+    dataset_temp, dataset_dew = open_datasets(temp_path, dew_path)
+    try:
+        frames = list(extract_indices(dataset_temp, dataset_dew, chunk_size,
+                                      verbose=False, shard=shard, offset=offset))
+    finally:
+        dataset_temp.close()
+        dataset_dew.close()
+    return shard, pd.concat(frames, ignore_index=True), time.time() - start_time, instrumentation.snapshot()
+
+
+def _iter_results(temp_path, dew_path, chunk_size, verbose, n_workers, shard_by, processed=None,
+                  last_number=0):
+    """
+    Restituisce i DataFrame dei risultati nell'ordine temporale,
+    in modo sequenziale (n_workers=1) o tramite un pool di processi.
+    I timestamp in processed vengono saltati e la numerazione prosegue
+    da last_number.
+    """
+    with xr.open_dataset(temp_path) as dataset_temp:
+        timestamps = dataset_temp['T_2M'].time.values
+    runs = pending_runs(timestamps, processed)
+    if verbose and processed is not None:
+        n_todo = sum(run.stop - run.start for run in runs)
+        print(f"⏭️ {len(timestamps) - n_todo} timestamp già elaborati, {n_todo} da elaborare.")
+
+    if n_workers == 1:
+        dataset_temp, dataset_dew = open_datasets(temp_path, dew_path)
+        try:
+            for run in runs:
+                yield from extract_indices(dataset_temp, dataset_dew, chunk_size, verbose, shard=run,
+                                           offset=number_offset(runs, run.start, last_number))
+        finally:
+            dataset_temp.close()
+            dataset_dew.close()
+        return
+
+    shards = shard_time_axis(timestamps, shard_by, chunk_size, runs)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_extract_shard, temp_path, dew_path, shard, chunk_size,
+                                   number_offset(runs, shard.start, last_number))
+                   for shard in shards]
+        # Unione deterministica: i risultati vengono consumati nell'ordine degli shard
+        for future in futures:
+            shard, df_shard, elapsed, metrics = future.result()
+            instrumentation.merge(metrics)
+            if verbose:
+                first = pd.Timestamp(timestamps[shard.start])
+                label = f"Anno {first.year}" if shard_by == "year" else f"Blocco {first:%Y-%m-%d %H:%M}"
+                print(f"  {label} completato in {elapsed:.1f} secondi.")
+            yield df_shard
+
+
+def marker_path(output_path, output_format="csv"):
+    """Percorso del marker delle formule accanto al CSV o dentro l'archivio Parquet."""
+    if output_format == "parquet":
+        return os.path.join(output_path, STORE_MARKER)
+    return output_path + MARKER_SUFFIX
+
+
+def write_marker(output_path, output_format="csv"):
+    """Registra accanto all'output le formule con cui viene prodotto."""
+    path = marker_path(output_path, output_format)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"formulas": FORMULAS}, f)
+
+
+def check_marker(output_path, output_format="csv"):
+    """
+    Verifica che l'output esistente sia stato prodotto con le formule attuali,
+    prima di aggiungervi nuove righe.
+    Solleva:
+      - ValueError se il marker manca (es. CSV del notebook 03) o è diverso
+    """
+    path = marker_path(output_path, output_format)
+    formulas = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            formulas = json.load(f).get("formulas")
+    if formulas != FORMULAS:
+        found = "nessun marker" if formulas is None else f"formule {formulas!r}"
+        raise ValueError(
+            f"❌ {output_path} non è stato prodotto con le formule attuali ({found}, attese {FORMULAS!r}): "
+            "aggiungere righe mescolerebbe serie di valori non confrontabili. "
+            "Ricalcolare prima l'intero output con run_extraction(..., incremental=False).")
+
+
+def repair_csv_tail(output_path):
+    """
+    Ripristina la coda del CSV dopo un'interruzione durante l'append:
+    rimuove l'ultima riga se è incompleta (senza a capo finale) e le righe
+    dell'ultimo timestamp se non sono presenti tutti gli indici.
+    Legge solo la parte finale del file.
+    Ritorna:
+      - numero di byte rimossi
+    """
+    n_indices = len(OUTPUT_INDICES)
+    with open(output_path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        start, tail = size, b""
+        # Quanto basta per contenere l'ultimo timestamp completo più una riga
+        while start > 0 and tail.count(b"\n") <= n_indices + 1:
+            start = max(0, start - (1 << 16))
+            f.seek(start)
+            tail = f.read(size - start)
+
+        end = tail.rfind(b"\n") + 1
+        lines = tail[:end].split(b"\n")[:-1]
+        offsets = np.cumsum([start] + [len(line) + 1 for line in lines])
+        # All'inizio del file la prima riga è l'intestazione
+        first_data = 1 if start == 0 else 0
+        cut = start + end
+        if len(lines) > first_data:
+            last_key = lines[-1].split(b",", 1)[0]
+            group = 0
+            while group < len(lines) - first_data and lines[-1 - group].split(b",", 1)[0] == last_key:
+                group += 1
+            if group < n_indices:
+                cut = int(offsets[len(lines) - group])
+        if cut < size:
+            f.truncate(cut)
+    return size - cut
+
+
+def existing_output(output_path, output_format="csv"):
+    """
+    Timestamp completi (tutti gli indici presenti) e "Numero Timestamp"
+    massimo dell'output esistente.
+    Ritorna:
+      - (DatetimeIndex, numero massimo); (vuoto, 0) se l'output non esiste
+    """
+    columns = ["Timestamp", "Numero Timestamp"]
+    if output_format == "parquet":
+        import storage
+        if not storage.available_years(output_path):
+            return pd.DatetimeIndex([]), 0
+        df = storage.load_table(output_path, columns=columns)
+    else:
+        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+            return pd.DatetimeIndex([]), 0
+        df = pd.read_csv(output_path, usecols=columns)
+    if df.empty:
+        return pd.DatetimeIndex([]), 0
+
+    counts = df["Timestamp"].value_counts(sort=False)
+    complete = counts.index[counts.to_numpy() >= len(OUTPUT_INDICES)]
+    return pd.DatetimeIndex(pd.to_datetime(complete)).sort_values(), int(df["Numero Timestamp"].max())
+
+
+def processed_timestamps(output_path, output_format="csv"):
+    """
+    Indice dei timestamp già presenti nell'output (CSV o archivio Parquet).
+    Un timestamp conta come elaborato solo se ha le righe di tutti gli indici.
+    Ritorna:
+      - DatetimeIndex (vuoto se l'output non esiste)
+    """
+    return existing_output(output_path, output_format)[0]
+
+
+def _prepare_incremental(output_path, output_format, verbose):
+    """
+    Controlla l'output esistente prima di una ripresa incrementale
+    (marker delle formule, coda del CSV) e ne legge i timestamp completi.
+    Ritorna:
+      - (timestamp elaborati, "Numero Timestamp" massimo)
+    """
+    if output_format == "parquet":
+        import storage
+        exists = bool(storage.available_years(output_path))
+    else:
+        exists = os.path.exists(output_path) and os.path.getsize(output_path) > 0
+    if not exists:
+        return pd.DatetimeIndex([]), 0
+
+    check_marker(output_path, output_format)
+    if output_format == "csv":
+        removed = repair_csv_tail(output_path)
+        if removed and verbose:
+            print(f"✂️ Rimossi {removed} byte di righe incomplete in coda a {output_path}.")
+    return existing_output(output_path, output_format)
+
+
+def run_extraction(temp_path, dew_path, output_path, chunk_size=DEFAULT_CHUNK_SIZE, verbose=True,
+                   n_workers=1, shard_by="year", output_format="csv", incremental=False):
+    """
+    Esegue l'estrazione e scrive i risultati in streaming (append per blocco).
+    Parametri:
+      - temp_path: NetCDF con T_2M
+      - dew_path: NetCDF con TD_2M
+      - output_path: CSV di output, oppure cartella dell'archivio Parquet
+      - chunk_size: numero di ore per blocco
+      - n_workers: numero di processi (1 = sequenziale, None = tutti i core)
+      - shard_by: suddivisione del lavoro tra i processi, "year" o "chunk"
+      - output_format: "csv" oppure "parquet" (archivio colonnare, vedi storage.py)
+      - incremental: se False l'output viene sovrascritto; se True vengono
+                     elaborati solo i timestamp non ancora presenti e i nuovi
+                     risultati vengono aggiunti senza riscrivere quelli esistenti,
+                     proseguendo il "Numero Timestamp" (permette anche di
+                     riprendere un'estrazione interrotta: una coda del CSV
+                     scritta a metà viene rimossa e ricalcolata).
+                     L'output esistente deve essere stato prodotto da questa
+                     pipeline (marker delle formule, vedi check_marker): il CSV
+                     del notebook 03 va prima ricalcolato con incremental=False
+    Ritorna:
+      - numero di righe scritte
+    """
+    if output_format not in ("csv", "parquet"):
+        raise ValueError(f"output_format non valido: {output_format!r} (usa 'csv' o 'parquet')")
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    if output_format == "parquet":
+        import storage
+
+    processed, last_number = None, 0
+    if incremental:
+        processed, last_number = _prepare_incremental(output_path, output_format, verbose)
+    elif output_format == "parquet":
+        storage.clear_store(output_path)
+    if last_number == 0:
+        # Output nuovo (o vuoto): da qui in poi contiene solo righe di questa pipeline
+        write_marker(output_path, output_format)
+
+    # In modalità incrementale il CSV esistente riceve solo nuove righe in append
+    write_header = not (incremental and os.path.exists(output_path) and os.path.getsize(output_path) > 0)
+    n_rows = 0
+    for df_chunk in _iter_results(temp_path, dew_path, chunk_size, verbose, n_workers, shard_by,
+                                  processed, last_number):
+        with span("extraction.write"):
+            if output_format == "parquet":
+                first = pd.Timestamp(df_chunk["Timestamp"].iloc[0])
+                storage.write_partitions(df_chunk, output_path, part_name=f"part-{first:%Y%m%d%H%M}")
+            else:
+                append = n_rows > 0 or not write_header
+                df_chunk.to_csv(output_path, mode="a" if append else "w",
+                                header=not append, index=False)
+        n_rows += len(df_chunk)
+
+    if verbose:
+        print(f"\n✅ Output aggiornato con successo: {output_path}")
+        print(f"📦 Righe aggiunte: {n_rows}")
+    if instrumentation.enabled():
+        if verbose:
+            print(instrumentation.summary().to_string(index=False, float_format=lambda v: f"{v:.2f}"))
+        instrumentation.write_metrics()
+    return n_rows
@@ -1,7 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-import numpy as np
 import xarray as xr
 
 def calculate_humidex(Ta_k, Td_k):
@@ -122,4 +119,342 @@ def calculate_utci(Ta_c, RH):
               + 0.022771 * Ta_c
               - 0.003578 * RH
               - 0.000119 * Ta_c * RH)
-    return UTCI_c
\ No newline at end of file
+    return UTCI_c
+
+# === Calcolo congiunto di tutti gli indici ===
+
+# Nomi degli indici prodotti da compute_all_indices (stesso ordine dei buffer)
+INDEX_NAMES = (
+    "Relative Humidity",
+    "Heat Index",
+    "Humidex",
+    "Wet Bulb Temperature",
+    "WBGT",
+    "Lethal Heat Stress Index",
+    "UTCI",
+)
+
+
+def allocate_index_buffers(shape, dtype=np.float32):
+    """
+    Prealloca i buffer di output per compute_all_indices.
+    Parametri:
+      - shape: forma della griglia, es. (time, rlat, rlon)
+      - dtype: tipo dei buffer (float32 di default)
+    Ritorna:
+      - dizionario {nome indice: array vuoto}
+    """
+    return {name: np.empty(shape, dtype=dtype) for name in INDEX_NAMES}
+
+
+def compute_all_indices(Ta_k, Td_k, out=None, dtype=np.float32):
+    """
+    Calcola in un solo passaggio tutti gli indici di heat stress,
+    condividendo le grandezze intermedie (Ta_c, Td_c, RH, WBT, pressione
+    di vapore) invece di ricalcolarle per ogni indice.
+    Le formule sono le stesse delle funzioni calculate_* di questo modulo.
+    Parametri:
+      - Ta_k: temperatura dell'aria in Kelvin (array o DataArray, qualsiasi forma)
+      - Td_k: temperatura di rugiada in Kelvin (stessa forma di Ta_k)
+      - out: dizionario di buffer preallocati (vedi allocate_index_buffers);
+             se None vengono allocati nuovi buffer
+      - dtype: precisione di calcolo (float32 di default)
+    Ritorna:
+      - dizionario {nome indice: array numpy} con le chiavi di INDEX_NAMES
+        (RH in %, tutti gli altri indici in °C)
+    """
+    Ta_k = np.asarray(Ta_k)
+    Td_k = np.asarray(Td_k)
+    if Ta_k.shape != Td_k.shape:
+        raise ValueError(f"Forme diverse per Ta_k {Ta_k.shape} e Td_k {Td_k.shape}")
+
+    if out is None:
+        out = allocate_index_buffers(Ta_k.shape, dtype)
+    else:
+        missing = [name for name in INDEX_NAMES if name not in out]
+        if missing:
+            raise KeyError(f"Buffer mancanti in out: {missing}")
+        for name in INDEX_NAMES:
+            if out[name].shape != Ta_k.shape:
+                raise ValueError(f"Il buffer '{name}' ha forma {out[name].shape}, attesa {Ta_k.shape}")
+        dtype = out[INDEX_NAMES[0]].dtype
+
+    # Unici temporanei a griglia piena: Ta_c, Td_c e due buffer di lavoro
+    Ta_c = np.subtract(Ta_k, 273.15, dtype=dtype)
+    Td_c = np.subtract(Td_k, 273.15, dtype=dtype)
+    tmp = np.empty_like(Ta_c)
+    tmp2 = np.empty_like(Ta_c)
+
+    rh = out["Relative Humidity"]
+    hi = out["Heat Index"]
+    hx = out["Humidex"]
+    wbt = out["Wet Bulb Temperature"]
+    wbgt = out["WBGT"]
+    lhs = out["Lethal Heat Stress Index"]
+    utci = out["UTCI"]
+
+    # --- Umidità relativa ---
+    # RH = 100 * exp(17.625*Td/(243.04+Td) - 17.625*Ta/(243.04+Ta))
+    np.add(Td_c, 243.04, out=tmp)
+    np.divide(Td_c, tmp, out=tmp)
+    np.add(Ta_c, 243.04, out=tmp2)
+    np.divide(Ta_c, tmp2, out=tmp2)
+    np.subtract(tmp, tmp2, out=rh)
+    np.multiply(rh, 17.625, out=rh)
+    np.exp(rh, out=rh)
+    np.multiply(rh, 100.0, out=rh)
+
+    # --- Humidex (pressione di vapore da Td) ---
+    # e = 6.11 * exp(5417.7530 * (1/273.16 - 1/(max(Td, -73.15) + 273.16)))
+    np.maximum(Td_c, -73.15, out=tmp)
+    np.add(tmp, 273.16, out=tmp)
+    np.reciprocal(tmp, out=tmp)
+    np.subtract(1.0 / 273.16, tmp, out=tmp)
+    np.multiply(tmp, 5417.7530, out=tmp)
+    np.exp(tmp, out=tmp)
+    np.multiply(tmp, 6.11, out=tmp)
+    np.subtract(tmp, 10.0, out=tmp)
+    np.multiply(tmp, 0.5555, out=tmp)
+    np.add(Ta_c, tmp, out=hx)
+
+    # --- Heat Index (formula in °F, schema di Horner sul polinomio) ---
+    # Td_c non serve più: viene riutilizzato come buffer per Ta in °F
+    Ta_f = Td_c
+    np.multiply(Ta_c, 9.0 / 5.0, out=Ta_f)
+    np.add(Ta_f, 32.0, out=Ta_f)
+    # coefficiente di RH^2: -5.48172e-2 + 8.528e-4*T - 1.99e-6*T^2
+    np.multiply(Ta_f, -1.99e-6, out=tmp)
+    np.add(tmp, 8.528e-4, out=tmp)
+    np.multiply(tmp, Ta_f, out=tmp)
+    np.add(tmp, -5.48172e-2, out=tmp)
+    np.multiply(tmp, rh, out=tmp)
+    # + coefficiente di RH: 10.14333127 - 0.22475541*T + 1.229e-3*T^2
+    np.multiply(Ta_f, 1.229e-3, out=tmp2)
+    np.add(tmp2, -0.22475541, out=tmp2)
+    np.multiply(tmp2, Ta_f, out=tmp2)
+    np.add(tmp2, 10.14333127, out=tmp2)
+    np.add(tmp, tmp2, out=tmp)
+    np.multiply(tmp, rh, out=tmp)
+    # + termini in sola T: -42.379 + 2.04901523*T - 6.8378e-3*T^2
+    np.multiply(Ta_f, -6.8378e-3, out=tmp2)
+    np.add(tmp2, 2.04901523, out=tmp2)
+    np.multiply(tmp2, Ta_f, out=tmp2)
+    np.add(tmp2, -42.379, out=tmp2)
+    np.add(tmp, tmp2, out=hi)
+    # °F -> °C
+    np.subtract(hi, 32.0, out=hi)
+    np.multiply(hi, 5.0 / 9.0, out=hi)
+
+    # --- Wet-Bulb Temperature (Stull) ---
+    np.add(rh, 8.313659, out=tmp)
+    np.sqrt(tmp, out=tmp)
+    np.multiply(tmp, 0.151977, out=tmp)
+    np.arctan(tmp, out=tmp)
+    np.multiply(Ta_c, tmp, out=wbt)
+    np.add(Ta_c, rh, out=tmp)
+    np.arctan(tmp, out=tmp)
+    np.add(wbt, tmp, out=wbt)
+    np.subtract(rh, 1.676331, out=tmp)
+    np.arctan(tmp, out=tmp)
+    np.subtract(wbt, tmp, out=wbt)
+    np.multiply(rh, 0.023101, out=tmp)
+    np.arctan(tmp, out=tmp)
+    np.power(rh, 1.5, out=tmp2)
+    np.multiply(tmp, tmp2, out=tmp)
+    np.multiply(tmp, 0.00391838, out=tmp)
+    np.add(wbt, tmp, out=wbt)
+    np.subtract(wbt, 4.686035, out=wbt)
+
+    # --- WBGT = 0.7 * WBT + 0.3 * Ta ---
+    np.multiply(wbt, 0.7, out=wbgt)
+    np.multiply(Ta_c, 0.3, out=tmp)
+    np.add(wbgt, tmp, out=wbgt)
+
+    # --- Lethal Heat Stress Index = WBT + 4.5 * (1 - (RH/100)^2) ---
+    np.multiply(rh, 0.01, out=tmp)
+    np.square(tmp, out=tmp)
+    np.subtract(1.0, tmp, out=tmp)
+    np.multiply(tmp, 4.5, out=tmp)
+    np.add(wbt, tmp, out=lhs)
+
+    # --- UTCI semplificato ---
+    # Ta + 0.607562 + 0.022771*Ta - 0.003578*RH - 0.000119*Ta*RH
+    np.multiply(Ta_c, rh, out=tmp)
+    np.multiply(tmp, -0.000119, out=tmp)
+    np.multiply(rh, -0.003578, out=tmp2)
+    np.add(tmp, tmp2, out=tmp)
+    np.multiply(Ta_c, 1.0 + 0.022771, out=utci)
+    np.add(utci, tmp, out=utci)
+    np.add(utci, 0.607562, out=utci)
+
+    return out
+
+
+# === Riempimento dei buchi nella temperatura di rugiada ===
+
+def _interpolate_nan_along_axis(data, axis, coord=None):
+    """
+    Interpolazione lineare dei NaN lungo un asse, vettorializzata su tutte le
+    altre dimensioni. Equivale a xarray.interpolate_na(method='linear'):
+    i NaN senza un valore valido prima e dopo (bordi) restano NaN.
+    Parametri:
+      - data: array numpy
+      - axis: asse lungo cui interpolare
+      - coord: coordinate 1D lungo l'asse (default: posizioni 0..n-1)
+    """
+    nan = np.isnan(data)
+    if not nan.any():
+        return data
+
+    n = data.shape[axis]
+    coord = np.arange(n, dtype=np.float64) if coord is None else np.asarray(coord, dtype=np.float64)
+
+    # Righe (1D lungo l'asse) che contengono almeno un NaN: le altre non si toccano
+    moved = np.moveaxis(data, axis, -1)
+    rows = moved.reshape(-1, n)
+    nan_rows = np.moveaxis(nan, axis, -1).reshape(-1, n)
+    row_sel = np.flatnonzero(nan_rows.any(axis=1))
+    sub = rows[row_sel]
+    sub_nan = nan_rows[row_sel]
+
+    # Indice del valore valido precedente e successivo per ogni cella
+    idx = np.arange(n)
+    prev = np.where(sub_nan, -1, idx)
+    np.maximum.accumulate(prev, axis=1, out=prev)
+    nxt = np.where(sub_nan, n, idx)
+    nxt = np.minimum.accumulate(nxt[:, ::-1], axis=1)[:, ::-1]
+
+    target = sub_nan & (prev >= 0) & (nxt < n)
+    r, c = np.nonzero(target)
+    p = prev[r, c]
+    q = nxt[r, c]
+    y0 = sub[r, p].astype(np.float64)
+    y1 = sub[r, q].astype(np.float64)
+    x0 = coord[p]
+    slope = (y1 - y0) / (coord[q] - x0)
+
+    filled = rows.copy()
+    sub_filled = filled[row_sel]
+    sub_filled[r, c] = slope * (coord[c] - x0) + y0
+    filled[row_sel] = sub_filled
+    return np.moveaxis(filled.reshape(moved.shape), -1, axis)
+
+
+def fill_dew_point(Td_k, threshold=243.15):
+    """
+    Sostituisce i valori di rugiada non validi (<= threshold, default 243.15 K)
+    con un'interpolazione lineare lungo rlat e poi lungo rlon, come
+    Td_k.where(Td_k > 243.15).interpolate_na('rlat').interpolate_na('rlon').
+    Lavora su un intero blocco (time, rlat, rlon) in un'unica operazione
+    e restituisce subito l'input se non ci sono celle da riempire.
+    Parametri:
+      - Td_k: DataArray con dimensioni rlat/rlon, oppure array numpy
+              con (rlat, rlon) come ultime due dimensioni
+    Ritorna:
+      - stesso tipo dell'input, con i buchi interpolati
+    """
+    is_dataarray = isinstance(Td_k, xr.DataArray)
+    values = Td_k.values if is_dataarray else np.asarray(Td_k)
+
+    # Percorso veloce: nessuna cella non valida (i NaN contano come non validi)
+    invalid = ~(values > threshold)
+    if not invalid.any():
+        return Td_k
+
+    if is_dataarray:
+        axis_lat = Td_k.get_axis_num("rlat")
+        axis_lon = Td_k.get_axis_num("rlon")
+        coord_lat = Td_k["rlat"].values if "rlat" in Td_k.coords else None
+        coord_lon = Td_k["rlon"].values if "rlon" in Td_k.coords else None
+    else:
+        axis_lat, axis_lon = values.ndim - 2, values.ndim - 1
+        coord_lat = coord_lon = None
+
+    filled = np.where(invalid, np.nan, values)
+    filled = _interpolate_nan_along_axis(filled, axis_lat, coord_lat)
+    filled = _interpolate_nan_along_axis(filled, axis_lon, coord_lon)
+
+    if is_dataarray:
+        return Td_k.copy(data=filled)
+    return filled
+
+
+# === Statistiche spaziali ===
+
+# Statistiche calcolate da spatial_stats: nome -> percentile (None = media)
+STAT_PERCENTILES = {
+    "mean": None,
+    "median": 50,
+    "p95": 95,
+    "p99": 99,
+    "max": 100,
+}
+
+
+def _lerp(a, b, t):
+    """Interpolazione lineare con la stessa formula usata da np.percentile."""
+    diff = b - a
+    res = a + diff * t
+    return np.where(t >= 0.5, b - diff * (1 - t), res)
+
+
+def spatial_stats(data, stats=STAT_PERCENTILES):
+    """
+    Calcola media, mediana, 95° e 99° percentile e massimo (ignorando i NaN)
+    per molte griglie in una sola chiamata: una sola partizione per riga
+    per tutti i percentili, e maschera dei NaN condivisa.
+    Equivale a np.nanmean / np.nanmedian / np.nanpercentile / np.nanmax.
+    Parametri:
+      - data: array (n, ...) -> una statistica per ognuno degli n elementi
+              (es. (time, rlat, rlon) oppure (indici, rlat, rlon))
+      - stats: dizionario {nome: percentile o None per la media}
+    Ritorna:
+      - dizionario {nome: array (n,) float64}; NaN se la griglia è tutta NaN
+    """
+    data = np.asarray(data)
+    n_rows = data.shape[0]
+    work = data.reshape(n_rows, -1).copy()
+    n_cells = work.shape[1]
+
+    nan = np.isnan(work)
+    if nan.any():
+        n_valid = n_cells - nan.sum(axis=1)
+        # I NaN vengono spinti in fondo alla partizione
+        work[nan] = np.inf
+    else:
+        n_valid = np.full(n_rows, n_cells)
+
+    result = {name: np.full(n_rows, np.nan) for name in stats}
+
+    if any(q is None for q in stats.values()):
+        sums = np.sum(np.where(nan, 0, work), axis=1, dtype=np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = sums / n_valid
+        for name, q in stats.items():
+            if q is None:
+                result[name] = np.where(n_valid > 0, mean, np.nan)
+
+    quantiles = {name: q for name, q in stats.items() if q is not None}
+    if not quantiles:
+        return result
+
+    # Righe con lo stesso numero di celle valide condividono gli stessi kth
+    for count in np.unique(n_valid):
+        if count == 0:
+            continue
+        rows = np.flatnonzero(n_valid == count)
+        block = work if len(rows) == n_rows else work[rows]
+
+        virtual = {name: q / 100.0 * (count - 1) for name, q in quantiles.items()}
+        kth = sorted({int(np.floor(v)) for v in virtual.values()}
+                     | {min(int(np.floor(v)) + 1, count - 1) for v in virtual.values()})
+        block.partition(kth, axis=1)
+
+        for name, v in virtual.items():
+            lo = int(np.floor(v))
+            hi = min(lo + 1, count - 1)
+            a = block[:, lo].astype(np.float64)
+            b = block[:, hi].astype(np.float64)
+            result[name][rows] = _lerp(a, b, v - lo)
+
+    return result
@@ -0,0 +1,320 @@
+"""
+Strumentazione dei percorsi critici: intervalli di tempo (span) con nome,
+aggregati per nome in istogrammi con bucket fissi.
+
+Uso nel codice:
+    with span("extraction.read"):
+        ...
+    timer = span("dashboard.matplotlib").start()   # per blocchi lunghi di una pagina
+    ...
+    timer.stop()
+
+La strumentazione è disattivata di default: span() restituisce allora un
+oggetto vuoto condiviso, per cui il costo è quello di una chiamata di
+funzione. Si attiva con HEATSTRESS_METRICS=1 (oppure enable()):
+  - le pagine chiamano start_page / finish_page: il tempo dell'intera
+    esecuzione della pagina viene registrato come "page.<nome>", le metriche
+    vengono scritte in METRICS_PATH (JSON, al più ogni FLUSH_INTERVAL secondi)
+    e, con HEATSTRESS_DEBUG_PANEL=1 oppure ?debug=1 nell'URL, viene mostrato
+    un pannello con la tabella dei tempi
+  - con HEATSTRESS_METRICS_PORT=<porta> un server HTTP locale espone /metrics
+    (formato Prometheus) e /metrics.json
+I processi di extraction.py registrano le proprie metriche, che vengono
+unite a quelle del processo principale con merge().
+"""
+import json
+import math
+import os
+import threading
+import time
+
+
+METRICS_PATH = os.environ.get("HEATSTRESS_METRICS_FILE", os.path.join("Heat_stress_App", "data", "metrics.json"))
+FLUSH_INTERVAL = 10.0  # secondi tra due scritture del file delle metriche
+
+# Limiti superiori (secondi) dei bucket degli istogrammi
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+_enabled = os.environ.get("HEATSTRESS_METRICS", "0") == "1"
+_lock = threading.Lock()
+_flush_lock = threading.Lock()  # separato da _lock: write_metrics chiama snapshot()
+_histograms = {}
+_last_flush = 0.0
+_server = None
+
+
+class Histogram:
+    """Conteggio, somma, minimo, massimo e bucket delle durate di uno span."""
+
+    __slots__ = ("count", "total", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def quantile(self, q):
+        """Quantile approssimato: limite superiore del bucket che lo contiene (al più il massimo)."""
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        cumulative = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            cumulative += n
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "total_s": self.total, "min_s": self.min if self.count else None,
+                "max_s": self.max, "buckets": list(self.buckets)}
+
+    def add(self, data):
+        """Somma un istogramma serializzato con to_dict (es. da un altro processo)."""
+        self.count += data["count"]
+        self.total += data["total_s"]
+        if data["min_s"] is not None:
+            self.min = min(self.min, data["min_s"])
+        self.max = max(self.max, data["max_s"])
+        self.buckets = [a + b for a, b in zip(self.buckets, data["buckets"])]
+
+
+def enabled():
+    return _enabled
+
+
+def enable(flag=True):
+    """Attiva o disattiva la strumentazione per il processo corrente."""
+    global _enabled
+    _enabled = bool(flag)
+
+
+def reset():
+    """Azzera tutte le metriche del processo."""
+    with _lock:
+        _histograms.clear()
+
+
+def record(name, seconds):
+    """Registra una durata (in secondi) per lo span name."""
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+
+class _Span:
+    __slots__ = ("name", "_start")
+
+    def __init__(self, name):
+        self.name = name
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        return self
+
+    def stop(self):
+        if self._start is not None:
+            record(self.name, time.perf_counter() - self._start)
+            self._start = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name):
+    """Intervallo di tempo con nome (context manager, oppure start()/stop())."""
+    return _Span(name) if _enabled else _NOOP
+
+
+def snapshot():
+    """Metriche correnti: {nome: istogramma serializzato}."""
+    with _lock:
+        return {name: histogram.to_dict() for name, histogram in _histograms.items()}
+
+
+def merge(metrics):
+    """Aggiunge le metriche di snapshot() di un altro processo."""
+    if not metrics:
+        return
+    with _lock:
+        for name, data in metrics.items():
+            histogram = _histograms.get(name)
+            if histogram is None:
+                histogram = _histograms[name] = Histogram()
+            histogram.add(data)
+
+
+def summary():
+    """
+    Tabella riassuntiva delle metriche (una riga per span, ordinate per tempo totale).
+    Ritorna:
+      - DataFrame con count, total_s, mean_ms, p50_ms, p95_ms, max_ms
+    """
+    import pandas as pd
+
+    with _lock:
+        rows = [{"span": name, "count": h.count, "total_s": h.total, "mean_ms": h.total / h.count * 1000,
+                 "p50_ms": h.quantile(0.5) * 1000, "p95_ms": h.quantile(0.95) * 1000, "max_ms": h.max * 1000}
+                for name, h in _histograms.items() if h.count]
+    columns = ["span", "count", "total_s", "mean_ms", "p50_ms", "p95_ms", "max_ms"]
+    return pd.DataFrame(rows, columns=columns).sort_values("total_s", ascending=False, ignore_index=True)
+
+
+def to_prometheus():
+    """Metriche nel formato testuale di Prometheus (istogramma heatstress_span_seconds)."""
+    lines = ["# TYPE heatstress_span_seconds histogram"]
+    for name, data in sorted(snapshot().items()):
+        cumulative = 0
+        for bound, n in zip(BUCKETS, data["buckets"]):
+            cumulative += n
+            le = "+Inf" if math.isinf(bound) else repr(bound)
+            lines.append(f'heatstress_span_seconds_bucket{{span="{name}",le="{le}"}} {cumulative}')
+        lines.append(f'heatstress_span_seconds_sum{{span="{name}"}} {data["total_s"]}')
+        lines.append(f'heatstress_span_seconds_count{{span="{name}"}} {data["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path=METRICS_PATH):
+    """
+    Scrive le metriche del processo in un file JSON (sostituzione atomica).
+    Il file temporaneo è diverso per ogni thread, per cui scritture
+    concorrenti non interferiscono: il file finale è quello dell'ultima.
+    """
+    global _last_flush
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    payload = {"pid": os.getpid(), "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "buckets": [None if math.isinf(bound) else bound for bound in BUCKETS], "spans": snapshot()}
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(payload, f, indent=1)
+    os.replace(tmp_path, path)
+    _last_flush = time.monotonic()
+    return path
+
+
+def _flush(path):
+    """
+    Scrive il file delle metriche se sono passati almeno FLUSH_INTERVAL
+    secondi dall'ultima scrittura (una sola sessione per intervallo).
+    Un errore di scrittura non deve interrompere la pagina.
+    """
+    global _last_flush
+    with _flush_lock:
+        if time.monotonic() - _last_flush < FLUSH_INTERVAL:
+            return
+        try:
+            write_metrics(path)
+        except OSError as e:
+            # Si riprova al prossimo intervallo
+            _last_flush = time.monotonic()
+            print(f"⚠️ Metriche non scritte in {path}: {e}")
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    """
+    Avvia (una sola volta per processo) un server HTTP che espone /metrics
+    (Prometheus) e /metrics.json.
+    """
+    global _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = to_prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, content_type = json.dumps(snapshot()).encode("utf-8"), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    with _lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, int(port)), Handler)
+            threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    return _server
+
+
+# === Pagine Streamlit ===
+
+def start_page(name):
+    """Inizio dell'esecuzione di una pagina; da passare a finish_page (None se disattivata)."""
+    if not _enabled:
+        return None
+    port = os.environ.get("HEATSTRESS_METRICS_PORT")
+    if port and _server is None:
+        serve_metrics(port)
+    return name, time.perf_counter()
+
+
+def finish_page(token, path=METRICS_PATH):
+    """
+    Fine dell'esecuzione di una pagina: registra "page.<nome>", scrive il
+    file delle metriche (al più ogni FLUSH_INTERVAL secondi) e mostra il
+    pannello di debug se richiesto.
+    """
+    if token is None:
+        return
+    name, start = token
+    record(f"page.{name}", time.perf_counter() - start)
+    _flush(path)
+    debug_panel()
+
+
+def debug_panel():
+    """Tabella dei tempi per span in un expander (HEATSTRESS_DEBUG_PANEL=1 oppure ?debug=1)."""
+    import streamlit as st
+
+    if os.environ.get("HEATSTRESS_DEBUG_PANEL", "0") != "1" and st.query_params.get("debug") != "1":
+        return
+    with st.expander("⏱️ Timings (debug)"):
+        st.dataframe(summary().style.format(precision=2), hide_index=True, width="stretch")
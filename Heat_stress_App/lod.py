@@ -0,0 +1,106 @@
+"""
+Livelli di dettaglio (LOD) per la superficie 3D della pagina HeatStress.
+
+La griglia rlat x rlon e la texture della mappa di sfondo vengono aggregate
+a blocchi fino a un numero massimo di vertici, e convertite in float32 prima
+di essere inviate al browser. Per il dominio Lombardia della demo la griglia
+resta quasi invariata, mentre per il dominio completo dell'Italia il
+payload JSON si riduce di ordini di grandezza.
+"""
+import math
+import warnings
+
+import numpy as np
+
+
+SURFACE_TARGET_VERTICES = 40_000
+BASEMAP_TARGET_VERTICES = 128 * 128
+
+
+def decimation_factor(shape, target_vertices):
+    """
+    Fattore di aggregazione (uguale sui due assi) per rientrare in target_vertices.
+    Ritorna:
+      - intero >= 1 (1 = nessuna decimazione)
+    """
+    n_vertices = shape[0] * shape[1]
+    if target_vertices is None or n_vertices <= target_vertices:
+        return 1
+    return int(math.ceil(math.sqrt(n_vertices / target_vertices)))
+
+
+def block_reduce(data, factor, dtype=np.float32):
+    """
+    Media a blocchi factor x factor sulle prime due dimensioni, ignorando i NaN.
+    I blocchi incompleti sui bordi sono mediati sulle sole celle presenti.
+    Parametri:
+      - data: array (ny, nx) oppure (ny, nx, canali)
+      - factor: lato del blocco
+    Ritorna:
+      - array ridotto in dtype
+    """
+    data = np.asarray(data, dtype=dtype)
+    if factor <= 1:
+        return data
+    ny, nx = data.shape[:2]
+    pad_y = -ny % factor
+    pad_x = -nx % factor
+    pad = [(0, pad_y), (0, pad_x)] + [(0, 0)] * (data.ndim - 2)
+    padded = np.pad(data, pad, constant_values=np.nan)
+    blocks = padded.reshape((ny + pad_y) // factor, factor, (nx + pad_x) // factor, factor, *data.shape[2:])
+    with warnings.catch_warnings():
+        # Blocchi interamente NaN: il risultato è NaN, senza avvisi
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3)).astype(dtype)
+
+
+def prepare_surface(temp_c, lon, lat, z_exaggeration, target_vertices=SURFACE_TARGET_VERTICES):
+    """
+    Prepara i dati della superficie della temperatura per go.Surface.
+    Parametri:
+      - temp_c: temperatura (rlat, rlon) in °C
+      - lon, lat: coordinate geografiche 2D della griglia
+      - z_exaggeration: esagerazione verticale della superficie
+      - target_vertices: numero massimo di vertici (None = piena risoluzione)
+    Ritorna:
+      - dizionario con x, y, z, color (array 2D float32), cmin, cmax e factor
+    """
+    factor = decimation_factor(np.shape(temp_c), target_vertices)
+    color = block_reduce(temp_c, factor)
+    x = block_reduce(lon, factor)
+    y = block_reduce(lat, factor)
+
+    # Scala colori sulla griglia a piena risoluzione, come prima della decimazione
+    cmin = float(np.nanmin(temp_c))
+    cmax = float(np.nanmax(temp_c))
+    range_ = cmax - cmin
+    z = ((cmax - color) / range_) * z_exaggeration if range_ > 0 else np.zeros_like(color)
+    return {
+        "x": x,
+        "y": y,
+        "z": z.astype(np.float32),
+        "color": color,
+        "cmin": cmin,
+        "cmax": cmax,
+        "factor": factor,
+    }
+
+
+def prepare_basemap(map_img, bbox, target_vertices=BASEMAP_TARGET_VERTICES):
+    """
+    Prepara la texture in scala di grigi della mappa di sfondo.
+    Parametri:
+      - map_img: immagine RGB (h, w, 3) con valori in [0, 1]
+      - bbox: (lon_min, lat_min, lon_max, lat_max)
+      - target_vertices: numero massimo di vertici
+    Ritorna:
+      - dizionario con x, y (1D float32), gray (2D float32, prima riga a sud)
+    """
+    lon_min, lat_min, lon_max, lat_max = bbox
+    gray = np.flipud(np.asarray(map_img, dtype=np.float32).mean(axis=2))
+    gray = block_reduce(gray, decimation_factor(gray.shape, target_vertices))
+    return {
+        "x": np.linspace(lon_min, lon_max, gray.shape[1], dtype=np.float32),
+        "y": np.linspace(lat_min, lat_max, gray.shape[0], dtype=np.float32),
+        "gray": np.ascontiguousarray(gray),
+    }
@@ -1,52 +1,33 @@
-from functions import (
-    calculate_heat_index,
-    calculate_humidex,
-    calculate_wbt,
-    calculate_wbgt,
-    calculate_lethal_heat_stress_index,
-    calculate_utci,
-    calculate_relative_humidity
-)
+from functions import compute_all_indices, fill_dew_point, spatial_stats
+from query import point_series
+from prefetch import Prefetcher, neighbours, session_owner
+import resources
+from warmup import start_warm_up
+from instrumentation import finish_page, span, start_page
+from rendering import render_colorbar_png, render_map_png, two_slope_normalize
 import streamlit as st
-import matplotlib.pyplot as plt
-import contextily as ctx
 import numpy as np
 import pandas as pd
-import xarray as xr
 from datetime import datetime
-import time
-import seaborn as sns
-from pyproj import Transformer
-from matplotlib.colors import Normalize, TwoSlopeNorm
 import os
-import gdown
-import urllib.request
 
 # --- CONFIG PAGINA ---
 st.set_page_config(layout="wide")
+# Precaricamento in background (una volta per processo) di dati e librerie delle pagine
+start_warm_up()
+page_metrics = start_page("dashboard")
 st.title("📊 Dashboard")
 st.markdown("#### From 1981 to 2023 everyday heat stress indices and climatological indicators")
 
-# === Funzione per caricare in modo sicuro i dataset ===
+# === Funzione per caricare in modo sicuro i dataset (condivisi tra pagine e utenti) ===
 def load_nc_datasets():
     try:
-        st.info("📂 Caricamento NetCDF dai file della repository...")
-
-        # Percorsi relativi compatibili con Streamlit Cloud
-        temp_path = os.path.join("Heat_stress_App", "data", "2m_air_temp_2023-04-01_2023-09-30.nc")
-        dew_path  = os.path.join("Heat_stress_App", "data", "2m_dew_point_temp_2023-04-01_2023-09-30.nc")
-
         # Controllo esistenza
-        if not os.path.exists(temp_path) or not os.path.exists(dew_path):
+        if not os.path.exists(resources.TEMP_PATH) or not os.path.exists(resources.DEW_PATH):
             st.error("❌ Uno o entrambi i file .nc non sono stati trovati nella directory 'data/'.")
             st.stop()
 
-        # Caricamento
-        ds_temp = xr.open_dataset(temp_path)
-        ds_dew = xr.open_dataset(dew_path)
-
-        st.success("✅ File NetCDF caricati correttamente.")
-        return ds_temp, ds_dew
+        return resources.load_nc_datasets()
 
     except Exception as e:
         st.error("❌ Errore durante il caricamento dei NetCDF.")
@@ -54,10 +35,14 @@ def load_nc_datasets():
         st.stop()
 
 # --- CARICAMENTO DATASET ---
-dataset3, dataset2 = load_nc_datasets()
+with span("dashboard.open_datasets"):
+    dataset3, dataset2 = load_nc_datasets()
+# Cubo precalcolato degli indici e climatologia per cella (opzionali, vedi cube.py e climatology.py)
+index_cube = resources.index_cube()
+climatology = resources.climatology()
 
 # --- 2. SELEZIONE DATA ---
-all_times = pd.to_datetime(dataset3['T_2M'].time.values)
+all_times = resources.time_values(resources.TEMP_PATH)
 all_dates = np.unique(all_times.date)
 st.write("THIS IS A DEMO VERSION OF THE APP AND THE AVAILABLE DATES RANGE FROM 23-4-1 TO 23-9-29")
 selected_date = st.date_input("Date to be visualized:", all_dates[0], min_value=all_dates[0], max_value=all_dates[-1])
@@ -71,26 +56,77 @@ available_times = [t.strftime("%H:%M") for t in times_for_day]
 selected_time_str = st.selectbox("Time to be visualized:", available_times, index=0)
 selected_time = datetime.combine(selected_date, datetime.strptime(selected_time_str, "%H:%M").time())
 
-with st.spinner("Wait for it..."):
-    time.sleep(2)
-st.success("Done!")
+# --- 2b. COLORMAP E RENDERING DELLE MAPPE ---
+cmaps = {
+    "Humidex": "plasma",
+    "WBGT": "viridis",
+    "Lethal Heat Stress Index": "coolwarm",
+    "UTCI": "cividis",
+    "Relative Humidity": "Blues"
+}
+# Mappe mostrate dalla pagina: titolo -> colormap
+map_cmaps = {"Temperature": "inferno", **cmaps}
+
+# Estensione in EPSG:3857 calcolata una sola volta per processo
+extent_3857 = resources.web_mercator_extent(resources.TEMP_PATH)
+
+def render_index_map(data, title, cmap, timestamp, alpha=0.6):
+    vmin = float(np.nanmin(data))
+    vmax = float(np.nanmax(data))
+    png = render_map_png(data, cmap, extent_3857, vmin=vmin, vmax=vmax, alpha=alpha,
+                         key=(str(timestamp), title))
+    return png, vmin, vmax
 
-# --- 3. ESTRAZIONE DATI ---
+
+# --- 3. ESTRAZIONE DATI (con precaricamento dei timestamp vicini) ---
 timestamp = pd.to_datetime(selected_time)
-temperature_snapshot = dataset3['T_2M'].sel(time=timestamp)
-dew_point_snapshot = dataset2['TD_2M'].sel(time=timestamp)
-dew_point_filtered = dew_point_snapshot.where(dew_point_snapshot > 243.15)
-dew_point_interpolated = dew_point_filtered.interpolate_na(dim='rlat', method='linear').interpolate_na(dim='rlon', method='linear')
 
-RH = calculate_relative_humidity(temperature_snapshot - 273.15, dew_point_interpolated - 273.15)
+# Ore adiacenti e stessa ora nei giorni adiacenti
+PREFETCH_OFFSETS = ("1h", "-1h", "1D", "-1D", "2h", "-2h", "3h", "-3h")
+
+@st.cache_resource
+def get_map_prefetcher():
+    return Prefetcher(max_items=48)
 
-heat_index_data = calculate_heat_index(temperature_snapshot - 273.15, RH)
-humidex_data = calculate_humidex(temperature_snapshot, dew_point_interpolated)
-wbt_data = calculate_wbt(temperature_snapshot - 273.15, RH)
-wbgt_data = calculate_wbgt(temperature_snapshot - 273.15, wbt_data)
-lhs_data = calculate_lethal_heat_stress_index(wbt_data, RH)
-utci_data = calculate_utci(temperature_snapshot - 273.15, RH)
-rh_data = RH
+def load_timestamp_data(timestamp):
+    # Nessun comando st.* qui: la funzione gira anche nei thread di precaricamento
+    if index_cube is not None and timestamp in index_cube:
+        # Lettura diretta delle griglie precalcolate (memory-map, nessun ricalcolo)
+        with span("dashboard.cube_read"):
+            data = dict(index_cube.get(timestamp))
+    else:
+        with span("dashboard.read"):
+            temperature_snapshot = dataset3['T_2M'].sel(time=timestamp).load()
+            dew_point_snapshot = dataset2['TD_2M'].sel(time=timestamp).load()
+        with span("dashboard.fill_dew_point"):
+            dew_point_interpolated = fill_dew_point(dew_point_snapshot)
+
+        # Tutti gli indici in un solo passaggio (intermedi condivisi, float32)
+        with span("dashboard.indices"):
+            data = compute_all_indices(temperature_snapshot, dew_point_interpolated)
+            data["Temperature"] = temperature_snapshot.values - 273.15
+
+    # Le mappe vengono renderizzate subito e restano nella cache dei PNG
+    with span("dashboard.render_maps"):
+        for title, cmap in map_cmaps.items():
+            render_index_map(data[title], title, cmap, timestamp)
+    return data
+
+prefetcher = get_map_prefetcher()
+with st.spinner("Wait for it..."), span("dashboard.load_timestamp"):
+    indices_data = prefetcher.get(timestamp, load_timestamp_data)
+st.success("Done!")
+prefetcher.prefetch(neighbours(all_times, timestamp, PREFETCH_OFFSETS), load_timestamp_data,
+                    owner=session_owner())
+
+temperature_c = indices_data["Temperature"]
+heat_index_data = indices_data["Heat Index"]
+humidex_data = indices_data["Humidex"]
+wbt_data = indices_data["Wet Bulb Temperature"]
+wbgt_data = indices_data["WBGT"]
+lhs_data = indices_data["Lethal Heat Stress Index"]
+utci_data = indices_data["UTCI"]
+rh_data = indices_data["Relative Humidity"]
 
 # --- 4. SOGLIE ---
 thresholds = {
@@ -102,79 +138,70 @@ thresholds = {
     "Temperature": "Reference at 2m height"
 }
 
-# --- 5. COLORMAP ---
-cmaps = {
-    "Humidex": "plasma",
-    "WBGT": "viridis",
-    "Lethal Heat Stress Index": "coolwarm",
-    "UTCI": "cividis",
-    "Relative Humidity": "Blues"
-}
-
-# --- 6. FUNZIONE MAPPA CON BASEMAP ---
-def plot_map_with_basemap(data, title, cmap="inferno", size=6, title_size=14, alpha=0.6):
-    lat = dataset3['lat'].values
-    lon = dataset3['lon'].values
-
-    fig, ax = plt.subplots(figsize=(size, size))
-    vmin = np.nanmin(data.values)
-    vmax = np.nanmax(data.values)
+# --- 6. FUNZIONE MAPPA CON BASEMAP (rendering diretto in PNG, con cache) ---
+def plot_map_with_basemap(data, title, cmap="inferno", alpha=0.6):
+    png, vmin, vmax = render_index_map(data, title, cmap, timestamp, alpha)
 
-    lon1d = lon[0, :] if lon.ndim == 2 else lon
-    lat1d = lat[:, 0] if lat.ndim == 2 else lat
-    extent = [lon1d.min(), lon1d.max(), lat1d.min(), lat1d.max()]
-
-    transformer = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
-    xmin, ymin = transformer.transform(extent[0], extent[2])
-    xmax, ymax = transformer.transform(extent[1], extent[3])
-    extent_3857 = [xmin, xmax, ymin, ymax]
-
-    ax.set_xlim(xmin, xmax)
-    ax.set_ylim(ymin, ymax)
-    ctx.add_basemap(ax, crs="EPSG:3857", source=ctx.providers.OpenStreetMap.Mapnik, attribution=False)
-
-    im = ax.imshow(data.values, extent=extent_3857, origin="lower", cmap=cmap, alpha=alpha, vmin=vmin, vmax=vmax)
-    ax.set_title(title, fontsize=title_size, fontweight='bold', pad=12)
-    ax.axis("off")
-
-    cbar = plt.colorbar(im, ax=ax, orientation="horizontal", pad=0.02, aspect=30, shrink=1.0)
+    st.markdown(f"<h4 style='text-align: center'>{title}</h4>", unsafe_allow_html=True)
+    st.image(png, width="stretch")
+    st.image(render_colorbar_png(cmap), width="stretch")
     if "Humidity" in title:
-        cbar.set_label("Relative Humidity [%]", fontsize=8)
-        tick_locs = cbar.get_ticks()
-        cbar.set_ticks(tick_locs)
-        cbar.set_ticklabels([f"{int(t)}%" for t in tick_locs])
+        scale_text = f"Relative Humidity [%]: {int(vmin)}% – {int(vmax)}%"
     else:
-        cbar.set_label("Unit: °C", fontsize=8)
-    cbar.outline.set_visible(False)
-    cbar.ax.tick_params(labelsize=7)
+        scale_text = f"Unit: °C: {vmin:.1f} – {vmax:.1f}"
+    st.caption(scale_text)
 
     threshold_text = thresholds.get(title, "")
-    ax.text(0.5, -0.25, threshold_text, ha='center', fontsize=9, transform=ax.transAxes)
-
-    fig.tight_layout()
-    return fig
+    st.markdown(f"<p style='text-align: center; font-size: 0.9em'>{threshold_text}</p>", unsafe_allow_html=True)
 
 # --- 7. VISUALIZZAZIONE ---
 st.markdown("### 🌡️ Climatological indicators")
 col_env = st.columns([1, 1])
 with col_env[0]:
-    st.pyplot(plot_map_with_basemap(temperature_snapshot - 273.15, "Temperature", cmap="inferno"))
+    plot_map_with_basemap(temperature_c, "Temperature", cmap="inferno")
 with col_env[1]:
-    st.pyplot(plot_map_with_basemap(rh_data, "Relative Humidity", cmap="Blues"))
+    plot_map_with_basemap(rh_data, "Relative Humidity", cmap="Blues")
 
 st.markdown("---")
 st.markdown("### 🔥 Heat Stress Indices")
 col_ind1 = st.columns([1, 1])
 with col_ind1[0]:
-    st.pyplot(plot_map_with_basemap(humidex_data, "Humidex", cmap=cmaps["Humidex"]))
+    plot_map_with_basemap(humidex_data, "Humidex", cmap=cmaps["Humidex"])
 with col_ind1[1]:
-    st.pyplot(plot_map_with_basemap(wbgt_data, "WBGT", cmap=cmaps["WBGT"]))
+    plot_map_with_basemap(wbgt_data, "WBGT", cmap=cmaps["WBGT"])
 col_ind2 = st.columns([1, 1])
 with col_ind2[0]:
-    st.pyplot(plot_map_with_basemap(lhs_data, "Lethal Heat Stress Index", cmap=cmaps["Lethal Heat Stress Index"]))
+    plot_map_with_basemap(lhs_data, "Lethal Heat Stress Index", cmap=cmaps["Lethal Heat Stress Index"])
 with col_ind2[1]:
-    st.pyplot(plot_map_with_basemap(utci_data, "UTCI", cmap=cmaps["UTCI"]))
-
+    plot_map_with_basemap(utci_data, "UTCI", cmap=cmaps["UTCI"])
+
+# --- 7b. ANOMALIE RISPETTO AL CLIMA LOCALE ---
+if climatology is not None:
+    st.markdown("---")
+    st.markdown(f"### 🧭 Local anomalies ({climatology.percentile}th percentile of daily maxima, "
+                f"{climatology.base_period[0]}–{climatology.base_period[1]})")
+    anomaly_options = {
+        "Temperature": temperature_c,
+        "Humidex": humidex_data,
+        "WBGT": wbgt_data,
+        "Lethal Heat Stress Index": lhs_data,
+        "UTCI": utci_data
+    }
+    anomaly_name = st.selectbox("Variable:", list(anomaly_options), key="anomaly_selector")
+    with span("dashboard.anomaly"):
+        anomaly = climatology.anomaly(timestamp, anomaly_name, anomaly_options[anomaly_name])
+        limit = float(np.nanmax(np.abs(anomaly))) if np.isfinite(anomaly).any() else 1.0
+        png = render_map_png(anomaly, "RdBu_r", extent_3857,
+                             vmin=-limit, vmax=limit, key=(str(timestamp), f"anomaly {anomaly_name}"))
+    col_anomaly = st.columns([1, 1])
+    with col_anomaly[0]:
+        st.image(png, width="stretch")
+        st.image(render_colorbar_png("RdBu_r"), width="stretch")
+        st.caption(f"Difference from the local climatological value (°C): {-limit:.1f} – {limit:.1f}")
+    with col_anomaly[1]:
+        valid = anomaly[np.isfinite(anomaly)]
+        share = float(np.mean(valid > 0) * 100) if valid.size else 0.0
+        st.metric("Cells above their local climatology", f"{share:.0f}%")
 
 # --- 8. STATISTICA ---
 st.markdown("---")
@@ -186,45 +213,37 @@ summary_matrix = {
     "UTCI (°C)": (utci_data, 46)
 }
 
+# Tutte le statistiche dei quattro indici in una sola chiamata
+with span("dashboard.statistics"):
+    summary_stats = spatial_stats(np.stack([array for array, _ in summary_matrix.values()]))
 matrix_values = {
-    "Mean": [],
-    "Median": [],
-    "95th percentile": [],
-    "99th percentile": [],
-    "Maximum": []
+    "Mean": summary_stats["mean"],
+    "Median": summary_stats["median"],
+    "95th percentile": summary_stats["p95"],
+    "99th percentile": summary_stats["p99"],
+    "Maximum": summary_stats["max"]
 }
 
-thresholds_list = []
-
-for key, (array, threshold) in summary_matrix.items():
-    flat = array.values.flatten()
-    clean = flat[~np.isnan(flat)]
-    matrix_values["Mean"].append(np.mean(clean))
-    matrix_values["Median"].append(np.median(clean))
-    matrix_values["95th percentile"].append(np.percentile(clean, 95))
-    matrix_values["99th percentile"].append(np.percentile(clean, 99))
-    matrix_values["Maximum"].append(np.max(clean))
-    thresholds_list.append(threshold)
-
-
+thresholds_list = [threshold for _, threshold in summary_matrix.values()]
 
 matrix_df = pd.DataFrame(matrix_values).T
 matrix_df.columns = list(summary_matrix.keys())
 
 # --- NUOVA VISUALIZZAZIONE HEATMAP CON NORMALIZZAZIONE PER COLONNA ---
+# matplotlib serve solo da qui in poi: importato dopo il rendering delle mappe
+matplotlib_timer = span("dashboard.matplotlib").start()
+import matplotlib.pyplot as plt
+
 fig, ax = plt.subplots(figsize=(9, 3.2))
 num_rows, num_cols = matrix_df.shape
 
-# Disegna manualmente le celle
-for row in range(num_rows):
-    for col in range(num_cols):
-        val = matrix_df.iloc[row, col]
-        threshold = thresholds_list[col]
-        norm = TwoSlopeNorm(vmin=0, vcenter=threshold, vmax=threshold * 2)
-        color = plt.cm.seismic(norm(val))
-        ax.add_patch(plt.Rectangle((col, row), 1, 1, color=color))
-        ax.text(col + 0.5, row + 0.5, f"{val:.1f}",
-                ha='center', va='center', fontsize=11, weight='bold', color='black')
+# Colori di tutte le celle in un'unica operazione (normalizzazione a due pendenze per colonna)
+thresholds_arr = np.asarray(thresholds_list, dtype=float)
+norm_values = two_slope_normalize(matrix_df.values, 0.0, thresholds_arr, thresholds_arr * 2)
+ax.imshow(plt.cm.seismic(norm_values), extent=(0, num_cols, num_rows, 0), aspect='auto', interpolation='nearest')
+for (row, col), val in np.ndenumerate(matrix_df.values):
+    ax.text(col + 0.5, row + 0.5, f"{val:.1f}",
+            ha='center', va='center', fontsize=11, weight='bold', color='black')
 
 # Imposta assi
 ax.set_xlim(0, num_cols)
@@ -253,6 +272,33 @@ legend_ax.set_yticks([])
 for spine in legend_ax.spines.values():
     spine.set_visible(False)
 st.pyplot(legend_fig)
+matplotlib_timer.stop()
+
+# --- 9. SERIE TEMPORALE IN UN PUNTO ---
+@st.cache_data(show_spinner=False)
+def load_point_series(lon, lat):
+    dataset_temp, dataset_dew = load_nc_datasets()
+    return point_series(dataset_temp, dataset_dew, resources.grid_locator(resources.TEMP_PATH), lon, lat)
 
 st.markdown("---")
-st.info("Use the menu on the left to explore how each indices performance time series!")
\ No newline at end of file
+st.markdown("### 📍 Time series at a location")
+grid_lon, grid_lat = resources.geographic_grid(resources.TEMP_PATH)
+col_point = st.columns(3)
+with col_point[0]:
+    point_lon = st.number_input("Longitude (°E):", value=round(float(np.nanmean(grid_lon)), 3), format="%.3f")
+with col_point[1]:
+    point_lat = st.number_input("Latitude (°N):", value=round(float(np.nanmean(grid_lat)), 3), format="%.3f")
+with col_point[2]:
+    point_variable = st.selectbox("Variable:", ["Temperature", "Humidex", "WBGT", "Lethal Heat Stress Index",
+                                                "UTCI", "Relative Humidity"], key="point_selector")
+try:
+    with span("dashboard.point_series"):
+        point_data = load_point_series(point_lon, point_lat)
+    st.line_chart(point_data[point_variable])
+except ValueError as e:
+    st.warning(f"⚠️ {e}")
+
+st.markdown("---")
+st.info("Use the menu on the left to explore how each indices performance time series!")
+
+finish_page(page_metrics)
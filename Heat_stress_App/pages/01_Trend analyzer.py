@@ -1,20 +1,30 @@
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib.colors import to_rgb
-import requests
-import io
-import gdown
 import os
+import resources
+from trends import STAT_LABELS, TrendAggregates
+from events import detect_danger_days, heatwave_events, yearly_summary
+from warmup import start_warm_up
+from instrumentation import finish_page, span, start_page
 
 
 st.set_page_config(layout="wide")
+# Precaricamento in background (una volta per processo) di dati e librerie delle pagine
+start_warm_up()
+page_metrics = start_page("trend_analyzer")
 st.title("📈 Trend Analyzer")
 st.markdown("#### Heat stress indices throughout time")
 
+STORE_PATH = "Heat_stress_App/data/heatstress_store"
+CSV_PATH = "Heat_stress_App/data/heatstress_all_timestamps_year_reduced.csv"
+
+# === CONFIG ===
+stat_column = "99° Perc. (°C)"
+method_label = "99th percentile"
+
 @st.cache_data
-def load_data():
+def load_data(columns=("Timestamp", "Indice", *STAT_LABELS)):
     # === [COMMENTATO] SCARICAMENTO DA GOOGLE DRIVE ===
     # file_id = "1JhXcQK3YoCJQvgrD7u9CY407_AwaYKdF"
     # url = f"https://drive.google.com/uc?id={file_id}"
@@ -23,22 +33,31 @@ def load_data():
     # if not os.path.exists(output):
     #     gdown.download(url, output, quiet=False)
 
-    # === [ATTIVO] PERCORSO LOCALE ===
-    output = "Heat_stress_App/data/heatstress_all_timestamps_year_reduced.csv"
+    # === [ATTIVO] ARCHIVIO COLONNARE (solo le colonne necessarie) ===
+    if os.path.isdir(STORE_PATH):
+        from storage import load_table
+        df = load_table(STORE_PATH, columns=list(columns))
+    # === FALLBACK: CSV LOCALE ===
+    else:
+        df = pd.read_csv(CSV_PATH, usecols=list(columns))
+        df["Timestamp"] = pd.to_datetime(df["Timestamp"])
 
-    # === CARICAMENTO DEL FILE ===
-    df = pd.read_csv(output)
-    df["Timestamp"] = pd.to_datetime(df["Timestamp"])
-    df["Date"] = df["Timestamp"].dt.date
-    df["Year"] = df["Timestamp"].dt.year
-    df["DayOfYear"] = df["Timestamp"].dt.dayofyear
     return df
 
-df = load_data()
+# === AGGREGAZIONI PRECALCOLATE (massimi giornalieri e superamenti per anno) ===
+@st.cache_resource(show_spinner=False)
+def load_aggregates():
+    return TrendAggregates(load_data())
+
+with span("trend.load_aggregates"):
+    aggregates = load_aggregates()
+
+# === DANGER DAYS MULTI-INDICE (stessa logica del notebook 04) ===
+@st.cache_data(show_spinner=False)
+def load_danger_days(stat_column, min_thresholds_exceeded):
+    danger_days = detect_danger_days(load_data(), stat_column, min_thresholds_exceeded)
+    return danger_days, heatwave_events(danger_days)
 
-# === CONFIG ===
-stat_column = "99° Perc. (°C)"
-method_label = "99th percentile"
 UTCI_FAKE_THRESHOLD = 42
 UTCI_INDEX = "UTCI"
 stat_thresholds = {
@@ -70,9 +89,14 @@ for i, index in enumerate(indices):
 st.markdown("---")
 
 # === HISTORICAL ANNUAL PERFORMANCE ===
+# matplotlib serve solo per i grafici: importato dopo aver mostrato la selezione dell'indice
+import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgb
+
 title_placeholder = st.empty()
 plot_placeholder = st.empty()
 
+annual_timer = span("trend.annual_plot").start()
 if not selected_index:
     fig, ax = plt.subplots(figsize=(10, 3))
     ax.set_xlim(0, 10)
@@ -88,12 +112,20 @@ if not selected_index:
     ax.set_title("Waiting for index selection", fontsize=10, color='lightgray')
     ax.grid(False)
     plot_placeholder.pyplot(fig)
+    annual_timer.stop()
 else:
-    df_index = df[df["Indice"] == selected_index]
-    threshold = stat_thresholds[selected_index]
-    grouped = df_index.groupby(["Year", "DayOfYear"])[stat_column].max().reset_index()
-    grouped["Exceed"] = grouped[stat_column] > threshold
-    annual_counts = grouped.groupby("Year")["Exceed"].sum()
+    # Statistica e soglia scelte dall'utente (default: 99° percentile e soglia dell'indice)
+    stat_options = list(STAT_LABELS)
+    stat_cols = st.columns(2)
+    with stat_cols[0]:
+        stat_column = st.selectbox("Statistic", stat_options, index=stat_options.index(stat_column),
+                                   format_func=STAT_LABELS.get, key="stat_selector")
+    with stat_cols[1]:
+        threshold = st.number_input("Threshold (°C)", value=float(stat_thresholds[selected_index]),
+                                    step=0.5, key=f"threshold_{selected_index}")
+    method_label = STAT_LABELS[stat_column]
+    with span("trend.exceedances"):
+        annual_counts = aggregates.annual_exceedances(selected_index, stat_column, threshold)
 
     title_placeholder.markdown(f"### 📌 How many times **{selected_index}** overpassed its threshold in the years")
     fig, ax = plt.subplots(figsize=(10, 3))
@@ -109,15 +141,16 @@ else:
     ax.set_ylabel("Number of exceedances", fontsize=9, color='gray')
     ax.grid(False)
     plot_placeholder.pyplot(fig)
+    annual_timer.stop()
 
     # === PER-YEAR DETAILED CURVE ===
     st.markdown("### 🗓️ Explore a specific year")
     st.write("THIS IS A DEMO VERSION OF THE APP AND THE AVAILABLE DATES RANGE FROM 1986 TO 2023")
-    years = df_index["Year"].sort_values().unique()
+    years = aggregates.years(selected_index)
     selected_year = st.selectbox("", years, key="year_selector")
 
-    df_year = df_index[df_index["Year"] == selected_year]
-    daily_max = df_year.groupby("Date")[stat_column].max()
+    year_timer = span("trend.year_plot").start()
+    daily_max = aggregates.daily_series(selected_index, stat_column, selected_year)
 
     fig2, ax2 = plt.subplots(figsize=(10, 3))
     ax2.plot(daily_max.index, daily_max.values, color=color, alpha=0.5)
@@ -145,7 +178,90 @@ else:
 
     ax2.grid(False)
     st.pyplot(fig2)
+    year_timer.stop()
+
+st.markdown("---")
+
+# === DANGEROUS DAYS (MULTI-INDEX) ===
+st.markdown("### 🔥 Dangerous days")
+danger_cols = st.columns(2)
+with danger_cols[0]:
+    danger_stat = st.selectbox("Statistic", list(STAT_LABELS), index=list(STAT_LABELS).index("99° Perc. (°C)"),
+                               format_func=STAT_LABELS.get, key="danger_stat_selector")
+with danger_cols[1]:
+    min_thresholds_exceeded = st.slider("Minimum number of indices above threshold", 1, 6, 3,
+                                        key="danger_min_exceeded")
+
+with span("trend.danger_days"):
+    danger_days, events = load_danger_days(danger_stat, min_thresholds_exceeded)
+    # Intervallo di anni dalle aggregazioni in cache, senza rileggere la tabella
+    all_years = np.concatenate([aggregates.years(index) for index in aggregates.indices])
+    summary = yearly_summary(danger_days, range(all_years.min(), all_years.max() + 1))
+
+danger_timer = span("trend.danger_plot").start()
+fig3, ax3 = plt.subplots(figsize=(10, 3))
+ax3.bar(summary.index, summary["DangerousDays"], color="#FFA573", edgecolor="none", width=0.65)
+ax3.set_ylabel("Dangerous timestamps", fontsize=9, color='gray')
+ax3.set_xlabel("Year", fontsize=9, color='gray')
+ax3.set_ylim(bottom=0)
+ax4 = ax3.twinx()
+ax4.plot(summary.index, summary["AvgCumulativeIntensity"], color="#6C8EBF", marker='o', markersize=3)
+ax4.set_ylabel("Avg. cumulative intensity (°C)", fontsize=9, color='gray')
+ax4.set_ylim(bottom=0)
+for axis in (ax3, ax4):
+    axis.spines['top'].set_visible(False)
+    axis.spines['left'].set_color('gray')
+    axis.spines['bottom'].set_color('gray')
+    axis.spines['right'].set_color('gray')
+    axis.tick_params(axis='both', colors='gray', labelsize=8, length=0)
+ax3.set_title(f"Timestamps with ≥ {min_thresholds_exceeded} indices above threshold – {STAT_LABELS[danger_stat]}",
+              fontsize=10)
+st.pyplot(fig3)
+danger_timer.stop()
+
+if len(events):
+    st.markdown("#### Longest heatwave events")
+    st.dataframe(events.sort_values(["Duration", "CumulativeIntensity"], ascending=False).head(10),
+                 hide_index=True)
+
+# === WHERE HEAT STRESS ACCUMULATES (aggregati per cella, opzionali, vedi rollup.py) ===
+rollup = resources.rollup()
+rollup_indices = [] if rollup is None else [name for name in stat_thresholds if name in rollup.thresholds]
+if rollup_indices:
+    from rendering import render_colorbar_png, render_map_png
+
+    st.markdown("---")
+    st.markdown("### 🗺️ Where heat stress accumulates")
+    rollup_cols = st.columns(2)
+    with rollup_cols[0]:
+        map_index = st.selectbox("Index", rollup_indices, key="rollup_index_selector",
+                                 index=rollup_indices.index(selected_index) if selected_index in rollup_indices else 0)
+    with rollup_cols[1]:
+        period_options = ["All years (average)"] + list(rollup.periods["yearly"][::-1])
+        map_period = st.selectbox("Year", period_options, key="rollup_year_selector")
+
+    with span("trend.rollup_map"):
+        if map_period == period_options[0]:
+            hours = rollup.average("yearly", map_index, "hours")
+        else:
+            hours = rollup.get("yearly", map_period, map_index, "hours").astype(np.float32)
+        vmax = max(float(np.nanmax(hours)), 1.0) if np.isfinite(hours).any() else 1.0
+        png = render_map_png(hours, "inferno", resources.web_mercator_extent(resources.TEMP_PATH),
+                             vmin=0, vmax=vmax, key=("rollup", map_index, map_period))
+        yearly_hours = rollup.series("yearly", map_index, "hours")
+
+    map_cols = st.columns([1, 1])
+    with map_cols[0]:
+        st.image(png, width="stretch")
+        st.image(render_colorbar_png("inferno"), width="stretch")
+        st.caption(f"Hours per year with {map_index} above {rollup.thresholds[map_index]:g} °C in each cell: "
+                   f"0 – {vmax:.0f}")
+    with map_cols[1]:
+        st.markdown(f"##### Average hours per cell above threshold – {map_index}")
+        st.bar_chart(yearly_hours, color=index_colors.get(map_index, "#FFA573"))
 
 st.markdown("---")
 
 st.info("Use the menu on the left to go back to the previous pages!")
+
+finish_page(page_metrics)
@@ -0,0 +1,156 @@
+"""
+Precaricamento in background dei timestamp vicini a quello visualizzato.
+
+Dopo aver servito il timestamp t, le pagine chiedono al Prefetcher di
+calcolare in un pool di thread i dati (e le immagini) delle ore/giorni
+adiacenti, così che lo spostamento successivo dello slider o della data
+trovi già tutto in cache. La cache è una LRU limitata; a ogni nuova
+navigazione i precaricamenti ancora in coda che non servono più vengono
+annullati. Il Prefetcher è condiviso tra le sessioni: ogni sessione passa
+il proprio owner e ritira solo le chiavi che aveva chiesto, così più utenti
+che navigano date diverse non annullano i precaricamenti degli altri.
+
+Il loader viene passato a ogni chiamata (e non salvato nel Prefetcher),
+perché le pagine Streamlit ridefiniscono le proprie funzioni a ogni rerun.
+I loader non devono usare comandi st.*: girano fuori dal contesto dello script.
+"""
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+
+DEFAULT_MAX_ITEMS = 64
+DEFAULT_WORKERS = 2
+
+
+class Prefetcher:
+    """
+    Cache LRU limitata con calcolo in background delle chiavi richieste.
+    """
+
+    def __init__(self, max_items=DEFAULT_MAX_ITEMS, max_workers=DEFAULT_WORKERS):
+        self.max_items = max_items
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._owners = {}  # chiave in coda -> sessioni che l'hanno chiesta
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._cache
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
+
+    def _store(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_items:
+                self._cache.popitem(last=False)
+
+    def _run(self, key, loader):
+        try:
+            value = loader(key)
+            self._store(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+                self._owners.pop(key, None)
+
+    def get(self, key, loader):
+        """
+        Valore associato a key: dalla cache, dal precaricamento in corso
+        oppure calcolato subito con loader(key).
+        """
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            future = self._pending.get(key)
+
+        if future is not None:
+            if future.cancel():
+                # Precaricamento ancora in coda: meglio calcolarlo subito
+                with self._lock:
+                    self._pending.pop(key, None)
+                    self._owners.pop(key, None)
+            else:
+                # Precaricamento in corso: si attende il risultato (in caso di errore si ricalcola)
+                try:
+                    return future.result()
+                except Exception:
+                    pass
+
+        value = loader(key)
+        self._store(key, value)
+        return value
+
+    def prefetch(self, keys, loader, owner=None):
+        """
+        Avvia in background il calcolo delle chiavi non ancora in cache e
+        ritira le chiavi chieste in precedenza da owner che non servono più:
+        un precaricamento in coda viene annullato solo quando nessuna
+        sessione lo richiede.
+        Parametri:
+          - owner: identificativo della sessione (es. in st.session_state)
+        """
+        keys = list(keys)
+        wanted = set(keys)
+        with self._lock:
+            for key, owners in list(self._owners.items()):
+                if key in wanted or owner not in owners:
+                    continue
+                owners.discard(owner)
+                if not owners and self._pending[key].cancel():
+                    del self._pending[key]
+                    del self._owners[key]
+            for key in keys:
+                if key in self._cache:
+                    continue
+                if key not in self._pending:
+                    self._pending[key] = self._executor.submit(self._run, key, loader)
+                self._owners.setdefault(key, set()).add(owner)
+
+    def cancel(self):
+        """Annulla tutti i precaricamenti non ancora iniziati."""
+        with self._lock:
+            for key, future in list(self._pending.items()):
+                if future.cancel():
+                    del self._pending[key]
+                    self._owners.pop(key, None)
+
+    def clear(self):
+        """Annulla i precaricamenti e svuota la cache."""
+        self.cancel()
+        with self._lock:
+            self._cache.clear()
+
+
+def session_owner():
+    """Identificativo della sessione Streamlit corrente, da passare come owner a prefetch."""
+    import streamlit as st
+
+    return st.session_state.setdefault("prefetch_owner", uuid.uuid4().hex)
+
+
+def neighbours(times, current, offsets):
+    """
+    Timestamp vicini a current presenti in times, nell'ordine di offsets.
+    Parametri:
+      - times: sequenza di timestamp disponibili
+      - current: timestamp corrente
+      - offsets: scostamenti (pd.Timedelta o stringhe, es. "1h", "-1D")
+    Ritorna:
+      - lista di pd.Timestamp
+    """
+    available = pd.DatetimeIndex(times)
+    current = pd.Timestamp(current)
+    candidates = pd.DatetimeIndex([current + pd.Timedelta(offset) for offset in offsets])
+    return [t for t in candidates if t in available]
@@ -0,0 +1,227 @@
+"""
+Interrogazioni puntuali e per area sulla griglia ruotata dei NetCDF.
+
+La griglia (rlat, rlon) è regolare nel sistema a polo ruotato: invece di un
+KD-tree sulle coordinate geografiche 2D, un punto (lon, lat) viene proiettato
+nel sistema ruotato con pyproj e la cella più vicina si ottiene direttamente
+dagli assi 1D (costo costante, nessuna struttura da costruire). Un poligono
+viene risolto nelle celle il cui centro cade al suo interno.
+
+Le serie temporali vengono lette dai NetCDF solo per le celle richieste
+(indicizzazione puntuale lazy di xarray, a blocchi temporali), senza caricare
+le griglie complete. Solo per i timestamp in cui la rugiada di una cella
+richiesta non è valida viene letta la griglia intera, per riempire i buchi
+con fill_dew_point esattamente come nell'estrazione.
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from functions import INDEX_NAMES, STAT_PERCENTILES, compute_all_indices, fill_dew_point, spatial_stats
+
+
+QUERY_VARIABLES = ("Temperature",) + INDEX_NAMES
+QUERY_CHUNK_SIZE = 24 * 365  # ore lette per blocco (memoria limitata per le aree grandi)
+
+
+class GridLocator:
+    """
+    Conversione tra coordinate geografiche e celle (riga, colonna) della griglia ruotata.
+    """
+
+    def __init__(self, rlat, rlon, pole_lat, pole_lon, lon=None, lat=None, rlat_step=None, rlon_step=None):
+        """
+        Parametri:
+          - rlat, rlon: assi 1D (regolari) della griglia ruotata
+          - pole_lat, pole_lon: polo nord della griglia ruotata
+          - lon, lat: coordinate geografiche 2D dei centri cella (per i poligoni)
+          - rlat_step, rlon_step: passo della griglia, usato solo per un asse di
+            lunghezza 1 (es. sottoinsieme di una riga); se assente, su quell'asse
+            ogni punto viene assegnato all'unica cella
+        """
+        self.rlat = np.asarray(rlat, dtype=np.float64)
+        self.rlon = np.asarray(rlon, dtype=np.float64)
+        self.rlat_step = rlat_step
+        self.rlon_step = rlon_step
+        self.lon = lon
+        self.lat = lat
+
+        from pyproj import CRS, Transformer
+
+        crs_rot = CRS.from_cf({
+            "grid_mapping_name": "rotated_latitude_longitude",
+            "grid_north_pole_latitude": pole_lat,
+            "grid_north_pole_longitude": pole_lon
+        })
+        self._to_rotated = Transformer.from_crs(CRS.from_epsg(4326), crs_rot, always_xy=True)
+
+    @classmethod
+    def from_dataset(cls, ds, lon=None, lat=None):
+        """Costruisce il locator dagli assi e dagli attributi del polo di un dataset."""
+        rotated_attrs = ds["crs_rotated_latitude_longitude"].attrs
+        return cls(ds["rlat"].values, ds["rlon"].values,
+                   rotated_attrs.get("grid_north_pole_latitude", 43.0),
+                   rotated_attrs.get("grid_north_pole_longitude", -170.0),
+                   lon, lat)
+
+    @staticmethod
+    def _nearest(axis, values, step=None):
+        """
+        Posizione del valore più vicino su un asse 1D regolare; -1 se fuori dal
+        dominio. step serve solo per un asse di lunghezza 1 (None = nessun limite).
+        """
+        if len(axis) == 1:
+            nearest = np.zeros(np.shape(values), dtype=np.intp)
+            if step is None:
+                return nearest
+            return np.where(np.abs(axis[0] - values) > abs(step) / 2, -1, nearest)
+        order = np.argsort(axis)
+        sorted_axis = axis[order]
+        pos = np.clip(np.searchsorted(sorted_axis, values), 1, len(axis) - 1)
+        left_closer = np.abs(values - sorted_axis[pos - 1]) <= np.abs(sorted_axis[pos] - values)
+        nearest = order[np.where(left_closer, pos - 1, pos)]
+        half_step = abs(axis[1] - axis[0]) / 2
+        return np.where(np.abs(axis[nearest] - values) > half_step, -1, nearest)
+
+    def locate(self, lon, lat):
+        """
+        Cella più vicina a uno o più punti geografici.
+        Parametri:
+          - lon, lat: scalari o array (gradi, EPSG:4326)
+        Ritorna:
+          - (rows, cols): array di indici su rlat e rlon; -1 per i punti fuori dal dominio
+        """
+        x, y = self._to_rotated.transform(np.atleast_1d(np.asarray(lon, dtype=np.float64)),
+                                          np.atleast_1d(np.asarray(lat, dtype=np.float64)))
+        rows = self._nearest(self.rlat, np.asarray(y), self.rlat_step)
+        cols = self._nearest(self.rlon, np.asarray(x), self.rlon_step)
+        outside = (rows < 0) | (cols < 0)
+        return np.where(outside, -1, rows), np.where(outside, -1, cols)
+
+    def cells_in_polygon(self, polygon):
+        """
+        Celle il cui centro cade all'interno di un poligono geografico.
+        Se nessun centro cella è interno (poligono più piccolo di una cella)
+        viene restituita la cella che contiene il baricentro dei vertici.
+        Parametri:
+          - polygon: lista di vertici (lon, lat) oppure geometria shapely (Polygon)
+        Ritorna:
+          - (rows, cols): array di indici
+        """
+        from matplotlib.path import Path
+
+        if self.lon is None or self.lat is None:
+            raise ValueError("Le coordinate geografiche 2D (lon, lat) sono necessarie per i poligoni")
+        exterior = getattr(polygon, "exterior", None)
+        vertices = np.asarray(exterior.coords if exterior is not None else polygon, dtype=np.float64)
+
+        # Prefiltro sul rettangolo che contiene il poligono
+        lon_min, lat_min = vertices.min(axis=0)
+        lon_max, lat_max = vertices.max(axis=0)
+        candidates = np.flatnonzero(((self.lon >= lon_min) & (self.lon <= lon_max)
+                                     & (self.lat >= lat_min) & (self.lat <= lat_max)).ravel())
+        points = np.column_stack([np.ravel(self.lon)[candidates], np.ravel(self.lat)[candidates]])
+        inside = candidates[Path(vertices).contains_points(points)] if len(candidates) else candidates
+        if len(inside) == 0:
+            rows, cols = self.locate(*vertices.mean(axis=0))
+            keep = rows >= 0
+            return rows[keep], cols[keep]
+        return np.unravel_index(inside, np.shape(self.lon))
+
+
+def _cell_indexers(rows, cols):
+    """Indicizzatori puntuali di xarray (dimensione comune "cell")."""
+    return {"rlat": xr.DataArray(np.asarray(rows), dims="cell"),
+            "rlon": xr.DataArray(np.asarray(cols), dims="cell")}
+
+
+def _read_cells(dataset_temp, dataset_dew, rows, cols, positions, threshold=243.15):
+    """
+    Legge T_2M e TD_2M (time, cell) per le celle richieste e i timestamp in
+    positions, riempiendo i buchi della rugiada come fill_dew_point sulla
+    griglia intera.
+    """
+    indexers = _cell_indexers(rows, cols)
+    Ta_k = dataset_temp['T_2M'].isel(time=positions, **indexers).transpose('time', 'cell').values
+    timestamps = dataset_temp['T_2M'].time.values[positions]
+    Td_k = dataset_dew['TD_2M'].sel(time=timestamps).isel(**indexers).transpose('time', 'cell').values
+
+    invalid = ~(Td_k > threshold)
+    bad_times = np.flatnonzero(invalid.any(axis=1))
+    if len(bad_times):
+        # Solo i timestamp con buchi nelle celle richieste: griglia intera e interpolazione
+        full = dataset_dew['TD_2M'].sel(time=timestamps[bad_times]).transpose('time', 'rlat', 'rlon').load()
+        filled = np.asarray(fill_dew_point(full))
+        Td_k = Td_k.copy()
+        Td_k[bad_times] = filled[:, np.asarray(rows), np.asarray(cols)]
+    return timestamps, Ta_k, Td_k
+
+
+def cell_series(dataset_temp, dataset_dew, rows, cols, variables=QUERY_VARIABLES, start=None, end=None,
+                stat=None, chunk_size=QUERY_CHUNK_SIZE):
+    """
+    Serie temporali di temperatura e indici per un insieme di celle.
+    Parametri:
+      - dataset_temp, dataset_dew: dataset con T_2M e TD_2M (anche lazy)
+      - rows, cols: indici delle celle (vedi GridLocator)
+      - variables: variabili richieste (nomi di QUERY_VARIABLES)
+      - start, end: intervallo temporale (default: tutto il dataset)
+      - stat: None per una sola cella, altrimenti statistica spaziale per
+              timestamp sulle celle ("mean", "median", "p95", "p99", "max")
+    Ritorna:
+      - DataFrame indicizzato per timestamp, una colonna per variabile
+    """
+    rows = np.atleast_1d(rows)
+    cols = np.atleast_1d(cols)
+    if len(rows) == 0:
+        raise ValueError("Nessuna cella selezionata")
+    if stat is None and len(rows) != 1:
+        raise ValueError("Con più celle è necessaria una statistica spaziale (stat)")
+    unknown = [name for name in variables if name not in QUERY_VARIABLES]
+    if unknown:
+        raise ValueError(f"Variabili non disponibili: {unknown}")
+
+    all_times = pd.DatetimeIndex(dataset_temp['T_2M'].time.values)
+    positions = np.flatnonzero((all_times >= (pd.Timestamp(start) if start is not None else all_times[0]))
+                               & (all_times <= (pd.Timestamp(end) if end is not None else all_times[-1])))
+
+    frames = []
+    for chunk_start in range(0, len(positions), chunk_size):
+        chunk = positions[chunk_start:chunk_start + chunk_size]
+        timestamps, Ta_k, Td_k = _read_cells(dataset_temp, dataset_dew, rows, cols, chunk)
+        values = compute_all_indices(Ta_k, Td_k)
+        values["Temperature"] = (Ta_k - 273.15).astype(np.float32)
+
+        if stat is None:
+            data = {name: values[name][:, 0] for name in variables}
+        else:
+            stats = {stat: STAT_PERCENTILES[stat]}
+            data = {name: spatial_stats(values[name], stats)[stat] for name in variables}
+        frames.append(pd.DataFrame(data, index=pd.DatetimeIndex(timestamps, name="Timestamp")))
+
+    if not frames:
+        return pd.DataFrame(columns=list(variables), index=pd.DatetimeIndex([], name="Timestamp"))
+    return pd.concat(frames)
+
+
+def point_series(dataset_temp, dataset_dew, locator, lon, lat, variables=QUERY_VARIABLES, start=None, end=None):
+    """
+    Serie temporali nella cella che contiene il punto (lon, lat).
+    Ritorna:
+      - DataFrame indicizzato per timestamp (ValueError se il punto è fuori dal dominio)
+    """
+    rows, cols = locator.locate(lon, lat)
+    if rows[0] < 0:
+        raise ValueError(f"Il punto ({lon}, {lat}) è fuori dal dominio della griglia")
+    return cell_series(dataset_temp, dataset_dew, rows[:1], cols[:1], variables, start, end)
+
+
+def area_series(dataset_temp, dataset_dew, locator, polygon, variables=QUERY_VARIABLES, start=None, end=None,
+                stat="mean"):
+    """
+    Statistica spaziale (default: media) sulle celle di un poligono, per ogni timestamp.
+    Ritorna:
+      - DataFrame indicizzato per timestamp
+    """
+    rows, cols = locator.cells_in_polygon(polygon)
+    return cell_series(dataset_temp, dataset_dew, rows, cols, variables, start, end, stat=stat)
@@ -0,0 +1,241 @@
+"""
+Costruzione del pacchetto di dati ridotto per la demo dell'app.
+
+Sostituisce il notebook 05, che caricava per intero i NetCDF 1981-2023 e,
+per la tabella degli indici, riscriveva l'intero CSV a ogni anno aggiunto
+solo per controllarne la dimensione (I/O quadratico nel numero di anni).
+  - reduce_netcdf: seleziona l'intervallo di date e le ore del giorno
+    leggendo dal NetCDF di origine solo blocchi di timestamp (netCDF4, senza
+    caricare il file) e scrive l'output compresso (zlib) blocco per blocco
+  - reduce_table: legge la tabella una sola volta (a blocchi di righe o per
+    anno dall'archivio Parquet), codifica ogni anno in CSV una sola volta
+    misurandone i byte, e tiene gli anni più recenti che stanno nel budget
+  - build_demo_bundle: NetCDF di temperatura e rugiada + tabella, con un
+    budget complessivo in MB
+
+Uso:
+    python Heat_stress_App/reduction.py T_2M.nc TD_2M.nc heatstress.csv output_dir 500
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+DEMO_START = "2023-04-01"
+DEMO_END = "2023-09-30"
+DEMO_HOURS = (11, 17)  # ore del giorno incluse (estremi compresi)
+DEMO_TABLE = "heatstress_all_timestamps_year_reduced.csv"
+DEFAULT_CHUNK_SIZE = 24 * 7  # timestamp di origine letti per blocco
+DEFAULT_COMPLEVEL = 4
+TABLE_CHUNK_ROWS = 200_000
+
+
+def _mb(n_bytes):
+    return n_bytes / (1024 * 1024)
+
+
+def select_timestamps(times, start=DEMO_START, end=DEMO_END, hours=DEMO_HOURS):
+    """
+    Posizioni dei timestamp tra start ed end (giorni interi inclusi) e nelle
+    ore hours=(prima, ultima); hours=None = tutte le ore.
+    """
+    times = pd.DatetimeIndex(times)
+    start = pd.Timestamp(start)
+    end = pd.Timestamp(end)
+    if end == end.normalize():
+        end = end + pd.Timedelta(days=1) - pd.Timedelta(1, "ns")
+    mask = (times >= start) & (times <= end)
+    if hours is not None:
+        mask &= (times.hour >= hours[0]) & (times.hour <= hours[1])
+    return np.flatnonzero(mask)
+
+
+def reduce_netcdf(input_path, output_path, start=DEMO_START, end=DEMO_END, hours=DEMO_HOURS,
+                  chunk_size=DEFAULT_CHUNK_SIZE, complevel=DEFAULT_COMPLEVEL, packed=False, verbose=True):
+    """
+    Sottoinsieme temporale di un NetCDF, scritto in streaming e compresso.
+    Le variabili senza dimensione time vengono copiate così come sono,
+    quelle con dimensione time a blocchi di al più chunk_size timestamp di origine.
+    Con packed=True T_2M/TD_2M vengono salvate come int16 quantizzati (vedi encoding.py).
+    Ritorna:
+      - numero di timestamp scritti
+    """
+    import netCDF4
+
+    from encoding import PACKING, create_packed_variable, packed_chunksizes, steps_per_day, write_packed
+
+    start_time = time.time()
+    with xr.open_dataset(input_path) as ds:
+        times = ds["time"].values
+        positions = select_timestamps(times, start, end, hours)
+    if len(positions) == 0:
+        raise ValueError(f"Nessun timestamp di {input_path} tra {start} e {end}")
+
+    # Blocchi di posizioni che coprono al più chunk_size timestamp di origine
+    block_ids = (positions - positions[0]) // chunk_size
+    bounds = np.flatnonzero(np.diff(block_ids)) + 1
+    blocks = np.split(positions, bounds)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with netCDF4.Dataset(input_path) as src, netCDF4.Dataset(tmp_path, "w", format="NETCDF4") as dst:
+        src.set_auto_maskandscale(False)
+        dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+        sizes = {name: len(positions) if name == "time" else len(dim) for name, dim in src.dimensions.items()}
+        for name, size in sizes.items():
+            dst.createDimension(name, size)
+
+        for name, var in src.variables.items():
+            pack_variable = packed and name in PACKING and "time" in var.dimensions and var.ndim > 1
+            if pack_variable:
+                # Chunk di un giorno del sottoinsieme (es. 7 timestamp con le ore 11-17)
+                out = create_packed_variable(dst, name, var, PACKING[name],
+                                             packed_chunksizes(var.dimensions, sizes,
+                                                               steps_per_day(times[positions])),
+                                             complevel)
+            else:
+                attrs = {key: var.getncattr(key) for key in var.ncattrs() if key != "_FillValue"}
+                fill_value = var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None
+                compress = var.ndim > 0 and var.dtype.kind in "fiu"
+                chunksizes = None
+                if "time" in var.dimensions and var.ndim > 1:
+                    # Un timestamp per chunk HDF5: lettura veloce di una singola griglia
+                    chunksizes = [1 if d == "time" else len(src.dimensions[d]) for d in var.dimensions]
+                out = dst.createVariable(name, var.dtype, var.dimensions, zlib=compress, complevel=complevel,
+                                         shuffle=compress, chunksizes=chunksizes, fill_value=fill_value)
+                out.set_auto_maskandscale(False)
+                out.setncatts(attrs)
+
+            if "time" not in var.dimensions:
+                out[...] = var[...]
+                continue
+            axis = var.dimensions.index("time")
+            written = 0
+            for block in blocks:
+                # Lettura del tratto contiguo che contiene il blocco, poi selezione in memoria
+                index = [slice(None)] * var.ndim
+                index[axis] = slice(int(block[0]), int(block[-1]) + 1)
+                data = np.take(var[tuple(index)], block - block[0], axis=axis)
+                index[axis] = slice(written, written + len(block))
+                if pack_variable:
+                    write_packed(out, tuple(index), var, data)
+                else:
+                    out[tuple(index)] = data
+                written += len(block)
+    os.replace(tmp_path, output_path)
+
+    if verbose:
+        print(f"✅ {os.path.basename(output_path)}: {len(positions)} timestamp, "
+              f"{_mb(os.path.getsize(output_path)):.1f} MB in {time.time() - start_time:.1f} secondi.")
+    return len(positions)
+
+
+def _iter_table_years(input_path, chunk_rows=TABLE_CHUNK_ROWS):
+    """
+    Generatore: blocchi (anno, DataFrame) della tabella degli indici, letti
+    una sola volta dal CSV (a blocchi di righe) o dall'archivio Parquet (per anno).
+    """
+    if os.path.isdir(input_path):
+        import storage
+        for year in storage.available_years(input_path):
+            df = storage.load_table(input_path, years=[year])
+            # Confronti con la soglia come "si"/"no", come nel CSV
+            yield year, storage.from_columnar(df.drop(columns=[storage.PARTITION_COLUMN], errors="ignore"))
+        return
+    for chunk in pd.read_csv(input_path, parse_dates=["Timestamp"], chunksize=chunk_rows):
+        years = chunk["Timestamp"].dt.year
+        for year, df_year in chunk.groupby(years, sort=False):
+            yield int(year), df_year
+
+
+def reduce_table(input_path, output_path, size_limit_mb, newest_first=True, verbose=True):
+    """
+    Tiene gli anni più recenti (o i più vecchi) della tabella finché il CSV
+    di output resta entro size_limit_mb. Ogni anno viene codificato una sola
+    volta in un file temporaneo, di cui si conoscono quindi i byte esatti;
+    il CSV finale è la concatenazione dell'intestazione e degli anni scelti
+    in ordine cronologico.
+    Ritorna:
+      - lista degli anni inclusi
+    """
+    start_time = time.time()
+    limit = size_limit_mb * 1024 * 1024
+    header = None
+    sizes = {}
+
+    spool_dir = tempfile.mkdtemp(prefix="heatstress_reduce_")
+    try:
+        for year, df_year in _iter_table_years(input_path):
+            if header is None:
+                header = df_year.iloc[:0].to_csv(index=False).encode("utf-8")
+            encoded = df_year.to_csv(index=False, header=False).encode("utf-8")
+            with open(os.path.join(spool_dir, f"{year}.csv"), "ab") as f:
+                f.write(encoded)
+            sizes[year] = sizes.get(year, 0) + len(encoded)
+        if header is None:
+            raise ValueError(f"Tabella vuota: {input_path}")
+
+        included = []
+        total = len(header)
+        for year in sorted(sizes, reverse=newest_first):
+            if total + sizes[year] > limit:
+                if verbose:
+                    print(f"🛑 Fermato prima di aggiungere l'anno {year} perché si supererebbe il limite.")
+                break
+            total += sizes[year]
+            included.append(year)
+
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as out:
+            out.write(header)
+            for year in sorted(included):
+                with open(os.path.join(spool_dir, f"{year}.csv"), "rb") as f:
+                    shutil.copyfileobj(f, out)
+        os.replace(tmp_path, output_path)
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    if verbose:
+        print(f"✅ {os.path.basename(output_path)}: {_mb(total):.2f} MB, anni inclusi: "
+              f"{sorted(included, reverse=True)} ({time.time() - start_time:.1f} secondi)")
+    return sorted(included)
+
+
+def build_demo_bundle(temp_path, dew_path, table_path, output_dir, size_limit_mb, start=DEMO_START,
+                      end=DEMO_END, hours=DEMO_HOURS, packed=False, verbose=True):
+    """
+    Crea in output_dir i file usati dalla demo (stessi nomi attesi dall'app):
+      - 2m_air_temp_{start}_{end}.nc e 2m_dew_point_temp_{start}_{end}.nc
+        (int16 quantizzati con packed=True, lasciando più spazio alla tabella)
+      - heatstress_all_timestamps_year_reduced.csv con lo spazio rimasto nel budget
+    Ritorna:
+      - dizionario {nome file: dimensione in MB}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    temp_out = os.path.join(output_dir, f"2m_air_temp_{start}_{end}.nc")
+    dew_out = os.path.join(output_dir, f"2m_dew_point_temp_{start}_{end}.nc")
+    reduce_netcdf(temp_path, temp_out, start, end, hours, packed=packed, verbose=verbose)
+    reduce_netcdf(dew_path, dew_out, start, end, hours, packed=packed, verbose=verbose)
+
+    used_mb = _mb(os.path.getsize(temp_out) + os.path.getsize(dew_out))
+    table_budget = size_limit_mb - used_mb
+    if table_budget <= 0:
+        raise ValueError(f"I NetCDF occupano già {used_mb:.1f} MB, oltre il budget di {size_limit_mb} MB")
+    reduce_table(table_path, os.path.join(output_dir, DEMO_TABLE), table_budget, verbose=verbose)
+
+    sizes = {name: round(_mb(os.path.getsize(os.path.join(output_dir, name))), 2)
+             for name in (os.path.basename(temp_out), os.path.basename(dew_out), DEMO_TABLE)}
+    if verbose:
+        print(f"📦 Pacchetto demo: {sum(sizes.values()):.1f} MB su {size_limit_mb} MB in {output_dir}")
+    return sizes
+
+
+if __name__ == "__main__":
+    build_demo_bundle(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], float(sys.argv[5]))
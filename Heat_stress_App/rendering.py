@@ -0,0 +1,267 @@
+"""
+Rendering lato server delle mappe della Dashboard.
+
+Invece di creare una figura Matplotlib per ogni mappa (basemap, imshow,
+colorbar, tight_layout), le griglie degli indici vengono convertite
+direttamente in pixel RGBA tramite tabelle di colori (LUT) in cache e
+sovrapposte a un raster di sfondo anch'esso in cache. Il risultato è un PNG,
+memorizzato in una cache LRU con chiave (timestamp, indice, colormap, ...).
+"""
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from instrumentation import span
+
+
+DEFAULT_WIDTH = 600  # larghezza in pixel delle mappe
+MAX_CACHED_IMAGES = 256
+
+
+# === Tabelle di colori ===
+
+@lru_cache(maxsize=64)
+def colormap_lut(cmap, n=256):
+    """
+    Tabella dei colori di una colormap Matplotlib.
+    Ritorna:
+      - array (n, 4) uint8 RGBA (sola lettura)
+    """
+    import matplotlib
+
+    lut = matplotlib.colormaps[cmap](np.linspace(0.0, 1.0, n), bytes=True)
+    lut.setflags(write=False)
+    return lut
+
+
+def colorize(data, cmap, vmin=None, vmax=None):
+    """
+    Converte una griglia in colori RGBA con la LUT della colormap.
+    I NaN diventano pixel trasparenti.
+    Parametri:
+      - data: array 2D
+      - cmap: nome della colormap Matplotlib
+      - vmin, vmax: estremi della scala (default: min e max della griglia)
+    Ritorna:
+      - array (..., 4) uint8
+    """
+    data = np.asarray(data, dtype=np.float32)
+    vmin = np.nanmin(data) if vmin is None else vmin
+    vmax = np.nanmax(data) if vmax is None else vmax
+    lut = colormap_lut(cmap)
+    n = len(lut)
+
+    # Stessa discretizzazione di Matplotlib: floor(norm * n), limitato a n - 1
+    scale = n / (vmax - vmin) if vmax > vmin else 0.0
+    idx = np.nan_to_num((data - vmin) * scale, nan=0.0)
+    np.clip(idx, 0, n - 1, out=idx)
+    rgba = lut[idx.astype(np.intp)]
+    rgba[np.isnan(data), 3] = 0
+    return rgba
+
+
+def two_slope_normalize(values, vmin, vcenter, vmax):
+    """
+    Versione vettorializzata di matplotlib.colors.TwoSlopeNorm: vmin -> 0,
+    vcenter -> 0.5, vmax -> 1. vmin, vcenter e vmax possono essere array
+    (una normalizzazione diversa per ogni colonna).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    vmin, vcenter, vmax = np.broadcast_arrays(*(np.asarray(v, dtype=np.float64) for v in (vmin, vcenter, vmax)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        below = 0.5 * (values - vmin) / (vcenter - vmin)
+        above = 0.5 + 0.5 * (values - vcenter) / (vmax - vcenter)
+    return np.clip(np.where(values < vcenter, below, above), 0.0, 1.0)
+
+
+# === Sfondo ===
+
+def output_shape(extent, width=DEFAULT_WIDTH):
+    """Dimensioni (altezza, larghezza) in pixel dell'immagine per l'estensione data."""
+    xmin, xmax, ymin, ymax = extent
+    height = max(1, int(round(width * (ymax - ymin) / (xmax - xmin))))
+    return height, width
+
+
+def _pixel_centers(extent, shape):
+    """Coordinate dei centri dei pixel (x per colonna, y per riga dall'alto)."""
+    xmin, xmax, ymin, ymax = extent
+    height, width = shape
+    xs = xmin + (np.arange(width) + 0.5) * (xmax - xmin) / width
+    ys = ymax - (np.arange(height) + 0.5) * (ymax - ymin) / height
+    return xs, ys
+
+
+@lru_cache(maxsize=8)
+def _tile_raster(extent, shape):
+    """
+    Tile di basemap.py ricampionate sull'estensione e sulla forma di output.
+    Se le tile non sono disponibili solleva LookupError: lru_cache non
+    memorizza le eccezioni, per cui la chiamata successiva riprova.
+    """
+    from basemap import fetch_tiles
+
+    with span("rendering.basemap_tiles"):
+        tiles = fetch_tiles(list(extent))
+    if tiles is None:
+        raise LookupError("Tile di sfondo non disponibili")
+    image, (left, right, bottom, top) = tiles
+    xs, ys = _pixel_centers(extent, shape)
+    cols = np.clip(((xs - left) / (right - left) * image.shape[1]).astype(np.intp), 0, image.shape[1] - 1)
+    rows = np.clip(((top - ys) / (top - bottom) * image.shape[0]).astype(np.intp), 0, image.shape[0] - 1)
+    raster = np.ascontiguousarray(image[rows[:, None], cols[None, :], :3])
+    raster.setflags(write=False)
+    return raster
+
+
+def blank_raster(shape):
+    """Sfondo bianco di ripiego (sola lettura)."""
+    raster = np.full(shape + (3,), 255, dtype=np.uint8)
+    raster.setflags(write=False)
+    return raster
+
+
+def basemap_raster(extent, shape, fallback=True):
+    """
+    Raster RGB di sfondo ricampionato sull'estensione e sulla forma di output.
+    Usa le tile in cache di basemap.py; solo i raster riusciti restano in
+    memoria, così un errore di rete temporaneo non rende lo sfondo bianco
+    fino al riavvio del processo.
+    Parametri:
+      - extent: tupla (xmin, xmax, ymin, ymax) in EPSG:3857
+      - shape: tupla (altezza, larghezza) in pixel
+      - fallback: se True e le tile non sono disponibili restituisce uno
+                  sfondo bianco, altrimenti None
+    Ritorna:
+      - array (altezza, larghezza, 3) uint8 (sola lettura), oppure None
+    """
+    try:
+        return _tile_raster(extent, shape)
+    except LookupError:
+        return blank_raster(shape) if fallback else None
+
+
+def resample_grid(data, extent, shape):
+    """
+    Ricampiona (nearest) una griglia con origine in basso a sinistra,
+    come imshow(origin="lower", extent=extent), sui pixel di output.
+    """
+    data = np.asarray(data)
+    ny, nx = data.shape
+    height, width = shape
+    cols = np.minimum((np.arange(width) + 0.5) * nx / width, nx - 1).astype(np.intp)
+    rows = np.minimum((np.arange(height) + 0.5) * ny / height, ny - 1).astype(np.intp)
+    # La riga 0 dell'immagine è in alto, la riga 0 della griglia in basso
+    return data[rows[::-1][:, None], cols[None, :]]
+
+
+def composite(base_rgb, overlay_rgba, alpha=0.6):
+    """Sovrappone overlay_rgba allo sfondo con opacità alpha (pixel trasparenti esclusi)."""
+    weight = (overlay_rgba[..., 3:4].astype(np.float32) / 255.0) * alpha
+    out = base_rgb.astype(np.float32) * (1.0 - weight) + overlay_rgba[..., :3].astype(np.float32) * weight
+    return out.astype(np.uint8)
+
+
+def encode_png(rgb):
+    """Codifica un array RGB/RGBA uint8 in PNG."""
+    with span("rendering.encode_png"):
+        buffer = BytesIO()
+        Image.fromarray(rgb).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+
+# === Cache delle immagini ===
+
+_png_cache = OrderedDict()
+_png_lock = threading.Lock()
+
+
+def _lookup_png(key):
+    """PNG in cache per key, oppure None."""
+    with _png_lock:
+        if key in _png_cache:
+            _png_cache.move_to_end(key)
+            return _png_cache[key]
+    return None
+
+
+def _store_png(key, png):
+    """Aggiunge un PNG alla cache (al massimo MAX_CACHED_IMAGES immagini, LRU)."""
+    with _png_lock:
+        _png_cache[key] = png
+        _png_cache.move_to_end(key)
+        while len(_png_cache) > MAX_CACHED_IMAGES:
+            _png_cache.popitem(last=False)
+
+
+def cached_png(key, render):
+    """
+    Restituisce il PNG associato a key, calcolandolo con render() se assente.
+    La cache tiene al massimo MAX_CACHED_IMAGES immagini (LRU).
+    """
+    png = _lookup_png(key)
+    if png is None:
+        png = render()
+        _store_png(key, png)
+    return png
+
+
+# === Mappe e legende ===
+
+def render_map_rgb(data, cmap, extent, vmin, vmax, alpha=0.6, width=DEFAULT_WIDTH, base=None):
+    """
+    Mappa di un indice sovrapposta allo sfondo, come array RGB uint8.
+    Parametri:
+      - base: raster di sfondo già calcolato (default: basemap_raster)
+    """
+    shape = output_shape(extent, width)
+    if base is None:
+        base = basemap_raster(tuple(float(v) for v in extent), shape)
+    with span("rendering.colorize"):
+        overlay = colorize(resample_grid(data, extent, shape), cmap, vmin, vmax)
+        return composite(base, overlay, alpha)
+
+
+def render_map_png(data, cmap, extent, vmin=None, vmax=None, alpha=0.6, width=DEFAULT_WIDTH, key=None):
+    """
+    Mappa di un indice sovrapposta allo sfondo, come PNG.
+    Parametri:
+      - data: griglia 2D (rlat, rlon), origine in basso
+      - cmap: nome della colormap
+      - extent: [xmin, xmax, ymin, ymax] in EPSG:3857
+      - vmin, vmax: estremi della scala (default: min e max della griglia)
+      - alpha: opacità della griglia sullo sfondo
+      - key: chiave di cache (es. (timestamp, indice)); None = nessuna cache
+    Ritorna:
+      - bytes PNG
+    """
+    extent = tuple(float(v) for v in extent)
+    vmin = float(np.nanmin(data)) if vmin is None else vmin
+    vmax = float(np.nanmax(data)) if vmax is None else vmax
+    cache_key = None if key is None else ("map", key, cmap, extent, vmin, vmax, alpha, width)
+    png = None if cache_key is None else _lookup_png(cache_key)
+    if png is not None:
+        return png
+
+    shape = output_shape(extent, width)
+    base = basemap_raster(extent, shape, fallback=False)
+    png = encode_png(render_map_rgb(data, cmap, extent, vmin, vmax, alpha, width,
+                                    base if base is not None else blank_raster(shape)))
+    # Con lo sfondo di ripiego l'immagine non va in cache: verrà ridisegnata con le tile
+    if cache_key is not None and base is not None:
+        _store_png(cache_key, png)
+    return png
+
+
+def render_colorbar_png(cmap, width=DEFAULT_WIDTH, height=12):
+    """Barra dei colori orizzontale della colormap, come PNG."""
+    def render():
+        lut = colormap_lut(cmap)
+        idx = np.linspace(0, len(lut) - 1, width).astype(np.intp)
+        return encode_png(np.ascontiguousarray(np.broadcast_to(lut[idx][None, :, :3], (height, width, 3))))
+
+    return cached_png(("colorbar", cmap, width, height), render)
@@ -0,0 +1,141 @@
+"""
+Risorse condivise tra le pagine dell'app (cache di Streamlit a livello di processo).
+
+I NetCDF vengono aperti una sola volta per processo e le trasformazioni di
+coordinate (griglia ruotata -> lon/lat, estensioni in EPSG:3857) vengono
+calcolate una sola volta e riutilizzate da tutte le pagine e da tutti gli utenti.
+Gli oggetti restituiti sono condivisi: non vanno modificati.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+import xarray as xr
+
+
+DATA_DIR = os.path.join("Heat_stress_App", "data")
+TEMP_PATH = os.path.join(DATA_DIR, "2m_air_temp_2023-04-01_2023-09-30.nc")
+DEW_PATH = os.path.join(DATA_DIR, "2m_dew_point_temp_2023-04-01_2023-09-30.nc")
+CUBE_PATH = os.path.join(DATA_DIR, "index_cube")
+CLIMATOLOGY_PATH = os.path.join(DATA_DIR, "climatology")
+ROLLUP_PATH = os.path.join(DATA_DIR, "rollup")
+
+# Margine (in gradi) attorno al dominio per la mappa di sfondo
+MAP_PADDING = 1.5
+
+
+@st.cache_resource(show_spinner=False)
+def open_dataset(path):
+    """Apre (una sola volta per processo) il NetCDF indicato."""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"❌ File NetCDF non trovato: {path}")
+    return xr.open_dataset(path)
+
+
+def load_nc_datasets():
+    """Ritorna i dataset condivisi di temperatura e punto di rugiada."""
+    return open_dataset(TEMP_PATH), open_dataset(DEW_PATH)
+
+
+@st.cache_resource(show_spinner=False)
+def time_values(path=TEMP_PATH, variable="T_2M"):
+    """Timestamp del dataset come DatetimeIndex."""
+    return pd.DatetimeIndex(open_dataset(path)[variable].time.values)
+
+
+@st.cache_resource(show_spinner=False)
+def geographic_grid(path=TEMP_PATH):
+    """
+    Converte la griglia ruotata (rlat, rlon) in coordinate geografiche.
+    Ritorna:
+      - (lon, lat): array 2D in EPSG:4326
+    """
+    from pyproj import CRS, Transformer
+
+    ds = open_dataset(path)
+    rlat = ds["rlat"].values
+    rlon = ds["rlon"].values
+    rlon2d, rlat2d = np.meshgrid(rlon, rlat)
+
+    rotated_attrs = ds["crs_rotated_latitude_longitude"].attrs
+    pole_lat = rotated_attrs.get("grid_north_pole_latitude", 43.0)
+    pole_lon = rotated_attrs.get("grid_north_pole_longitude", -170.0)
+
+    crs_rot = CRS.from_cf({
+        "grid_mapping_name": "rotated_latitude_longitude",
+        "grid_north_pole_latitude": pole_lat,
+        "grid_north_pole_longitude": pole_lon
+    })
+    transformer = Transformer.from_crs(crs_rot, CRS.from_epsg(4326), always_xy=True)
+    lon, lat = transformer.transform(rlon2d, rlat2d)
+    lon.setflags(write=False)
+    lat.setflags(write=False)
+    return lon, lat
+
+
+@st.cache_resource(show_spinner=False)
+def grid_locator(path=TEMP_PATH):
+    """Conversione punto/poligono geografico -> celle della griglia (vedi query.py)."""
+    from query import GridLocator
+
+    lon, lat = geographic_grid(path)
+    return GridLocator.from_dataset(open_dataset(path), lon, lat)
+
+
+@st.cache_resource(show_spinner=False)
+def padded_bbox(path=TEMP_PATH, padding=MAP_PADDING):
+    """
+    Bounding box geografico del dominio con margine, per la mappa di sfondo.
+    Ritorna:
+      - (lon_min, lat_min, lon_max, lat_max)
+    """
+    lon, lat = geographic_grid(path)
+    return (float(np.nanmin(lon)) - padding, float(np.nanmin(lat)) - padding,
+            float(np.nanmax(lon)) + padding, float(np.nanmax(lat)) + padding)
+
+
+@st.cache_resource(show_spinner=False)
+def web_mercator_extent(path=TEMP_PATH):
+    """
+    Estensione del dominio in EPSG:3857 a partire dalle variabili lat/lon
+    del dataset, nel formato di imshow.
+    Ritorna:
+      - [xmin, xmax, ymin, ymax]
+    """
+    from pyproj import Transformer
+
+    ds = open_dataset(path)
+    lat = ds['lat'].values
+    lon = ds['lon'].values
+    lon1d = lon[0, :] if lon.ndim == 2 else lon
+    lat1d = lat[:, 0] if lat.ndim == 2 else lat
+
+    transformer = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+    xmin, ymin = transformer.transform(lon1d.min(), lat1d.min())
+    xmax, ymax = transformer.transform(lon1d.max(), lat1d.max())
+    return [xmin, xmax, ymin, ymax]
+
+
+@st.cache_resource(show_spinner=False)
+def index_cube(root=CUBE_PATH):
+    """Cubo precalcolato degli indici in memory-map (None se non ancora costruito, vedi cube.py)."""
+    from cube import IndexCube, cube_exists
+
+    return IndexCube(root) if cube_exists(root) else None
+
+
+@st.cache_resource(show_spinner=False)
+def climatology(root=CLIMATOLOGY_PATH):
+    """Climatologia dei percentili per cella (None se non ancora costruita, vedi climatology.py)."""
+    from climatology import Climatology, climatology_exists
+
+    return Climatology(root) if climatology_exists(root) else None
+
+
+@st.cache_resource(show_spinner=False)
+def rollup(root=ROLLUP_PATH):
+    """Piramide degli aggregati per cella (None se non ancora costruita, vedi rollup.py)."""
+    from rollup import Rollup, rollup_exists
+
+    return Rollup(root) if rollup_exists(root) else None
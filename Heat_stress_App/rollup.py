@@ -0,0 +1,379 @@
+"""
+Piramide di aggregati temporali per cella: oraria -> giornaliera -> mensile -> annuale.
+
+Il Trend Analyzer lavora su statistiche spaziali (un valore per timestamp
+per tutta la regione), per cui non può mostrare dove si accumula il caldo;
+una mappa giornaliera o annuale per cella richiederebbe di rileggere tutti
+i dati orari. build_rollup calcola invece, in un solo passaggio sui dati
+orari, per ogni cella, variabile e periodo:
+  - max: valore massimo orario
+  - mean: media dei valori orari
+  - hours: ore con valore sopra la soglia dell'indice (extraction.soglie,
+    stesso confronto ">" della tabella degli indici), solo per gli indici con soglia
+ai livelli giornaliero, mensile e annuale. I livelli superiori vengono
+ottenuti da quelli inferiori (massimo dei massimi, somme e conteggi per la
+media, somma delle ore), senza rileggere i dati orari.
+
+I dati orari vengono letti dal cubo degli indici (cube.py) se disponibile,
+altrimenti calcolati dai NetCDF con compute_all_indices, a blocchi di giorni
+interi: la memoria dipende da days_per_chunk e non dalla lunghezza del
+periodo. Uno shard per anno, parallelizzabile su più processi (ogni worker
+scrive righe diverse degli array di output).
+
+Struttura della cartella:
+  - {livello}_{statistica}.npy con livello in daily/monthly/yearly:
+      max, mean: (periodi, variabili, rlat, rlon) float32
+      hours: (periodi, indici con soglia, rlat, rlon) uint16
+  - meta.json: variabili, soglie, periodi di ogni livello e forme (scritto
+    per ultimo, la sua presenza indica che la piramide è completa)
+
+Uso:
+    python Heat_stress_App/rollup.py T_2M.nc TD_2M.nc Heat_stress_App/data/rollup --cube Heat_stress_App/data/index_cube
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cube import CUBE_VARIABLES
+
+
+ROLLUP_VARIABLES = CUBE_VARIABLES
+LEVELS = ("daily", "monthly", "yearly")
+STATS = ("max", "mean", "hours")
+# Etichetta di un periodo per livello (formato di strftime)
+PERIOD_FORMATS = {"daily": "%Y-%m-%d", "monthly": "%Y-%m", "yearly": "%Y"}
+DEFAULT_DAYS_PER_CHUNK = 7
+META_FILE = "meta.json"
+
+
+def _file_name(level, stat):
+    return f"{level}_{stat}.npy"
+
+
+def period_labels(timestamps, level):
+    """Etichette dei periodi ("2023", "2023-07", "2023-07-15") di ciascun timestamp."""
+    return pd.DatetimeIndex(timestamps).strftime(PERIOD_FORMATS[level])
+
+
+def _day_aggregates(values, starts, threshold_positions, thresholds):
+    """
+    Aggregati giornalieri di un blocco orario (time, variabili, rlat, rlon)
+    con i giorni che iniziano alle posizioni starts.
+    Ritorna:
+      - (max, somma, ore valide, ore sopra soglia), un elemento per giorno
+    """
+    valid = ~np.isnan(values)
+    # fmax ignora i NaN (NaN solo se il giorno è tutto NaN)
+    day_max = np.fmax.reduceat(values, starts, axis=0)
+    day_sum = np.add.reduceat(np.where(valid, values, 0), starts, axis=0, dtype=np.float64)
+    day_count = np.add.reduceat(valid, starts, axis=0, dtype=np.int32)
+    above = values[:, threshold_positions] > thresholds[None, :, None, None]
+    day_hours = np.add.reduceat(above, starts, axis=0, dtype=np.int32)
+    return day_max, day_sum, day_count, day_hours
+
+
+def _mean(total, count):
+    """Media da somma e numero di valori validi (NaN dove non ce ne sono)."""
+    return np.where(count > 0, total / np.maximum(count, 1), np.nan).astype(np.float32)
+
+
+def _nanmean(values, axis):
+    """Media lungo axis ignorando i NaN (NaN se tutti i valori sono NaN)."""
+    values = np.asarray(values, dtype=np.float32)
+    valid = ~np.isnan(values)
+    return _mean(np.where(valid, values, 0).sum(axis=axis, dtype=np.float64), valid.sum(axis=axis))
+
+
+def _iter_hourly(temp_path, dew_path, cube_root, positions, days_per_chunk):
+    """
+    Generatore: (timestamp, valori (time, variabili, rlat, rlon) float32) a
+    blocchi di giorni interi, dal cubo degli indici o dai NetCDF.
+    """
+    # Import locali: come in cube.py
+    from climatology import _day_chunks
+    from cube import IndexCube, cube_exists
+
+    if cube_root is not None and cube_exists(cube_root):
+        cube = IndexCube(cube_root)
+        timestamps = cube.timestamps.values
+        for chunk in _day_chunks(positions, timestamps, days_per_chunk):
+            yield timestamps[chunk], cube.read(chunk)
+        return
+
+    from extraction import open_datasets
+    from functions import INDEX_NAMES, allocate_index_buffers, compute_all_indices, fill_dew_point
+
+    dataset_temp, dataset_dew = open_datasets(temp_path, dew_path)
+    try:
+        timestamps = dataset_temp['T_2M'].time.values
+        out = None
+        for chunk in _day_chunks(positions, timestamps, days_per_chunk):
+            chunk_times = timestamps[chunk]
+            Ta_k = dataset_temp['T_2M'].isel(time=chunk).transpose('time', 'rlat', 'rlon').load()
+            Td_k = dataset_dew['TD_2M'].sel(time=chunk_times).transpose('time', 'rlat', 'rlon').load()
+            if out is None or out["UTCI"].shape != Ta_k.shape:
+                out = allocate_index_buffers(Ta_k.shape)
+            compute_all_indices(Ta_k, fill_dew_point(Td_k), out=out)
+            hourly = [Ta_k.values.astype(np.float32) - np.float32(273.15)] + [out[name] for name in INDEX_NAMES]
+            yield chunk_times, np.stack(hourly, axis=1)
+    finally:
+        dataset_temp.close()
+        dataset_dew.close()
+
+
+def _rollup_year(temp_path, dew_path, cube_root, root, positions, offsets, threshold_positions, thresholds,
+                 days_per_chunk):
+    """
+    Lavoro di un singolo worker: tutti i livelli della piramide per un anno,
+    scritti direttamente negli array di output alle righe offsets
+    (primo giorno, primo mese, anno).
+    """
+    start_time = time.time()
+    arrays = {(level, stat): np.load(os.path.join(root, _file_name(level, stat)), mmap_mode="r+")
+              for level in LEVELS for stat in STATS}
+    day_row, month_row, year_row = offsets
+    n_vars, n_rlat, n_rlon = arrays[("daily", "max")].shape[1:]
+    thresholds = np.asarray(thresholds, dtype=np.float32)
+
+    # Accumulatori dei mesi dell'anno
+    month_max = np.full((12, n_vars, n_rlat, n_rlon), np.nan, dtype=np.float32)
+    month_sum = np.zeros((12, n_vars, n_rlat, n_rlon), dtype=np.float64)
+    month_count = np.zeros((12, n_vars, n_rlat, n_rlon), dtype=np.int32)
+    month_hours = np.zeros((12, len(thresholds), n_rlat, n_rlon), dtype=np.int32)
+    months_seen = set()
+
+    for chunk_times, values in _iter_hourly(temp_path, dew_path, cube_root, positions, days_per_chunk):
+        days = pd.DatetimeIndex(chunk_times).normalize()
+        starts = np.concatenate([[0], np.flatnonzero(days[1:] != days[:-1]) + 1])
+        day_max, day_sum, day_count, day_hours = _day_aggregates(values, starts, threshold_positions, thresholds)
+
+        rows = slice(day_row, day_row + len(starts))
+        arrays[("daily", "max")][rows] = day_max
+        arrays[("daily", "mean")][rows] = _mean(day_sum, day_count)
+        arrays[("daily", "hours")][rows] = day_hours
+        day_row += len(starts)
+
+        day_months = days[starts].month.values - 1
+        for month in np.unique(day_months):
+            sel = day_months == month
+            month_max[month] = np.fmax(month_max[month], np.fmax.reduce(day_max[sel], axis=0))
+            month_sum[month] += day_sum[sel].sum(axis=0)
+            month_count[month] += day_count[sel].sum(axis=0)
+            month_hours[month] += day_hours[sel].sum(axis=0)
+            months_seen.add(int(month))
+
+    months = sorted(months_seen)
+    rows = slice(month_row, month_row + len(months))
+    arrays[("monthly", "max")][rows] = month_max[months]
+    arrays[("monthly", "mean")][rows] = _mean(month_sum[months], month_count[months])
+    arrays[("monthly", "hours")][rows] = month_hours[months]
+
+    arrays[("yearly", "max")][year_row] = np.fmax.reduce(month_max[months], axis=0)
+    arrays[("yearly", "mean")][year_row] = _mean(month_sum[months].sum(axis=0), month_count[months].sum(axis=0))
+    arrays[("yearly", "hours")][year_row] = month_hours[months].sum(axis=0)
+
+    for array in arrays.values():
+        array.flush()
+    return year_row, time.time() - start_time
+
+
+def build_rollup(temp_path, dew_path, root, cube_root=None, days_per_chunk=DEFAULT_DAYS_PER_CHUNK, n_workers=1,
+                 verbose=True):
+    """
+    Costruisce la piramide di aggregati per cella di temperatura (°C) e indici.
+    Parametri:
+      - temp_path: NetCDF con T_2M
+      - dew_path: NetCDF con TD_2M
+      - root: cartella di output
+      - cube_root: cubo degli indici da cui leggere i dati orari (se esiste;
+        altrimenti gli indici vengono calcolati dai NetCDF)
+      - days_per_chunk: giorni letti per blocco (memoria limitata)
+      - n_workers: numero di processi (uno shard per anno; None = tutti i core)
+    Ritorna:
+      - Rollup aperto sulla piramide appena creata
+    """
+    import xarray as xr
+
+    from cube import IndexCube, cube_exists
+    from constants import soglie
+
+    start_time = time.time()
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if cube_root is not None and cube_exists(cube_root):
+        cube = IndexCube(cube_root)
+        timestamps = cube.timestamps.values
+        n_rlat, n_rlon = cube.data.shape[2:]
+        del cube
+    else:
+        with xr.open_dataset(temp_path) as dataset_temp:
+            timestamps = dataset_temp['T_2M'].time.values
+            n_rlat = dataset_temp.sizes['rlat']
+            n_rlon = dataset_temp.sizes['rlon']
+    if np.any(np.diff(timestamps) <= np.timedelta64(0)):
+        raise ValueError("I timestamp dei dati orari devono essere strettamente crescenti")
+
+    threshold_variables = [name for name in soglie if name in ROLLUP_VARIABLES]
+    threshold_positions = [ROLLUP_VARIABLES.index(name) for name in threshold_variables]
+    thresholds = [float(soglie[name]) for name in threshold_variables]
+    periods = {level: list(pd.unique(period_labels(timestamps, level))) for level in LEVELS}
+
+    os.makedirs(root, exist_ok=True)
+    meta_path = os.path.join(root, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    shapes = {}
+    for level in LEVELS:
+        for stat in STATS:
+            n_layers = len(threshold_variables) if stat == "hours" else len(ROLLUP_VARIABLES)
+            shape = (len(periods[level]), n_layers, n_rlat, n_rlon)
+            dtype = np.uint16 if stat == "hours" else np.float32
+            np.lib.format.open_memmap(os.path.join(root, _file_name(level, stat)), mode="w+", dtype=dtype,
+                                      shape=shape)
+            shapes[f"{level}_{stat}"] = list(shape)
+
+    # Uno shard per anno, con le righe di output del suo primo giorno, primo mese e dell'anno
+    years = pd.DatetimeIndex(timestamps).year.values
+    day_positions = {label: i for i, label in enumerate(periods["daily"])}
+    month_positions = {label: i for i, label in enumerate(periods["monthly"])}
+    args = []
+    for year_row, year in enumerate(periods["yearly"]):
+        positions = np.flatnonzero(years == int(year))
+        first = timestamps[positions[:1]]
+        offsets = (day_positions[period_labels(first, "daily")[0]], month_positions[period_labels(first, "monthly")[0]],
+                   year_row)
+        args.append((temp_path, dew_path, cube_root, root, positions, offsets, threshold_positions, thresholds,
+                     days_per_chunk))
+
+    if n_workers == 1:
+        results = (_rollup_year(*a) for a in args)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        results = (future.result() for future in [executor.submit(_rollup_year, *a) for a in args])
+    try:
+        for year_row, elapsed in results:
+            if verbose:
+                print(f"  Aggregati {periods['yearly'][year_row]} completati in {elapsed:.1f} secondi.")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    meta = {
+        "variables": list(ROLLUP_VARIABLES),
+        "threshold_variables": threshold_variables,
+        "thresholds": thresholds,
+        "periods": periods,
+        "shapes": shapes,
+    }
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+    if verbose:
+        print(f"✅ Piramide degli aggregati ({periods['yearly'][0]}-{periods['yearly'][-1]}) creata in {root} "
+              f"in {time.time() - start_time:.1f} secondi.")
+    return Rollup(root)
+
+
+def rollup_exists(root):
+    """True se la cartella contiene una piramide completa."""
+    return os.path.exists(os.path.join(root, META_FILE))
+
+
+class Rollup:
+    """
+    Lettore della piramide degli aggregati con accesso in memory-map.
+    Le griglie restituite sono viste in sola lettura sul file.
+    """
+
+    def __init__(self, root):
+        if not rollup_exists(root):
+            raise FileNotFoundError(f"❌ Piramide degli aggregati non trovata o incompleta: {root}")
+        with open(os.path.join(root, META_FILE)) as f:
+            meta = json.load(f)
+        self.root = root
+        self.variables = tuple(meta["variables"])
+        self.thresholds = dict(zip(meta["threshold_variables"], meta["thresholds"]))
+        self.periods = {level: pd.Index(labels) for level, labels in meta["periods"].items()}
+        self.data = {}
+        for level in LEVELS:
+            for stat in STATS:
+                array = np.load(os.path.join(root, _file_name(level, stat)), mmap_mode="r")
+                if list(array.shape) != meta["shapes"][f"{level}_{stat}"]:
+                    raise ValueError(f"Forma di {_file_name(level, stat)} {array.shape} diversa da meta.json")
+                self.data[(level, stat)] = array
+
+    def _layer(self, variable, stat):
+        """Posizione della variabile nel secondo asse degli array di stat."""
+        if stat not in STATS:
+            raise ValueError(f"Statistica sconosciuta: {stat!r} (disponibili: {', '.join(STATS)})")
+        if stat == "hours":
+            if variable not in self.thresholds:
+                raise KeyError(f"Nessuna soglia per {variable!r}")
+            return list(self.thresholds).index(variable)
+        return self.variables.index(variable)
+
+    def get(self, level, period, variable, stat="max"):
+        """
+        Griglia (rlat, rlon) di una statistica per un periodo.
+        Parametri:
+          - level: "daily", "monthly" o "yearly"
+          - period: etichetta del periodo ("2023-07-15", "2023-07", "2023") o timestamp
+          - variable: nome della variabile (vedi ROLLUP_VARIABLES)
+          - stat: "max", "mean" oppure "hours" (ore sopra soglia)
+        Ritorna:
+          - array 2D (float32, uint16 per "hours")
+        """
+        if not isinstance(period, str):
+            period = pd.Timestamp(period).strftime(PERIOD_FORMATS[level])
+        row = self.periods[level].get_loc(period)
+        return self.data[(level, stat)][row, self._layer(variable, stat)]
+
+    def average(self, level, variable, stat="max", periods=None):
+        """
+        Media per cella della statistica su più periodi (es. ore sopra soglia
+        per anno, in media su tutti gli anni).
+        Ritorna:
+          - array 2D float32
+        """
+        rows = slice(None) if periods is None else self.periods[level].get_indexer(list(periods))
+        return _nanmean(self.data[(level, stat)][rows, self._layer(variable, stat)], axis=0)
+
+    def series(self, level, variable, stat="max", cell=None):
+        """
+        Serie temporale di una statistica per una cella (rlat, rlon) oppure,
+        con cell=None, della media spaziale.
+        Ritorna:
+          - Series indicizzata per periodo
+        """
+        values = self.data[(level, stat)][:, self._layer(variable, stat)]
+        if cell is None:
+            series = _nanmean(values.reshape(len(values), -1), axis=1)
+        else:
+            series = values[:, cell[0], cell[1]]
+        return pd.Series(series, index=self.periods[level], name=f"{variable} {stat}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Piramide di aggregati temporali per cella")
+    parser.add_argument("temp_path", help="NetCDF con T_2M")
+    parser.add_argument("dew_path", help="NetCDF con TD_2M")
+    parser.add_argument("root", help="cartella di output")
+    parser.add_argument("--cube", help="cubo degli indici da cui leggere i dati orari (cube.py)")
+    parser.add_argument("--days-per-chunk", type=int, default=DEFAULT_DAYS_PER_CHUNK,
+                        help="giorni letti per blocco")
+    parser.add_argument("--workers", type=int, default=1, help="processi (0 = tutti i core)")
+    args = parser.parse_args(argv)
+    build_rollup(args.temp_path, args.dew_path, args.root, cube_root=args.cube, days_per_chunk=args.days_per_chunk,
+                 n_workers=args.workers or None)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""
+Archivio colonnare (Parquet) per la tabella degli indici di heat stress.
+
+Rispetto al CSV in formato lungo, le colonne sono tipizzate:
+  - Timestamp: datetime64
+  - Indice: categorica
+  - statistiche e soglia: float32
+  - confronti con la soglia: booleani (invece di "si"/"no")
+e i dati sono partizionati per anno (Year=YYYY/), così il caricamento può
+leggere solo le colonne e gli anni necessari.
+"""
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from constants import STAT_COLUMNS, soglie
+
+
+VALUE_COLUMNS = [col_value for col_value, _ in STAT_COLUMNS.values()] + ["Soglia (°C)"]
+FLAG_COLUMNS = [col_flag for _, col_flag in STAT_COLUMNS.values()]
+INDEX_CATEGORIES = list(soglie.keys())
+
+PARTITION_COLUMN = "Year"
+COMPRESSION = "zstd"
+
+
+def to_columnar(df):
+    """
+    Converte la tabella in formato lungo (output di extraction o CSV storico)
+    nei tipi dell'archivio colonnare.
+    Parametri:
+      - df: DataFrame con le colonne del notebook di estrazione
+    Ritorna:
+      - nuovo DataFrame tipizzato con la colonna di partizione "Year"
+    """
+    out = pd.DataFrame({
+        "Timestamp": pd.to_datetime(df["Timestamp"]),
+        "Numero Timestamp": df["Numero Timestamp"].astype(np.int32),
+        "Indice": pd.Categorical(df["Indice"], categories=INDEX_CATEGORIES),
+    })
+    for col in VALUE_COLUMNS:
+        out[col] = df[col].astype(np.float32)
+    for col in FLAG_COLUMNS:
+        flags = df[col]
+        # "si"/"no" possono avere dtype object o str (pandas 3): si confrontano i valori
+        out[col] = flags if flags.dtype == bool else flags.astype(str).eq("si")
+    out[PARTITION_COLUMN] = out["Timestamp"].dt.year.astype(np.int16)
+    return out
+
+
+def from_columnar(df):
+    """
+    Riporta le colonne di confronto con la soglia dai booleani dell'archivio
+    ai valori "si"/"no" del CSV (attesi dai notebook e dal lettore del CSV).
+    Ritorna:
+      - nuovo DataFrame
+    """
+    out = df.copy()
+    for col in FLAG_COLUMNS:
+        if col in out.columns and out[col].dtype == bool:
+            out[col] = np.where(out[col].to_numpy(), "si", "no")
+    return out
+
+
+def write_partitions(df, root, part_name="part"):
+    """
+    Aggiunge un blocco di righe all'archivio, scrivendo un file per anno
+    in root/Year=YYYY/. I file esistenti non vengono riscritti.
+    Ogni file viene scritto con un nome temporaneo (ignorato in lettura)
+    e poi rinominato, così un'interruzione non lascia file parziali.
+    Parametri:
+      - df: DataFrame in formato lungo (viene convertito con to_columnar)
+      - root: cartella dell'archivio
+      - part_name: nome univoco del blocco (es. primo timestamp)
+    """
+    df = to_columnar(df)
+    for year, df_year in df.groupby(PARTITION_COLUMN, sort=True):
+        part_dir = os.path.join(root, f"{PARTITION_COLUMN}={year}")
+        os.makedirs(part_dir, exist_ok=True)
+        table = pa.Table.from_pandas(df_year.drop(columns=PARTITION_COLUMN), preserve_index=False)
+        final_path = os.path.join(part_dir, f"{part_name}.parquet")
+        tmp_path = os.path.join(part_dir, f".{part_name}.parquet.tmp")
+        pq.write_table(table, tmp_path, compression=COMPRESSION)
+        os.replace(tmp_path, final_path)
+
+
+def clear_store(root):
+    """Elimina l'archivio esistente (usato prima di una nuova estrazione completa)."""
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+
+
+def available_years(root):
+    """Ritorna gli anni presenti nell'archivio leggendo solo i nomi delle partizioni."""
+    if not os.path.isdir(root):
+        return []
+    prefix = f"{PARTITION_COLUMN}="
+    return sorted(int(name[len(prefix):]) for name in os.listdir(root) if name.startswith(prefix))
+
+
+def load_table(root, columns=None, years=None, indices=None):
+    """
+    Carica la tabella dall'archivio leggendo solo ciò che serve.
+    Parametri:
+      - root: cartella dell'archivio
+      - columns: lista di colonne da leggere (default: tutte)
+      - years: lista di anni da leggere (default: tutti)
+      - indices: lista di indici (valori di "Indice") da leggere (default: tutti)
+    Ritorna:
+      - DataFrame tipizzato, ordinato per timestamp
+    """
+    filters = []
+    if years is not None:
+        filters.append((PARTITION_COLUMN, "in", [int(y) for y in years]))
+    if indices is not None:
+        filters.append(("Indice", "in", list(indices)))
+    if columns is not None:
+        columns = list(dict.fromkeys(["Timestamp", *columns]))
+
+    df = pd.read_parquet(root, columns=columns, filters=filters or None)
+    if PARTITION_COLUMN in df.columns:
+        df[PARTITION_COLUMN] = df[PARTITION_COLUMN].astype(np.int16)
+    if "Indice" in df.columns:
+        df["Indice"] = df["Indice"].astype(pd.CategoricalDtype(INDEX_CATEGORIES))
+    return df.sort_values("Timestamp", kind="stable").reset_index(drop=True)
+
+
+def processed_timestamps(root):
+    """
+    Indice dei timestamp già presenti nell'archivio (legge solo la colonna Timestamp).
+    Ritorna:
+      - DatetimeIndex (vuoto se l'archivio non esiste)
+    """
+    if not available_years(root):
+        return pd.DatetimeIndex([])
+    timestamps = pd.read_parquet(root, columns=["Timestamp"])["Timestamp"]
+    return pd.DatetimeIndex(timestamps.unique()).sort_values()
+
+
+def csv_to_store(csv_path, root, chunksize=500_000):
+    """
+    Converte il CSV storico nell'archivio colonnare leggendolo a blocchi.
+    Al termine verifica che il numero di righe e di confronti "si" per
+    ciascuna colonna di soglia nell'archivio sia uguale a quello del CSV.
+    L'archivio convertito non ha il marker delle formule di extraction.py
+    (il CSV storico viene dal notebook 03), per cui non può essere esteso
+    con run_extraction(..., incremental=True).
+    Ritorna:
+      - numero di righe convertite
+    """
+    clear_store(root)
+    n_rows = 0
+    expected = dict.fromkeys(FLAG_COLUMNS, 0)
+    for i, chunk in enumerate(pd.read_csv(csv_path, chunksize=chunksize)):
+        write_partitions(chunk, root, part_name=f"csv-{i:05d}")
+        n_rows += len(chunk)
+        for col in FLAG_COLUMNS:
+            expected[col] += int(chunk[col].astype(str).eq("si").sum())
+
+    stored = pd.read_parquet(root, columns=FLAG_COLUMNS)
+    found = {col: int(stored[col].sum()) for col in FLAG_COLUMNS}
+    if len(stored) != n_rows or found != expected:
+        raise ValueError(f"Archivio diverso dal CSV: {len(stored)} righe invece di {n_rows}, "
+                         f"confronti 'si' {found} invece di {expected}")
+    return n_rows
@@ -0,0 +1,90 @@
+"""
+Aggregazioni precalcolate per il Trend Analyzer.
+
+Al caricamento la tabella degli indici (un record per timestamp e indice)
+viene ridotta una sola volta a:
+  - massimi giornalieri per ogni indice e statistica (float32)
+  - per ogni indice, statistica e anno, i massimi giornalieri ordinati
+Il numero di giorni sopra una soglia qualsiasi in un anno si ottiene quindi
+con una ricerca binaria, senza riscansionare la tabella originale.
+"""
+import numpy as np
+import pandas as pd
+
+
+# Colonne delle statistiche nella tabella degli indici
+STAT_LABELS = {
+    "Media (°C)": "Mean",
+    "Mediana (°C)": "Median",
+    "95° Perc. (°C)": "95th percentile",
+    "99° Perc. (°C)": "99th percentile",
+    "Massimo (°C)": "Maximum",
+}
+
+
+class TrendAggregates:
+    """
+    Massimi giornalieri e conteggi annuali dei superamenti di soglia,
+    per tutti gli indici e tutte le statistiche.
+    """
+
+    def __init__(self, df, stat_columns=None):
+        """
+        Parametri:
+          - df: DataFrame con almeno Timestamp, Indice e le colonne delle statistiche
+          - stat_columns: colonne da aggregare (default: quelle di STAT_LABELS presenti)
+        """
+        if stat_columns is None:
+            stat_columns = [col for col in STAT_LABELS if col in df.columns]
+        self.stat_columns = list(stat_columns)
+
+        dates = pd.to_datetime(df["Timestamp"]).dt.normalize()
+        daily = (df[self.stat_columns]
+                 .astype(np.float32)
+                 .groupby([df["Indice"].astype(str).values, dates.values])
+                 .max())
+        daily.index.names = ["Indice", "Date"]
+        self.daily_max = daily.sort_index()
+        self.indices = list(self.daily_max.index.get_level_values("Indice").unique())
+
+        # Per ogni (indice, statistica): valori ordinati per anno e poi per valore,
+        # con gli offset di inizio/fine di ciascun anno
+        self._sorted = {}
+        for index in self.indices:
+            daily_index = self.daily_max.loc[index]
+            years = daily_index.index.year.values
+            unique_years, starts = np.unique(years, return_index=True)
+            for stat in self.stat_columns:
+                values = daily_index[stat].values
+                order = np.lexsort((values, years))
+                # I NaN finiscono in fondo a ciascun anno e non contano come superamenti
+                valid = np.add.reduceat(~np.isnan(values[order]), starts) if len(values) else starts
+                self._sorted[(index, stat)] = (values[order], unique_years, starts, starts + valid)
+
+    def years(self, index):
+        """Anni disponibili per l'indice."""
+        return self._sorted[(index, self.stat_columns[0])][1]
+
+    def annual_exceedances(self, index, stat, threshold):
+        """
+        Numero di giorni per anno in cui il massimo giornaliero della
+        statistica supera la soglia (stesso risultato del groupby per
+        Year/DayOfYear seguito dal confronto con la soglia).
+        Ritorna:
+          - Series indicizzata per anno
+        """
+        values, years, starts, stops = self._sorted[(index, stat)]
+        counts = [stop - start - np.searchsorted(values[start:stop], threshold, side="right")
+                  for start, stop in zip(starts, stops)]
+        return pd.Series(np.asarray(counts, dtype=np.int64), index=pd.Index(years, name="Year"), name="Exceed")
+
+    def daily_series(self, index, stat, year=None):
+        """
+        Massimi giornalieri di una statistica per un indice (ed eventualmente un anno).
+        Ritorna:
+          - Series indicizzata per data
+        """
+        series = self.daily_max.loc[index, stat]
+        if year is not None:
+            series = series[series.index.year == year]
+        return series
@@ -0,0 +1,236 @@
+"""
+Avvio a freddo dell'app: precaricamento (warm-up) e report dei tempi di import.
+
+Le pagine importano subito solo ciò che serve per le prime righe mostrate;
+le librerie pesanti usate più in basso (plotly, matplotlib) vengono
+importate nel punto in cui servono. start_warm_up, chiamata in cima a ogni
+pagina, avvia una sola volta per processo un thread che prepara in
+background ciò che le pagine useranno: dataset, trasformazioni di
+coordinate, cubo, climatologia e aggregati per cella, tabelle delle colormap, sfondi delle mappe
+e moduli differiti. La prima pagina viene mostrata subito e le successive
+trovano le cache già pronte. Con HEATSTRESS_WARMUP=0 il warm-up è disattivato.
+
+import_report misura in un processo Python nuovo il tempo degli import di
+ciascuna pagina (fino al primo comando della pagina e in totale) e indica i
+moduli più pesanti; i risultati si salvano e si confrontano come baseline di
+benchmark.py, così che una regressione dell'avvio sia visibile.
+
+Uso:
+    python Heat_stress_App/warmup.py                        # warm-up con i tempi di ogni passo
+    python Heat_stress_App/warmup.py --report               # tempi di import delle pagine
+    python Heat_stress_App/warmup.py --report --save startup
+    python Heat_stress_App/warmup.py --report --compare startup
+"""
+import argparse
+import ast
+import importlib
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from functools import partial
+
+import streamlit as st
+
+import resources
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PAGES = ("HeatStress.py", os.path.join("pages", "00_Dashboard.py"), os.path.join("pages", "01_Trend analyzer.py"))
+
+# Moduli importati dalle pagine solo nel punto in cui servono
+DEFERRED_MODULES = ("plotly.graph_objects", "matplotlib.pyplot")
+WARMUP_COLORMAPS = ("inferno", "plasma", "viridis", "coolwarm", "cividis", "Blues", "RdBu_r")
+DEFAULT_REPEAT = 3
+TOP_MODULES = 5
+
+
+# === Warm-up ===
+
+def _warm_colormaps():
+    from rendering import colormap_lut
+
+    for cmap in WARMUP_COLORMAPS:
+        colormap_lut(cmap)
+
+
+def _warm_map_basemap():
+    """Sfondo delle mappe della Dashboard (tile contextily ricampionate)."""
+    from rendering import DEFAULT_WIDTH, basemap_raster, output_shape
+
+    extent = tuple(float(v) for v in resources.web_mercator_extent(resources.TEMP_PATH))
+    basemap_raster(extent, output_shape(extent, DEFAULT_WIDTH))
+
+
+def _warm_surface_basemap():
+    """Sfondo WMS della superficie 3D di HeatStress."""
+    from basemap import fetch_wms_png
+
+    fetch_wms_png(resources.padded_bbox(resources.TEMP_PATH))
+
+
+WARMUP_STEPS = (
+    ("datasets", resources.load_nc_datasets),
+    ("timestamps", resources.time_values),
+    ("geographic grid", resources.geographic_grid),
+    ("bounding box", resources.padded_bbox),
+    ("web mercator extent", resources.web_mercator_extent),
+    ("grid locator", resources.grid_locator),
+    ("index cube", resources.index_cube),
+    ("climatology", resources.climatology),
+    ("rollup", resources.rollup),
+    ("colormaps", _warm_colormaps),
+    ("map basemap", _warm_map_basemap),
+    ("surface basemap", _warm_surface_basemap),
+) + tuple((f"import {name}", partial(importlib.import_module, name)) for name in DEFERRED_MODULES)
+
+
+def warm_up(steps=WARMUP_STEPS, verbose=False):
+    """
+    Esegue i passi di warm-up in ordine. Un passo che fallisce (es. dati
+    mancanti, nessuna rete) non interrompe i successivi.
+    Ritorna:
+      - dizionario {passo: secondi impiegati, oppure None se fallito}
+    """
+    timings = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+            timings[name] = time.perf_counter() - start
+        except Exception as e:
+            timings[name] = None
+            if verbose:
+                print(f"  ⚠️ {name}: {e}")
+            continue
+        if verbose:
+            print(f"  {name:<28} {timings[name]:7.2f} s")
+    return timings
+
+
+@st.cache_resource(show_spinner=False)
+def start_warm_up():
+    """
+    Avvia (una sola volta per processo) il warm-up in un thread in background.
+    Ritorna:
+      - il thread, oppure None se disattivato con HEATSTRESS_WARMUP=0
+    """
+    if os.environ.get("HEATSTRESS_WARMUP", "1") == "0":
+        return None
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+    thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        # Le funzioni in cache di Streamlit chiamate dal thread usano il contesto della sessione
+        add_script_run_ctx(thread, ctx)
+    thread.start()
+    return thread
+
+
+# === Report dei tempi di import ===
+
+def page_imports(path):
+    """
+    Import di primo livello di una pagina.
+    Ritorna:
+      - (before_render, all_imports): sorgenti degli import che precedono il
+        primo altro comando della pagina e di tutti gli import di primo livello
+    """
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    before_render, all_imports = [], []
+    rendering_started = False
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            statement = ast.get_source_segment(source, node)
+            all_imports.append(statement)
+            if not rendering_started:
+                before_render.append(statement)
+        elif not (isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant)):
+            rendering_started = True
+    return before_render, all_imports
+
+
+def measure_imports(statements):
+    """
+    Esegue gli import in un processo Python nuovo con -X importtime.
+    Ritorna:
+      - (secondi totali, dizionario {modulo di primo livello: secondi cumulativi})
+    """
+    code = "\n".join(["import sys, time", f"sys.path.insert(0, {APP_DIR!r})", "start = time.perf_counter()",
+                      *statements, "print(time.perf_counter() - start)"])
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(APP_DIR), env={**os.environ, "HEATSTRESS_WARMUP": "0"})
+    if result.returncode != 0:
+        raise RuntimeError(f"Import falliti:\n{result.stderr[-2000:]}")
+    modules = {}
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | modulo" (i sottomoduli sono indentati)
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3 or parts[2][1:].startswith(" "):
+            continue
+        try:
+            modules[parts[2].strip()] = int(parts[1]) / 1e6
+        except ValueError:
+            continue
+    return float(result.stdout.strip().splitlines()[-1]), modules
+
+
+def import_report(pages=PAGES, repeat=DEFAULT_REPEAT, verbose=True):
+    """
+    Tempi di import di ogni pagina, prima del rendering e in totale.
+    Ritorna:
+      - dizionario {"startup/pagina/fase": {min_s, median_s, items, unit, throughput}}
+        nello stesso formato dei risultati di benchmark.py
+    """
+    results = {}
+    for page in pages:
+        name = os.path.splitext(os.path.basename(page))[0]
+        before_render, all_imports = page_imports(os.path.join(APP_DIR, page))
+        for phase, statements in (("before_render", before_render), ("all_imports", all_imports)):
+            runs = [measure_imports(statements) for _ in range(repeat)]
+            timings = [seconds for seconds, _ in runs]
+            key = f"startup/{name}/{phase}"
+            results[key] = {"min_s": min(timings), "median_s": statistics.median(timings), "items": 1,
+                            "unit": "avvii/s", "throughput": 1 / min(timings)}
+            if verbose:
+                heaviest = sorted(runs[0][1].items(), key=lambda item: item[1], reverse=True)[:TOP_MODULES]
+                print(f"  {key:<45} {min(timings):6.2f} s   "
+                      + ", ".join(f"{module} {seconds:.2f}s" for module, seconds in heaviest))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Warm-up dell'app e report dei tempi di import delle pagine")
+    parser.add_argument("--report", action="store_true", help="misura i tempi di import delle pagine")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="ripetizioni per misura")
+    parser.add_argument("--save", metavar="NOME", help="salva il report come baseline (vedi benchmark.py)")
+    parser.add_argument("--compare", metavar="NOME", help="confronta il report con una baseline salvata")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="rallentamento relativo tollerato prima di segnalare una regressione")
+    args = parser.parse_args(argv)
+
+    if not args.report:
+        start = time.perf_counter()
+        warm_up(verbose=True)
+        print(f"✅ Warm-up completato in {time.perf_counter() - start:.1f} secondi.")
+        return 0
+
+    import benchmark
+
+    results = import_report(repeat=args.repeat)
+    if args.save:
+        print(f"💾 Baseline salvata: {benchmark.save_baseline(results, args.save)}")
+    if args.compare:
+        table = benchmark.compare(results, benchmark.load_baseline(args.compare), args.tolerance)
+        print(table.to_string(index=False, float_format=lambda v: f"{v:.2f}"))
+        if (table["esito"] == "regressione").any():
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())